@@ -0,0 +1,91 @@
+-- Partitioning of the daily balance fact tables
+-- Purpose: Converts fact_client_daily_balance, fact_client_daily_portfolio_balance and fact_store_dailyinventorylevels
+--          into tables partitioned by day, so the update scripts can load each day as a partition of its own
+
+-- Why: the daily updates used to find and delete the rows of the day before loading it again (WHERE DATE(date) = CURRENT_DATE - 1).
+-- DATE() around the column prevents the use of an index, so both the check and the delete scanned the whole table,
+-- and the deleted rows left bloat behind on tables that only ever grow.
+-- Once partitioned, each day is loaded into a staging table and swapped in as that day's partition (see balance_loader.py):
+-- a rerun only replaces one small partition, and older days are never read or rewritten.
+
+-- How: the existing table is renamed to <table>_history and attached, as it is, as the partition of every day before
+-- yesterday. Rows from yesterday on (e.g. when the migration runs after the day's update) are moved into daily
+-- partitions of their own, named as the update scripts name them, so no loaded day is lost.
+-- Rows without a date cannot belong to a range partition: they are moved to <table>_without_date.
+-- Apart from these few rows, the history table is not rewritten, only scanned to validate its NOT NULL and CHECK
+-- constraints. Except when the date column is stored as text (tables created by pandas): converting it to DATE
+-- rewrites the whole history table, under an ACCESS EXCLUSIVE lock held until the migration commits.
+
+-- Run once, while the daily updates are paused.
+
+
+CREATE OR REPLACE PROCEDURE analytics_mart.partition_daily_fact_table(fact_table TEXT, date_column TEXT)
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    history_table TEXT := fact_table || '_history';
+    first_daily_partition DATE := CURRENT_DATE - 1;
+    daily_partition TEXT;
+    partition_day DATE;
+    has_undated_rows BOOLEAN;
+BEGIN
+    EXECUTE format('ALTER TABLE analytics_mart.%I RENAME TO %I', fact_table, history_table);
+
+    -- The partition key must be a DATE (tables created by pandas may hold the date as text; converting it rewrites the table)
+    IF (SELECT data_type FROM information_schema.columns
+        WHERE table_schema = 'analytics_mart' AND table_name = history_table AND column_name = date_column) <> 'date' THEN
+        EXECUTE format('ALTER TABLE analytics_mart.%I ALTER COLUMN %I TYPE DATE USING %I::DATE', history_table, date_column, date_column);
+    END IF;
+
+    EXECUTE format('CREATE TABLE analytics_mart.%I (LIKE analytics_mart.%I INCLUDING DEFAULTS) PARTITION BY RANGE (%I)',
+                   fact_table, history_table, date_column);
+
+    -- Days from yesterday on become daily partitions, as the update scripts load them (see balance_loader.py)
+    FOR partition_day IN EXECUTE format('SELECT DISTINCT %I FROM analytics_mart.%I WHERE %I >= %L ORDER BY 1',
+                                        date_column, history_table, date_column, first_daily_partition)
+    LOOP
+        daily_partition := fact_table || '_p' || to_char(partition_day, 'YYYYMMDD');
+
+        EXECUTE format('CREATE TABLE analytics_mart.%I AS SELECT * FROM analytics_mart.%I WHERE %I = %L',
+                       daily_partition, history_table, date_column, partition_day);
+        EXECUTE format('ALTER TABLE analytics_mart.%I ALTER COLUMN %I SET NOT NULL', daily_partition, date_column);
+        EXECUTE format('ALTER TABLE analytics_mart.%I ADD CONSTRAINT %I CHECK (%I >= %L AND %I < %L)',
+                       daily_partition, daily_partition || '_day', date_column, partition_day, date_column, partition_day + 1);
+        EXECUTE format('ALTER TABLE analytics_mart.%I ATTACH PARTITION analytics_mart.%I FOR VALUES FROM (%L) TO (%L)',
+                       fact_table, daily_partition, partition_day, partition_day + 1);
+    END LOOP;
+
+    -- Rows without a date are kept aside for inspection, if there are any
+    EXECUTE format('SELECT EXISTS (SELECT 1 FROM analytics_mart.%I WHERE %I IS NULL)', history_table, date_column) INTO has_undated_rows;
+    IF has_undated_rows THEN
+        EXECUTE format('CREATE TABLE analytics_mart.%I AS SELECT * FROM analytics_mart.%I WHERE %I IS NULL',
+                       fact_table || '_without_date', history_table, date_column);
+    END IF;
+    EXECUTE format('DELETE FROM analytics_mart.%I WHERE %I IS NULL OR %I >= %L', history_table, date_column, date_column, first_daily_partition);
+
+    -- Keep only the days before yesterday in the history, and state it with constraints,
+    -- so that attaching the history as a partition does not need to scan it
+    EXECUTE format('ALTER TABLE analytics_mart.%I ALTER COLUMN %I SET NOT NULL', history_table, date_column);
+    EXECUTE format('ALTER TABLE analytics_mart.%I ADD CONSTRAINT %I CHECK (%I < %L)',
+                   history_table, history_table || '_range', date_column, first_daily_partition);
+
+    EXECUTE format('ALTER TABLE analytics_mart.%I ATTACH PARTITION analytics_mart.%I FOR VALUES FROM (MINVALUE) TO (%L)',
+                   fact_table, history_table, first_daily_partition);
+
+    -- Index of the parent table, created on every partition (present and future), for date range queries
+    EXECUTE format('CREATE INDEX IF NOT EXISTS %I ON analytics_mart.%I (%I)', fact_table || '_date_idx', fact_table, date_column);
+END;
+$$;
+
+
+BEGIN;
+
+CALL analytics_mart.partition_daily_fact_table('fact_client_daily_balance', 'date');
+CALL analytics_mart.partition_daily_fact_table('fact_client_daily_portfolio_balance', 'portfolio_date');
+CALL analytics_mart.partition_daily_fact_table('fact_store_dailyinventorylevels', 'inventory_date');
+
+COMMIT;
+
+
+-- Full reloads: the backfill scripts start with DELETE FROM <table>. On a partitioned table, prefer
+-- TRUNCATE TABLE <table>, which empties every partition without scanning them.
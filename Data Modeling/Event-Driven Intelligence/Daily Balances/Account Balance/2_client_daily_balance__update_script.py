@@ -6,6 +6,7 @@ import pandas as pd
 from sqlalchemy import text
 import os
 from cred import db_conn
+from balance_loader import load_snapshot
 
 # Get the absolute path of the current directory
 dir_path = os.path.dirname(os.path.realpath('__file__'))
@@ -18,69 +19,141 @@ config.read(f"{dir_path}/config.ini")
 config_source = 'ANALYTICS_SOURCE_DB'
 source_engine, conn_source = db_conn(conn_param=config_source)
 
-# Check if we already have balance records for yesterday in the database
-check_query = """
-SELECT COUNT(*) as count
-FROM analytics_mart.fact_client_daily_balance
-WHERE DATE(date) = (CURRENT_DATE - 1)"""
-# This checks for yesterday's date because the updates for a particular day are done the following day
-
-# Execute the check query and get the count of existing records
-existing_count = pd.read_sql_query(check_query, source_engine).iloc[0]['count']
-
-# If records exist for yesterday, delete them to avoid duplicates
-if existing_count > 0:
-    delete_query = """
-    DELETE FROM analytics_mart.fact_client_daily_balance
-    WHERE DATE(date) = (CURRENT_DATE - 1)
-    """
-    with source_engine.connect() as connection:
-        connection.execute(text(delete_query))
-
-# Query to get the most recent balance for each client
-# Uses a CTE (Common Table Expression) to handle the data in steps:
-# 1. base_table: Gets all valid transactions (excluding Declined and Reverted)
-# 2. indexed_table: Numbers each transaction per client, with most recent first
-# 3. Final SELECT: Gets only the most recent transaction per client
-latest_balance = """
-    WITH base_table as (
-        SELECT trans.client_id AS id_index
-                , DATE(trans.created_at) AS date
-                , trans.*
-                
-        FROM public.transactions_log
-        WHERE transaction_status NOT IN ('Declined', 'Reverted')
-    ),
-    
-    indexed_table as (
-        SELECT ROW_NUMBER() OVER (PARTITION BY id_index ORDER BY created_at desc) AS daily_index,
-                *
-        FROM base_table 
-    )
-
-    SELECT date
-            , client_id
-            , end_amount as account_balance
-            , created_at as latest_trans_at
-    FROM indexed_table
-    WHERE daily_index = 1
+# Latest balance of each client, kept incrementally
+# Scanning the whole of public.transactions_log every day to find each client's latest transaction costs more as the
+# history grows. Instead, the latest balance of each client is persisted in a snapshot table, together with a
+# watermark: the latest creation or modification time (created_at / updated_at) of the transactions folded into it.
+# Each run finds the clients with a transaction created or modified after the watermark (indexes on
+# transactions_log.created_at and updated_at keep that read proportional to the day's activity), and derives the latest
+# valid balance of each of these clients again from their own transactions. A transaction later Declined or Reverted
+# therefore gives the client their previous balance back, or removes them from the snapshot if they have no valid one left.
+# The first run, or a run with REBUILD_BALANCE_SNAPSHOT=true, builds the snapshot from the full history.
+SNAPSHOT_JOB = 'client_latest_balance'
+REBUILD_SNAPSHOT = os.getenv('REBUILD_BALANCE_SNAPSHOT', 'false').lower() == 'true'
+
+# Transactions created or modified up to this long before the watermark are read again, in case they were committed late
+# (a transaction is only visible once committed, which can be after its timestamps). Refolding a client has no effect
+# when nothing changed, so the overlap is harmless. Raise it if transactions can take longer to commit.
+WATERMARK_LOOKBACK = timedelta(hours=float(os.getenv('BALANCE_WATERMARK_LOOKBACK_HOURS', 1)))
+
+snapshot_ddl = """
+CREATE TABLE IF NOT EXISTS analytics_mart.client_latest_balance (
+    client_id VARCHAR(25) PRIMARY KEY,
+    account_balance NUMERIC,
+    latest_trans_at TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS analytics_mart.etl_watermarks (
+    job_name TEXT PRIMARY KEY,
+    watermark TIMESTAMP NOT NULL,
+    updated_at TIMESTAMP NOT NULL DEFAULT now()
+);
+"""
+
+# Fold the clients touched since the watermark into the snapshot:
+# 1. touched: the clients with a transaction created or modified in the window, whatever its status
+# 2. latest: the most recent valid transaction (excluding Declined and Reverted) of each of them, over their whole history
+# 3. removed: touched clients left without any valid transaction are deleted from the snapshot
+# 4. The upsert replaces the balance of the other touched clients
+fold_query = """
+WITH touched AS (
+    SELECT DISTINCT client_id
+    FROM public.transactions_log
+    WHERE created_at > :since OR updated_at > :since
+),
+
+latest AS (
+    SELECT DISTINCT ON (logg.client_id)
+            logg.client_id
+            , logg.end_amount AS account_balance
+            , logg.created_at AS latest_trans_at
+    FROM public.transactions_log logg
+    JOIN touched ON touched.client_id = logg.client_id
+    WHERE logg.transaction_status NOT IN ('Declined', 'Reverted')
+    ORDER BY logg.client_id, logg.created_at DESC
+),
+
+removed AS (
+    DELETE FROM analytics_mart.client_latest_balance AS snapshot
+    USING touched
+    WHERE snapshot.client_id = touched.client_id
+        AND NOT EXISTS (SELECT 1 FROM latest WHERE latest.client_id = touched.client_id)
+    RETURNING snapshot.client_id
+),
+
+upserted AS (
+    INSERT INTO analytics_mart.client_latest_balance AS snapshot (client_id, account_balance, latest_trans_at)
+    SELECT client_id, account_balance, latest_trans_at
+    FROM latest
+    ON CONFLICT (client_id) DO UPDATE
+    SET account_balance = EXCLUDED.account_balance,
+        latest_trans_at = EXCLUDED.latest_trans_at
+    RETURNING client_id
+)
+
+SELECT (SELECT COUNT(*) FROM upserted) AS updated, (SELECT COUNT(*) FROM removed) AS removed
 """
 
-# Execute the balance query and store results in DataFrame
-hot_data = pd.read_sql_query(latest_balance, source_engine)
+# The snapshot, the fold and the new watermark are committed together, so an interrupted run is simply repeated
+with source_engine.begin() as connection:
+    connection.execute(text(snapshot_ddl))
 
-# Select only the required columns for the final dataset
-fin_data = hot_data[['date',
-                    'client_id',
-                    'account_balance',
-                    'latest_trans_at']]
+    # Snapshots created with a floating point balance are converted and rebuilt, so no balance keeps a rounding error
+    balance_type = connection.execute(text("""
+    SELECT data_type FROM information_schema.columns
+    WHERE table_schema = 'analytics_mart' AND table_name = 'client_latest_balance' AND column_name = 'account_balance'
+    """)).scalar()
+    rebuild = REBUILD_SNAPSHOT or balance_type != 'numeric'
+    if balance_type != 'numeric':
+        connection.execute(text("ALTER TABLE analytics_mart.client_latest_balance ALTER COLUMN account_balance TYPE NUMERIC"))
+
+    if rebuild:
+        connection.execute(text("TRUNCATE TABLE analytics_mart.client_latest_balance"))
+        watermark = None
+    else:
+        watermark = connection.execute(text("""
+        SELECT watermark FROM analytics_mart.etl_watermarks WHERE job_name = :job_name FOR UPDATE
+        """), {'job_name': SNAPSHOT_JOB}).scalar()
+
+    # No watermark yet: fold the full history once
+    since = datetime(1900, 1, 1) if watermark is None else watermark - WATERMARK_LOOKBACK
+
+    # The new watermark is read before the fold, so a transaction committed while it runs is read again by the next run
+    new_watermark = connection.execute(text("""
+    SELECT MAX(GREATEST(created_at, updated_at))
+    FROM public.transactions_log
+    WHERE created_at > :since OR updated_at > :since
+    """), {'since': since}).scalar()
+
+    updated, removed = connection.execute(text(fold_query), {'since': since}).one()
+
+    if new_watermark is not None and (watermark is None or new_watermark > watermark):
+        connection.execute(text("""
+        INSERT INTO analytics_mart.etl_watermarks (job_name, watermark, updated_at)
+        VALUES (:job_name, :watermark, now())
+        ON CONFLICT (job_name) DO UPDATE SET watermark = EXCLUDED.watermark, updated_at = EXCLUDED.updated_at
+        """), {'job_name': SNAPSHOT_JOB, 'watermark': new_watermark})
+
+print(f'{updated} client balances updated and {removed} removed since {since}')
+
+# Query to get the most recent balance for each client, now a plain read of the snapshot (one row per client)
+latest_balance = """
+    SELECT DATE(latest_trans_at) AS date
+            , client_id
+            , account_balance
+            , latest_trans_at
+    FROM analytics_mart.client_latest_balance
+"""
 
-# Update all dates to yesterday's date
+# Replace yesterday's balances in the fact table (see balance_loader.py)
+# Rows already loaded for yesterday are deleted first, so a rerun does not duplicate them. With BALANCE_LOAD_MODE=in_database
+# the delete and a single INSERT ... SELECT run in one transaction; by default the rows are streamed in chunks and written with COPY
 yesterday = (date.today()) - timedelta(days=1)
-fin_data.date = yesterday.strftime("%Y-%m-%d")
 print('\n\n\ntoday_date :', yesterday)
 
-# Save the final dataset to the database
 # If table doesn't exist, it will be created
 # If table exists, new records will be appended
-fin_data.to_sql('fact_client_daily_balance', source_engine, schema='analytics_mart', index=False, if_exists="append")
\ No newline at end of file
+rows_written = load_snapshot(latest_balance, conn_source, source_engine, 'fact_client_daily_balance', 'analytics_mart',
+                             columns=['date', 'client_id', 'account_balance', 'latest_trans_at'],
+                             date_column='date', snapshot_date=yesterday.strftime("%Y-%m-%d"))
+print(f'{rows_written} rows written to analytics_mart.fact_client_daily_balance')
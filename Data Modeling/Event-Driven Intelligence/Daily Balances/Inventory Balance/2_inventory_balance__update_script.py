@@ -4,6 +4,7 @@ from datetime import datetime, date, timedelta
 import pandas as pd
 import os
 from credentials import db_conn
+from balance_loader import load_snapshot
 from datetime import datetime
 dir_path = os.path.dirname(os.path.realpath('__file__'))
 import psycopg2
@@ -16,28 +17,6 @@ config_source = 'ANALYTICS_SOURCE_DB'
 # connection
 source_engine, conn_source = db_conn(conn_param=config_source)
 
-# Define the query to check for existing records for today's date
-check_query = """
-SELECT COUNT(*) as count
-FROM analytics_mart.fact_store_dailyinventorylevels
-WHERE DATE(inventory_date) = (CURRENT_DATE - 1)
-"""
-
-# Execute the check query
-try:
-    existing_count = pd.read_sql_query(check_query, source_engine).iloc[0]['count']
-except psycopg2.errors.UndefinedTable:
-    existing_count = 0
-
-# If there are existing records for today, delete them
-if existing_count > 0:
-    delete_query = """
-    DELETE FROM analytics_mart.fact_store_dailyinventorylevels
-    WHERE DATE(inventory_date) = (CURRENT_DATE - 1)
-    """
-    with source_engine.connect() as connection:
-        connection.execute(delete_query)
-
 # Get the latest inventory levels for all stores
 latest_inventory = """
 with base_table as (
@@ -81,20 +60,18 @@ where daily_index = 1
 order by created desc
 """
 
-current_data = pd.read_sql_query(latest_inventory, source_engine)
-
-final_data = current_data[['inventory_date', 'store_id', 'store_name', 'product_id',
-                          'product_name', 'product_code', 'product_category', 'quality_level',
-                          'client_id', 'current_reserved_units', 'current_available_units',
-                          'current_total_units', 'current_reserved_volume',
-                          'current_available_volume', 'current_total_volume',
-                          'store_inventory_account_id', 'latest_trans_at']]
-
 # Set inventory date to yesterday
 yesterday = (date.today()) - timedelta(days=1)
-final_data.inventory_date = yesterday.strftime("%Y-%m-%d")
 print('\n\n\ntoday_date:', yesterday)
 
-# Save to analytics_mart schema
-final_data.to_sql('fact_store_dailyinventorylevels', source_engine,
-                  schema='analytics_mart', index=False, if_exists="append")
\ No newline at end of file
+# Replace yesterday's levels in the analytics_mart schema, streamed in chunks or in a single INSERT ... SELECT
+# depending on BALANCE_LOAD_MODE (see balance_loader.py)
+rows_written = load_snapshot(latest_inventory, conn_source, source_engine, 'fact_store_dailyinventorylevels', 'analytics_mart',
+                             columns=['inventory_date', 'store_id', 'store_name', 'product_id',
+                                      'product_name', 'product_code', 'product_category', 'quality_level',
+                                      'client_id', 'current_reserved_units', 'current_available_units',
+                                      'current_total_units', 'current_reserved_volume',
+                                      'current_available_volume', 'current_total_volume',
+                                      'store_inventory_account_id', 'latest_trans_at'],
+                             date_column='inventory_date', snapshot_date=yesterday.strftime("%Y-%m-%d"))
+print(f'{rows_written} rows written to analytics_mart.fact_store_dailyinventorylevels')
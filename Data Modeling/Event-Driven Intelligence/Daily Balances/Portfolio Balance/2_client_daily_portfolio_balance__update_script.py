@@ -6,6 +6,7 @@ import pandas as pd
 from sqlalchemy import text
 import os
 from cred import db_conn
+from balance_loader import load_snapshot
 
 # Get the absolute path of the current directory
 dir_path = os.path.dirname(os.path.realpath('__file__'))
@@ -18,25 +19,6 @@ config.read(f"{dir_path}/config.ini")
 config_source = 'ANALYTICS_SOURCE_DB'
 source_engine, conn_source = db_conn(conn_param=config_source)
 
-# Check if we already have balance records for yesterday in the database
-check_query = """
-SELECT COUNT(*) as count
-FROM analytics_mart.fact_client_daily_portfolio_balance
-WHERE DATE(portfolio_date) = (CURRENT_DATE - 1)"""
-# This checks for yesterday's date because the updates for a particular day are done the following day
-
-# Execute the check query and get the count of existing records
-existing_count = pd.read_sql_query(check_query, source_engine).iloc[0]['count']
-
-# If records exist for yesterday, delete them to avoid duplicates
-if existing_count > 0:
-    delete_query = """
-    DELETE FROM analytics_mart.fact_client_daily_portfolio_balance
-    WHERE DATE(portfolio_date) = (CURRENT_DATE - 1)
-    """
-    with source_engine.connect() as connection:
-        connection.execute(text(delete_query))
-
 # Query to get latest portfolio balance for all clients
 # Uses CTEs (Common Table Expressions) to handle the data in steps:
 # 1. base_table: Gets all portfolio transactions and joins with product information for complete product details
@@ -188,18 +170,17 @@ WHERE daily_index = 1
 
 ORDER BY client_id, product_code, "location" 
 """
-hot_data = pd.read_sql_query(latest_balance,source_engine)
-
-fin_data = hot_data[['portfolio_date', 'client_id', 'product_code', 
-                     'location', 'state',
-					 'total_portfolio_balance', 'latest_trans_at']]
-
 # change the latest portfolio_date to the current date
 yesterday = (date.today()) - timedelta(days=1)
-fin_data.portfolio_date = yesterday.strftime("%Y-%m-%d")
 print('\n\n\ntoday_date :',yesterday)
 
-# Save the final dataset to the database
+# Replace yesterday's balances in the database (see balance_loader.py): streamed in chunks and written with COPY,
+# or with BALANCE_LOAD_MODE=in_database, deleted and inserted by a single INSERT ... SELECT in one transaction
 # If table doesn't exist, it will be created
 # If table exists, new records will be appended
-fin_data.to_sql('fact_client_daily_portfolio_balance', source_engine, schema='analytics_mart', index=False, if_exists="append")
+rows_written = load_snapshot(latest_balance, conn_source, source_engine, 'fact_client_daily_portfolio_balance', 'analytics_mart',
+                             columns=['portfolio_date', 'client_id', 'product_code',
+                                      'location', 'state',
+                                      'total_portfolio_balance', 'latest_trans_at'],
+                             date_column='portfolio_date', snapshot_date=yesterday.strftime("%Y-%m-%d"))
+print(f'{rows_written} rows written to analytics_mart.fact_client_daily_portfolio_balance')
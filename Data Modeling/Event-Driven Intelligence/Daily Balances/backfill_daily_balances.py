@@ -0,0 +1,803 @@
+# Import required libraries
+import argparse
+import json
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date, datetime, timedelta
+from sqlalchemy import text
+from cred import db_conn
+from balance_loader import is_partitioned, daily_partitions_start, create_staging_partition, swap_partition
+
+# Parallel backfill of the daily balance fact tables over any date range
+# The backfill scripts (1_*_backfill.sql) rebuild a whole fact table in a single statement over the entire history,
+# which cannot be resumed, split or limited to a few days. Here the work is split into steps run concurrently over the
+# connection pool of the engine returned by cred.db_conn:
+# 1. The events of the range are read once, in segments of days: the last event of each entity on each day is written
+#    to a staging table, together with the latest event of each entity before the range and after it, and the first
+#    and last day of the events of each entity are written to another one.
+# 2. From the staging tables, one query derives the balance carried into the first day of every chunk (its opening),
+#    and another the first and last event day of each entity over all its events (its span).
+# 3. The chunks of days are computed from the staging tables, each independently of the others, and each replaces its
+#    days in one transaction. Days held in daily partitions (see 0_partition_daily_balance_tables.sql) are swapped in
+#    as partitions, as by the update scripts.
+# The completed days are recorded in a checkpoint file, so an interrupted backfill resumes where it stopped.
+#
+# Usage (from the Daily Balances folder, with the Event-Driven Intelligence folder on the PYTHONPATH):
+#   python backfill_daily_balances.py --models account inventory --start 2024-01-01 --end 2024-06-30 --workers 4
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+
+config_source = 'ANALYTICS_SOURCE_DB'
+
+# Backfill settings, each of which can be overridden on the command line (see parse_arguments)
+CHUNK_DAYS = 31
+BACKFILL_WORKERS = 4
+# Kept outside the repository, as it only serves to resume an interrupted backfill
+CHECKPOINT_FILE = os.getenv('BALANCE_BACKFILL_CHECKPOINT_FILE',
+                            os.path.join(tempfile.gettempdir(), 'daily_balances_backfill_checkpoint.json'))
+
+# Bounds of the events read before and after the backfilled range
+EARLIEST_EVENT = date(1900, 1, 1)
+LATEST_EVENT = date(9999, 12, 31)
+
+# Staging tables of a backfill, per model: created at the start, dropped at the end.
+# UNLOGGED, as they are rebuilt by any rerun. Two backfills of the same model must not run at the same time.
+STAGING_TABLES = {
+    'event_days': '{table}_backfill_event_days',       # Last event of each entity on each day with one
+    'event_spans': '{table}_backfill_event_spans',     # First and last event day of each entity, per segment of events
+    'openings': '{table}_backfill_openings',           # Latest event of each entity before the first day of each chunk
+    'spans': '{table}_backfill_spans',                 # First and last event day of each entity, before, in or after the range
+}
+
+# Columns of the event days and event spans tables, which are created empty
+EVENT_DAYS_COLUMNS = """
+WITH events AS (
+{events}
+)
+
+SELECT {keys}, DATE(created) AS day, {values}, created
+FROM events
+"""
+
+EVENT_SPANS_COLUMNS = """
+WITH events AS (
+{events}
+)
+
+SELECT {span_keys}, DATE(created) AS start_date, DATE(created) AS end_date
+FROM events
+"""
+
+# The events created between :events_from and :events_to, from which a staging query writes the first and last day
+# of the events of each entity to the event spans table. Every event counts in the spans, including those left out
+# of the balances by the model's balance filter.
+STAGED_EVENTS = """
+WITH events AS (
+{events}
+),
+
+spans AS (
+    INSERT INTO {event_spans}
+    SELECT {span_keys}, MIN(DATE(created)) AS start_date, MAX(DATE(created)) AS end_date
+    FROM events
+    GROUP BY {span_keys}
+)
+"""
+
+# Last event of each entity on each day
+EVENT_DAYS_QUERY = STAGED_EVENTS + """
+INSERT INTO {event_days}
+SELECT DISTINCT ON ({keys}, DATE(created)) {keys}, DATE(created) AS day, {values}, created
+FROM events
+WHERE {balance_filter}
+ORDER BY {keys}, DATE(created), created DESC
+"""
+
+# Latest event of each entity
+LATEST_EVENT_QUERY = STAGED_EVENTS + """
+INSERT INTO {event_days}
+SELECT DISTINCT ON ({keys}) {keys}, DATE(created) AS day, {values}, created
+FROM events
+WHERE {balance_filter}
+ORDER BY {keys}, created DESC
+"""
+
+# Opening of every chunk in one pass: an event day is the opening of the chunks starting after it,
+# up to and including the entity's next event day
+OPENINGS_QUERY = """
+SELECT boundaries.chunk_start, {keys}, {values}, created
+FROM (
+    SELECT *, LEAD(day) OVER (PARTITION BY {keys} ORDER BY day) AS next_day
+    FROM {event_days}
+) AS event_days
+JOIN UNNEST(CAST(:chunk_starts AS DATE[])) AS boundaries (chunk_start)
+    ON boundaries.chunk_start > event_days.day
+    AND (event_days.next_day IS NULL OR boundaries.chunk_start <= event_days.next_day)
+"""
+
+SPANS_QUERY = """
+SELECT {span_keys}, MIN(start_date) AS start_date, MAX(end_date) AS end_date
+FROM {event_spans}
+GROUP BY {span_keys}
+"""
+
+# Balance of each entity on each day of a chunk, read from the staging tables:
+# 1. opening: the latest event of each entity before the chunk, carried into its first day
+# 2. daily_last: the last event of each entity on each day of the chunk
+# 3. grid: every day of the chunk for every entity, with a running count of the days with an event, so that each day
+#    without one falls in the group of the last day with one (group 0: no event yet in the chunk, use the opening)
+# 4. balances: the values of the first day of each group, carried over the group's days.
+#    Entities start on the day of their first event, as in the backfill scripts.
+CHUNK_QUERY = """
+WITH opening AS (
+    SELECT {keys}, {values}, created
+    FROM {openings}
+    WHERE chunk_start = :chunk_start
+),
+
+daily_last AS (
+    SELECT {keys}, day, {values}, created
+    FROM {event_days}
+    WHERE day >= :chunk_start AND day < :chunk_end
+),
+
+entities AS (
+    SELECT {keys} FROM opening
+    UNION
+    SELECT {keys} FROM daily_last
+),
+
+days AS (
+    SELECT CAST(day AS DATE) AS day
+    FROM generate_series(CAST(:chunk_start AS DATE), CAST(:chunk_end AS DATE) - 1, INTERVAL '1 day') AS day
+),
+
+grid AS (
+    SELECT {entity_keys}, days.day, {daily_values}, daily_last.created
+            , COUNT(daily_last.created) OVER (PARTITION BY {entity_keys} ORDER BY days.day) AS running_total_transactions
+    FROM entities
+    CROSS JOIN days
+    LEFT JOIN daily_last
+        ON daily_last.day = days.day
+        AND {entities_join}
+),
+
+balances AS (
+    SELECT grid.day, {grid_keys}
+            , {carried_values}
+            , CASE WHEN grid.running_total_transactions = 0 THEN opening.created
+                ELSE FIRST_VALUE(grid.created) OVER carry END AS latest_trans_at
+    FROM grid
+    LEFT JOIN opening
+        ON {opening_join}
+    WHERE grid.running_total_transactions > 0 OR opening.created IS NOT NULL
+    WINDOW carry AS (PARTITION BY {grid_keys}, grid.running_total_transactions ORDER BY grid.day)
+)
+
+{select}
+"""
+
+# The models: for each fact table, its events (one row per transaction, with a `created` timestamp, limited to those
+# created between :events_from and :events_to on the indexed column of the log), the columns identifying an entity
+# (keys, never NULL), the columns carried from its latest event (values), and the final select over `balances`.
+# Optionally, a condition on the events setting a balance (balance_filter, by default all of them) and the columns
+# grouping the events into the spans of {spans} (span_keys, by default the keys).
+# history_start is the first day of the backfill scripts, and the default start of a backfill.
+MODELS = {
+    'account': {
+        'table': 'fact_client_daily_balance',
+        'date_column': 'date',
+        'columns': ['date', 'client_id', 'account_balance', 'latest_trans_at'],
+        'history_start': date(2023, 1, 1),
+        'backfill_sql': os.path.join(dir_path, 'Account Balance', '1_client_daily_balance__backfill.sql'),
+        'keys': ['client_id'],
+        'values': ['account_balance'],
+        'events': """
+    SELECT client_id
+            , end_amount AS account_balance
+            , created_at AS created
+    FROM public.transactions_log
+    WHERE transaction_status NOT IN ('Declined', 'Reverted')
+        AND created_at >= :events_from AND created_at < :events_to
+""",
+        'select': """
+SELECT day AS date
+        , client_id
+        , account_balance
+        , latest_trans_at
+FROM balances
+""",
+    },
+
+    'inventory': {
+        'table': 'fact_store_dailyinventorylevels',
+        'date_column': 'inventory_date',
+        'columns': ['inventory_date', 'store_id', 'store_name', 'product_id', 'product_name', 'product_code',
+                    'product_category', 'quality_level', 'client_id', 'current_reserved_units', 'current_available_units',
+                    'current_total_units', 'current_reserved_volume', 'current_available_volume', 'current_total_volume',
+                    'store_inventory_account_id', 'latest_trans_at'],
+        'history_start': date(2013, 1, 1),
+        'backfill_sql': os.path.join(dir_path, 'Inventory Balance', '1_inventory_balance__backfill.sql'),
+        # An inventory account is one product at one quality level in one store
+        'keys': ['store_inventory_account_id'],
+        'values': ['store_id', 'product_id', 'quality_level', 'client_id',
+                   'current_reserved_units', 'current_available_units', 'current_total_units',
+                   'current_reserved_volume', 'current_available_volume', 'current_total_volume'],
+        'events': """
+    SELECT trans.store_inventory_account_id
+            , acc.store_id
+            , acc.product_id
+            , acc.quality_level
+            , trans.client_id
+            , trans.reserved_units_after AS current_reserved_units
+            , trans.units_after AS current_available_units
+            , trans.total_units_after AS current_total_units
+            , trans.reserved_volume_after AS current_reserved_volume
+            , trans.volume_after AS current_available_volume
+            , trans.total_volume_after AS current_total_volume
+            , trans.created
+    FROM inventory.store_inventory_transaction trans
+    LEFT JOIN inventory.store_inventory_account acc
+    ON trans.store_inventory_account_id = acc.id
+    WHERE trans.is_deleted IS FALSE
+        AND trans.created >= :events_from AND trans.created < :events_to
+""",
+        'select': """
+SELECT bal.day AS inventory_date
+        , bal.store_id
+        , store.name AS store_name
+        , bal.product_id
+        , prod_item.name AS product_name
+        , prod_item.code AS product_code
+        , prod_item.category_type AS product_category
+        , bal.quality_level
+        , bal.client_id
+        , bal.current_reserved_units
+        , bal.current_available_units
+        , bal.current_total_units
+        , bal.current_reserved_volume
+        , bal.current_available_volume
+        , bal.current_total_volume
+        , bal.store_inventory_account_id
+        , bal.latest_trans_at
+FROM balances bal
+LEFT JOIN inventory.store store
+ON bal.store_id = store.id
+LEFT JOIN analytics_mart.dim_product prod_item
+ON bal.product_id = prod_item.id
+""",
+    },
+
+    'portfolio': {
+        'table': 'fact_client_daily_portfolio_balance',
+        'date_column': 'portfolio_date',
+        'columns': ['portfolio_date', 'client_id', 'product_code', 'location', 'state', 'total_portfolio_balance', 'latest_trans_at'],
+        'history_start': date(2022, 8, 28),  # The date when location_breakdown computation commenced
+        'backfill_sql': os.path.join(dir_path, 'Portfolio Balance', '1_client_daily_portfolio_balance__backfill.sql'),
+        'keys': ['client_id', 'product_code', 'location_code_after'],
+        'values': ['total_volume_after'],
+        # As in the backfill script, only the transactions moving a volume set a balance, but the days of an entity
+        # span all its transactions, per maturity date
+        'balance_filter': 'volume IS NOT NULL',
+        'span_keys': ['client_id', 'product_code', 'location_code_after', 'product_maturity_date'],
+        # The transactions per location, as derived from the location breakdowns in 1_client_daily_portfolio_balance__backfill.sql
+        'events': """
+    WITH base_table AS (
+        SELECT sec.product_type, sec.product_code, sec.maturity_date product_maturity_date, logg.client_id,
+                logg.location_id, loc.code location_code, logg.units, logg.total_units_before, logg.total_units_after,
+                logg.created, logg.location_breakdown, logg.location_breakdown_before, logg.location_breakdown_after
+        FROM public.portfolio_transactions_log logg
+        LEFT JOIN public.dim_product sec
+        ON logg.product_id = sec.id
+        LEFT JOIN public.dim_location loc
+        ON logg.location_id = loc.id
+        WHERE logg.created >= '2022-08-28' AND (NOT (sec.product_type = 'Dawa' AND logg.location_id IS NULL))
+            AND logg.created >= :events_from AND logg.created < :events_to
+    ),
+
+    using_location_breakdown AS (
+        SELECT *
+                , string_to_array(REPLACE(TRIM(BOTH '[]' FROM location_breakdown),'},', '};'), '; ') edited_location_breakdown
+                , string_to_array(REPLACE(TRIM(BOTH '[]' FROM location_breakdown_before),'},', '};'), '; ') edited_location_breakdown_before
+                , string_to_array(REPLACE(TRIM(BOTH '[]' FROM location_breakdown_after),'},', '};'), '; ') edited_location_breakdown_after
+        FROM base_table
+    ),
+
+    amount_moving AS (
+        SELECT client_id, product_code, created
+                , (loc_breakdown::json)->>'volume' AS volume
+                , (loc_breakdown::json)->>'location_code' AS location_code
+        FROM (SELECT *, UNNEST(edited_location_breakdown) AS loc_breakdown FROM using_location_breakdown) unnested_amount
+    ),
+
+    before_after_values AS (
+        SELECT client_id, product_code, product_type, product_maturity_date, units, created, location_code
+                , CASE WHEN product_type = 'Dawa' THEN total_units_after * 1000
+                    WHEN product_type != 'Dawa' AND loc_breakdown_after = '{}' THEN total_units_after
+                    ELSE ((loc_breakdown_after::json)->>'volume') :: INTEGER
+                    END AS total_volume_after
+                , CASE WHEN product_type = 'Dawa' THEN location_code
+                    WHEN product_type != 'Dawa' AND loc_breakdown_after = '{}' THEN location_code
+                    ELSE (loc_breakdown_after::json)->>'location_code'
+                    END AS location_code_after
+        FROM (SELECT *,
+                    UNNEST(coalesce(edited_location_breakdown_before, '{"{}"}')) AS loc_breakdown_before,
+                    UNNEST(coalesce(edited_location_breakdown_after, '{"{}"}')) AS loc_breakdown_after
+              FROM using_location_breakdown) unnested_before_after
+    )
+
+    SELECT bav.client_id
+            , bav.product_code
+            , bav.location_code_after
+            , DATE(bav.product_maturity_date) AS product_maturity_date
+            , bav.total_volume_after
+            , CASE WHEN bav.product_type = 'Dawa' THEN bav.units * 1000
+                WHEN bav.product_type != 'Dawa' AND am.volume IS NULL THEN bav.units
+                ELSE am.volume :: INTEGER
+                END AS volume
+            , bav.created
+    FROM before_after_values bav
+    LEFT JOIN amount_moving am
+    ON bav.client_id = am.client_id
+        AND bav.location_code_after = am.location_code
+        AND bav.product_code = am.product_code
+        AND bav.created = am.created
+""",
+        # Every day from the first transaction of an entity is kept, with no balance until its first transaction moving
+        # a volume. Securities are kept for a month after their maturity date, or after their last transaction if later.
+        # The first and last transaction days of each entity, whatever the backfilled range, are in {spans}.
+        'select': """
+SELECT days.day AS portfolio_date
+        , cl.client_id
+        , span.product_code
+        , loc.name AS "location"
+        , loc.state AS "state"
+        , ROUND(bal.total_volume_after, 4) AS total_portfolio_balance
+        , bal.latest_trans_at
+FROM {spans} span
+JOIN days
+ON days.day >= span.start_date
+LEFT JOIN balances bal
+ON bal.day = days.day
+    AND bal.client_id = span.client_id
+    AND bal.product_code = span.product_code
+    AND bal.location_code_after = span.location_code_after
+LEFT JOIN public.dim_client cl
+ON span.client_id = cl.id
+LEFT JOIN public.dim_location loc
+ON span.location_code_after = loc.code
+WHERE span.product_maturity_date IS NULL
+    OR ((span.end_date <= span.product_maturity_date) AND (days.day <= (span.product_maturity_date + INTERVAL '1 month')))
+    OR ((span.end_date > span.product_maturity_date) AND (days.day <= (span.end_date + INTERVAL '1 month')))
+""",
+    },
+}
+
+
+def staging_tables(model, schema='analytics_mart'):
+    """ Returns the names of the staging tables of a model's backfill (see STAGING_TABLES), qualified with the schema. """
+    return {name: f"{schema}.{table.format(table=model['table'])}" for name, table in STAGING_TABLES.items()}
+
+
+def _format_query(query, model, **tables):
+    """ Fills a query template with the events, keys and values of a model. """
+    return query.format(events=model['events'].strip('\n'),
+                        keys=', '.join(model['keys']),
+                        values=', '.join(model['values']),
+                        span_keys=', '.join(model.get('span_keys', model['keys'])),
+                        balance_filter=model.get('balance_filter', 'TRUE'),
+                        **tables)
+
+
+def chunk_query(model, schema='analytics_mart'):
+    """
+    Returns the query computing the balances of a model over a chunk of days (see CHUNK_QUERY).
+
+    The query takes two parameters: :chunk_start, the first day of the chunk, and :chunk_end, the day after its last day.
+    It reads the staging tables, which must have been filled for a range including the chunk (see run_backfill).
+    """
+    keys, values = model['keys'], model['values']
+    tables = staging_tables(model, schema)
+
+    return _format_query(
+        CHUNK_QUERY, model,
+        openings=tables['openings'],
+        event_days=tables['event_days'],
+        entity_keys=', '.join(f'entities.{key}' for key in keys),
+        grid_keys=', '.join(f'grid.{key}' for key in keys),
+        daily_values=', '.join(f'daily_last.{value}' for value in values),
+        entities_join=' AND '.join(f'daily_last.{key} = entities.{key}' for key in keys),
+        opening_join=' AND '.join(f'opening.{key} = grid.{key}' for key in keys),
+        carried_values='\n            , '.join(f'CASE WHEN grid.running_total_transactions = 0 THEN opening.{value} '
+                                 f'ELSE FIRST_VALUE(grid.{value}) OVER carry END AS {value}' for value in values),
+        select=model['select'].strip('\n').format(spans=tables['spans']))
+
+
+def create_staging_tables(engine, model, schema='analytics_mart'):
+    """ Creates the (empty) event days and event spans tables of a model's backfill, dropping the staging tables left by a previous run. """
+    tables = staging_tables(model, schema)
+
+    with engine.begin() as connection:
+        for table_name in tables.values():
+            connection.execute(text(f"DROP TABLE IF EXISTS {table_name}"))
+        for table_name, columns_query in ((tables['event_days'], EVENT_DAYS_COLUMNS), (tables['event_spans'], EVENT_SPANS_COLUMNS)):
+            connection.execute(text(f"CREATE UNLOGGED TABLE {table_name} AS {_format_query(columns_query, model)} WITH NO DATA"),
+                               {'events_from': EARLIEST_EVENT, 'events_to': EARLIEST_EVENT})
+
+
+def drop_staging_tables(engine, model, schema='analytics_mart'):
+    with engine.begin() as connection:
+        for table_name in staging_tables(model, schema).values():
+            connection.execute(text(f"DROP TABLE IF EXISTS {table_name}"))
+
+
+def stage_events(engine, model, events_from, events_to, latest_only=False, schema='analytics_mart'):
+    """
+    Writes the last event of each entity on each day, from the events created between two days, to the event days table,
+    and the first and last day of the events of each entity to the event spans table.
+
+    Parameters
+    ----------
+    engine : sqlalchemy.engine.Engine
+        The engine whose connection pool the steps of the backfill share.
+    model : dict
+        The model (see MODELS).
+    events_from, events_to : datetime.date
+        The events created from events_from and before events_to are read.
+    latest_only : bool, optional
+        Only write the latest event of each entity, e.g. for the events before the backfilled range,
+        of which only the balance carried into the range matters.
+    schema : str, optional
+        The schema of the fact table. Defaults to analytics_mart.
+
+    Returns
+    -------
+    int
+        The number of event days written.
+    """
+    tables = staging_tables(model, schema)
+    query = _format_query(LATEST_EVENT_QUERY if latest_only else EVENT_DAYS_QUERY, model,
+                          event_days=tables['event_days'], event_spans=tables['event_spans'])
+
+    with engine.begin() as connection:
+        return connection.execute(text(query), {'events_from': events_from, 'events_to': events_to}).rowcount
+
+
+def stage_openings(engine, model, chunk_starts, schema='analytics_mart'):
+    """ Derives the openings of the chunks starting on chunk_starts and the span of each entity, from the event days and event spans tables. """
+    tables = staging_tables(model, schema)
+
+    with engine.begin() as connection:
+        connection.execute(text(f"CREATE INDEX ON {tables['event_days']} (day)"))
+        connection.execute(text(f"CREATE UNLOGGED TABLE {tables['openings']} AS {_format_query(OPENINGS_QUERY, model, event_days=tables['event_days'])}"),
+                           {'chunk_starts': sorted(chunk_starts)})
+        connection.execute(text(f"CREATE INDEX ON {tables['openings']} (chunk_start)"))
+        connection.execute(text(f"CREATE UNLOGGED TABLE {tables['spans']} AS {_format_query(SPANS_QUERY, model, event_spans=tables['event_spans'])}"))
+        # Statistics for the plans of the chunk queries
+        for table_name in tables.values():
+            connection.execute(text(f"ANALYZE {table_name}"))
+
+
+def load_chunk(engine, model, chunk_start, chunk_end, schema='analytics_mart', daily_partitions=False):
+    """
+    Replaces the days of a chunk in the fact table of a model, in one transaction.
+
+    Parameters
+    ----------
+    engine : sqlalchemy.engine.Engine
+        The engine whose connection pool the chunks share.
+    model : dict
+        The model (see MODELS).
+    chunk_start : datetime.date
+        The first day of the chunk.
+    chunk_end : datetime.date
+        The last day of the chunk.
+    schema : str, optional
+        The schema of the fact table. Defaults to analytics_mart.
+    daily_partitions : bool, optional
+        The days of the chunk are held in daily partitions (see 0_partition_daily_balance_tables.sql). Each day is then
+        loaded into a staging table swapped in as its partition (see balance_loader.swap_partition), which creates the
+        partitions missing for some days and leaves no deleted rows behind. Otherwise, the days are deleted and inserted again.
+
+    Returns
+    -------
+    int
+        The number of rows written.
+    """
+    table_name = f"{schema}.{model['table']}"
+    date_column = model['date_column']
+    column_list = ', '.join(f'"{col}"' for col in model['columns'])
+    params = {'chunk_start': chunk_start, 'chunk_end': chunk_end + timedelta(days=1)}
+
+    with engine.begin() as connection:
+        if not daily_partitions:
+            # The date column is compared to a range rather than wrapped in DATE(), so that an index (or partitions) can be used
+            connection.execute(text(f"""
+            DELETE FROM {table_name}
+            WHERE {date_column} >= :chunk_start AND {date_column} < :chunk_end
+            """), params)
+
+            return connection.execute(text(f"INSERT INTO {table_name} ({column_list})\n{chunk_query(model, schema)}"), params).rowcount
+
+        connection.execute(text(f"CREATE TEMPORARY TABLE backfill_chunk ON COMMIT DROP AS\n{chunk_query(model, schema)}"), params)
+
+        # Swapping partitions locks the fact table. The lock is taken once, before the first swap, so that the chunks
+        # loaded at the same time swap their partitions one after the other rather than deadlock.
+        connection.execute(text(f"LOCK TABLE {table_name} IN ACCESS EXCLUSIVE MODE"))
+
+        row_count = 0
+        for offset in range((chunk_end - chunk_start).days + 1):
+            day = chunk_start + timedelta(days=offset)
+            staging_table = create_staging_partition(connection, schema, model['table'], date_column, day)
+            row_count += connection.execute(text(f"""
+            INSERT INTO {schema}.{staging_table} ({column_list})
+            SELECT {column_list} FROM backfill_chunk WHERE "{date_column}" = :day
+            """), {'day': day}).rowcount
+            swap_partition(connection, schema, model['table'], staging_table, day)
+
+        return row_count
+
+
+def split_into_chunks(days, chunk_days, breaks=()):
+    """
+    Splits days into chunks of at most chunk_days consecutive days, returned as (first day, last day) pairs.
+    A chunk never spans one of the breaks: a day in breaks always starts a new chunk.
+    """
+    breaks = set(breaks)
+    chunks = []
+    for day in sorted(days):
+        if chunks and day == chunks[-1][1] + timedelta(days=1) and (day - chunks[-1][0]).days < chunk_days and day not in breaks:
+            chunks[-1][1] = day
+        else:
+            chunks.append([day, day])
+
+    return [tuple(chunk) for chunk in chunks]
+
+
+def checkpoint_key(name, start, end):
+    """ Returns the key of a backfill in the checkpoint file: the model and the requested range. """
+    return f"{name} {start} to {end}"
+
+
+def load_checkpoint(checkpoint_file):
+    """ Returns the days already loaded by interrupted backfills, per model and requested range (see checkpoint_key). """
+    if not os.path.exists(checkpoint_file):
+        return {}
+
+    with open(checkpoint_file) as f:
+        return {key: {date.fromisoformat(day) for day in days} for key, days in json.load(f).get('completed_days', {}).items()}
+
+
+def save_checkpoint(checkpoint_file, completed_days):
+    """
+    Records the days loaded so far, writing to a temporary file first so a crash never leaves a truncated checkpoint.
+    The file is removed once no backfill is left to resume.
+    """
+    completed_days = {key: days for key, days in completed_days.items() if days}
+    if not completed_days:
+        if os.path.exists(checkpoint_file):
+            os.remove(checkpoint_file)
+        return
+
+    temporary_file = f"{checkpoint_file}.tmp"
+    with open(temporary_file, 'w') as f:
+        json.dump({'completed_days': {key: sorted(day.isoformat() for day in days) for key, days in completed_days.items()},
+                   'updated_at': datetime.now().isoformat(timespec='seconds')}, f, indent=2)
+    os.replace(temporary_file, checkpoint_file)
+
+
+def _days(first_day, last_day):
+    return [first_day + timedelta(days=offset) for offset in range((last_day - first_day).days + 1)]
+
+
+def run_backfill(engine, model_names, start, end, chunk_days=CHUNK_DAYS, workers=BACKFILL_WORKERS,
+                 checkpoint_file=CHECKPOINT_FILE, restart=False, schema='analytics_mart'):
+    """
+    Backfills the fact tables of some models over a date range, chunk by chunk and several chunks at a time.
+
+    The events of the range (and the latest events before and after it) are first staged, in segments of chunk_days
+    read concurrently, then the openings of the chunks are derived from them, and finally the chunks are loaded concurrently.
+    Each event is read once, whatever the number of chunks.
+
+    Parameters
+    ----------
+    engine : sqlalchemy.engine.Engine
+        The engine whose connection pool the steps share. Its pool must allow `workers` connections at once.
+    model_names : list of str
+        The models to backfill (keys of MODELS).
+    start : datetime.date or None
+        The first day. None starts each model at its history_start.
+    end : datetime.date
+        The last day.
+    chunk_days : int, optional
+        Number of days per chunk. Defaults to CHUNK_DAYS.
+    workers : int, optional
+        Number of segments, or chunks, computed at the same time. Defaults to BACKFILL_WORKERS.
+    checkpoint_file : str or None, optional
+        File recording the days already loaded, per model and requested range, until the backfill of the range completes.
+        None disables the checkpoint.
+    restart : bool, optional
+        Ignore the checkpoint and load every day again.
+    schema : str, optional
+        The schema of the fact tables. Defaults to analytics_mart.
+
+    Returns
+    -------
+    dict
+        For each model: the rows written, the days loaded and the chunks that failed (as (first day, last day) pairs).
+    """
+    completed_days = {} if restart or not checkpoint_file else load_checkpoint(checkpoint_file)
+    results = {name: {'rows_written': 0, 'days_loaded': 0, 'failed_chunks': []} for name in model_names}
+
+    # Plan each model: the days left to load, and their chunks
+    plans = {}
+    completed_ranges = False
+    for name in model_names:
+        model = MODELS[name]
+        model_start = start or model['history_start']
+        key = checkpoint_key(name, model_start, end)
+        done = completed_days.setdefault(key, set())
+        pending_days = [day for day in _days(model_start, end) if day not in done]
+
+        if done and not pending_days:
+            # The range was fully loaded by a run that stopped before clearing its checkpoint: clear it now,
+            # so the next backfill of the range loads it again instead of finding nothing to do
+            print(f"{name}: every day from {model_start} to {end} is recorded as loaded in {checkpoint_file} "
+                  f"by an interrupted backfill, nothing to do (the range is removed from the checkpoint)")
+            completed_days.pop(key)
+            completed_ranges = True
+            continue
+        if done:
+            print(f"{name}: resuming the backfill of {model_start} to {end}, {len(done)} days already loaded "
+                  f"(recorded in {checkpoint_file}, use --restart to load them again)")
+        if not pending_days:
+            continue
+
+        with engine.connect() as connection:
+            partitioned = is_partitioned(connection, schema, model['table'])
+            first_daily_day = daily_partitions_start(connection, schema, model['table']) if partitioned else None
+
+        # Chunks do not straddle the history partition and the daily partitions, which are loaded differently
+        chunks = split_into_chunks(pending_days, chunk_days, breaks=[first_daily_day] if first_daily_day else [])
+        plans[name] = {'key': key, 'first_day': pending_days[0], 'last_day': pending_days[-1],
+                       'chunks': [(chunk_start, chunk_end, partitioned and (first_daily_day is None or chunk_start >= first_daily_day))
+                                  for chunk_start, chunk_end in chunks]}
+
+    if checkpoint_file and completed_ranges:
+        save_checkpoint(checkpoint_file, completed_days)
+
+    if not plans:
+        return results
+
+    failed_models = set()
+
+    def run_steps(steps):
+        """ Runs (name, label, function, args) steps on the pool; returns the result of each successful step, by step. """
+        step_results = {}
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(steps)))) as executor:
+            futures = {executor.submit(function, *args): (name, label) for name, label, function, args in steps}
+            for future in as_completed(futures):
+                name, label = futures[future]
+                try:
+                    step_results[(name, label)] = future.result()
+                except Exception as err:
+                    print(f"{name}: {label} failed\n", err)
+                    failed_models.add(name)
+        return step_results
+
+    try:
+        # 1. Stage the events: the range in segments, and the latest events before and after it
+        for name in plans:
+            create_staging_tables(engine, MODELS[name], schema)
+
+        steps = []
+        for name, plan in plans.items():
+            range_end = plan['last_day'] + timedelta(days=1)
+            steps.append((name, f"events before {plan['first_day']}", stage_events,
+                          (engine, MODELS[name], EARLIEST_EVENT, plan['first_day'], True, schema)))
+            steps += [(name, f"events of {segment_start} to {segment_end}", stage_events,
+                       (engine, MODELS[name], segment_start, segment_end + timedelta(days=1), False, schema))
+                      for segment_start, segment_end in split_into_chunks(_days(plan['first_day'], plan['last_day']), chunk_days)]
+            steps.append((name, f"events after {plan['last_day']}", stage_events,
+                          (engine, MODELS[name], range_end, LATEST_EVENT, True, schema)))
+
+        print(f"Staging the events of {len(plans)} models in {len(steps)} segments, {workers} at a time...")
+        run_steps(steps)
+
+        # 2. Openings of the chunks
+        run_steps([(name, "openings", stage_openings, (engine, MODELS[name], [chunk[0] for chunk in plan['chunks']], schema))
+                   for name, plan in plans.items() if name not in failed_models])
+
+        for name in failed_models:
+            results[name]['failed_chunks'] += [(chunk_start, chunk_end) for chunk_start, chunk_end, _ in plans[name]['chunks']]
+
+        # 3. The chunks
+        chunks = [(name, chunk) for name, plan in plans.items() if name not in failed_models for chunk in plan['chunks']]
+        if chunks:
+            print(f"Backfilling {len(chunks)} chunks of up to {chunk_days} days, {workers} at a time...")
+            with ThreadPoolExecutor(max_workers=max(1, min(workers, len(chunks)))) as executor:
+                futures = {executor.submit(load_chunk, engine, MODELS[name], chunk_start, chunk_end, schema, daily_partitions): (name, chunk_start, chunk_end)
+                           for name, (chunk_start, chunk_end, daily_partitions) in chunks}
+
+                for future in as_completed(futures):
+                    name, chunk_start, chunk_end = futures[future]
+                    try:
+                        rows_written = future.result()
+                    except Exception as err:
+                        print(f"{name}: chunk {chunk_start} to {chunk_end} failed\n", err)
+                        results[name]['failed_chunks'].append((chunk_start, chunk_end))
+                        continue
+
+                    days = _days(chunk_start, chunk_end)
+                    results[name]['rows_written'] += rows_written
+                    results[name]['days_loaded'] += len(days)
+                    print(f"{name}: {chunk_start} to {chunk_end} loaded ({rows_written} rows)")
+
+                    # Only this thread writes the checkpoint, as each chunk completes
+                    if checkpoint_file:
+                        completed_days[plans[name]['key']].update(days)
+                        save_checkpoint(checkpoint_file, completed_days)
+
+    finally:
+        for name in plans:
+            drop_staging_tables(engine, MODELS[name], schema)
+
+    # A range backfilled completely has nothing left to resume: its days are removed from the checkpoint,
+    # so that a later backfill of the same range loads them again
+    if checkpoint_file:
+        for name, plan in plans.items():
+            if not results[name]['failed_chunks']:
+                completed_days.pop(plan['key'], None)
+        save_checkpoint(checkpoint_file, completed_days)
+
+    return results
+
+
+def parse_arguments(argv=None):
+    """ Reads the models, the date range and the backfill settings from the command line. """
+    yesterday = date.today() - timedelta(days=1)
+
+    parser = argparse.ArgumentParser(description="Backfill the daily balance fact tables over a date range, several chunks at a time.")
+    parser.add_argument('--models', nargs='+', choices=sorted(MODELS), default=sorted(MODELS),
+                        help="Models to backfill (default: all).")
+    parser.add_argument('--start', type=date.fromisoformat,
+                        help="First day, as YYYY-MM-DD (default: the first day of each model's backfill script).")
+    parser.add_argument('--end', type=date.fromisoformat, default=yesterday,
+                        help="Last day, as YYYY-MM-DD (default: yesterday).")
+    parser.add_argument('--chunk-days', type=int, default=CHUNK_DAYS,
+                        help="Days per chunk (default: %(default)s).")
+    parser.add_argument('--workers', type=int, default=BACKFILL_WORKERS,
+                        help="Segments of events, or chunks, computed at the same time (default: %(default)s).")
+    parser.add_argument('--checkpoint-file', default=CHECKPOINT_FILE,
+                        help="File recording the days already loaded until the backfill completes "
+                             "(default: %(default)s, set by BALANCE_BACKFILL_CHECKPOINT_FILE).")
+    parser.add_argument('--restart', action='store_true',
+                        help="Ignore the checkpoint and load every day again.")
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    arguments = parse_arguments(argv)
+
+    source_engine, conn_source = db_conn(conn_param=config_source)
+    if source_engine is None:
+        return "Database could not connect"
+    conn_source.close()
+
+    started = time.perf_counter()
+    results = run_backfill(source_engine, arguments.models, arguments.start, arguments.end, arguments.chunk_days,
+                           arguments.workers, arguments.checkpoint_file, arguments.restart)
+    print(f"Backfill finished in {time.perf_counter() - started:.1f} s")
+
+    failed = {name: result['failed_chunks'] for name, result in results.items() if result['failed_chunks']}
+    if failed:
+        error_msg = f"Backfill incomplete, chunks failed: {failed}. Re-run the script to retry them."
+        print(error_msg)
+        return error_msg
+
+
+if __name__ == "__main__":
+    main()
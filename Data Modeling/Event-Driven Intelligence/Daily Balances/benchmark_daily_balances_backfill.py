@@ -0,0 +1,168 @@
+# Import required libraries
+import argparse
+import json
+import os
+import re
+import time
+from datetime import date, datetime, timedelta
+from sqlalchemy import text
+from cred import db_conn
+from backfill_daily_balances import MODELS, CHUNK_DAYS, run_backfill
+
+# Benchmark of the two ways of rebuilding the daily balance fact tables:
+# - monolithic: the INSERT ... SELECT of the model's backfill script (1_*_backfill.sql), a single statement over all history,
+# - chunked: backfill_daily_balances.py, the same days split into chunks computed concurrently, for each number of workers given.
+#
+# Both write to copies of the fact tables in a separate schema (dropped and recreated for each run), so the
+# analytics_mart tables are never touched, over the same days: from the model's first day to yesterday.
+# The monolithic output is kept in its own copy ({table}_monolithic), and each chunked output is compared with it
+# (EXCEPT ALL both ways): a speedup is only reported when both wrote the same rows.
+# Every run is saved as a JSON file in the results directory.
+#
+# Usage (from the Daily Balances folder, with the Event-Driven Intelligence folder on the PYTHONPATH):
+#   python benchmark_daily_balances_backfill.py --models account --workers 1 4 8 --chunk-days 31
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+
+config_source = 'ANALYTICS_SOURCE_DB'
+
+RESULTS_DIR = os.path.join(dir_path, 'benchmark_results')
+
+
+def monolithic_query(backfill_sql_path):
+    """ Returns the SELECT of a backfill script: everything from the WITH that follows its INSERT INTO column list. """
+    with open(backfill_sql_path) as f:
+        backfill_sql = f.read()
+
+    match = re.search(r'INSERT INTO[^(]*\([^)]*\)\s*(?:--[^\n]*\n\s*)*(WITH\b.*)', backfill_sql, re.IGNORECASE | re.DOTALL)
+    if match is None:
+        raise ValueError(f"No INSERT INTO ... WITH statement found in {backfill_sql_path}")
+
+    return match.group(1).strip().rstrip(';')
+
+
+def reset_table(engine, schema, table_name, copy_name=None):
+    """ Drops and recreates a benchmark copy of a fact table (named copy_name, by default as the table), with the columns of the analytics_mart one. """
+    copy_name = copy_name or table_name
+    with engine.begin() as connection:
+        connection.execute(text(f"CREATE SCHEMA IF NOT EXISTS {schema}"))
+        connection.execute(text(f"DROP TABLE IF EXISTS {schema}.{copy_name}"))
+        connection.execute(text(f"CREATE TABLE {schema}.{copy_name} (LIKE analytics_mart.{table_name} INCLUDING DEFAULTS)"))
+
+
+def count_rows(engine, schema, table_name):
+    with engine.connect() as connection:
+        return connection.execute(text(f"SELECT COUNT(*) FROM {schema}.{table_name}")).scalar()
+
+
+def monolithic_table(model):
+    return f"{model['table']}_monolithic"
+
+
+def time_monolithic(engine, model, schema):
+    """ Times the backfill script's statement, writing into its own benchmark copy of the table (see monolithic_table). """
+    reset_table(engine, schema, model['table'], monolithic_table(model))
+    column_list = ', '.join(f'"{col}"' for col in model['columns'])
+
+    started = time.perf_counter()
+    with engine.begin() as connection:
+        connection.execute(text(f"INSERT INTO {schema}.{monolithic_table(model)} ({column_list})\n{monolithic_query(model['backfill_sql'])}"))
+    seconds = time.perf_counter() - started
+
+    return {'seconds': round(seconds, 3), 'rows': count_rows(engine, schema, monolithic_table(model))}
+
+
+def time_chunked(engine, name, model, schema, end, chunk_days, workers):
+    """ Times the chunked backfill of the same days (without checkpoint), writing into the benchmark copy of the table. """
+    reset_table(engine, schema, model['table'])
+
+    started = time.perf_counter()
+    results = run_backfill(engine, [name], None, end, chunk_days=chunk_days, workers=workers, checkpoint_file=None, schema=schema)
+    seconds = time.perf_counter() - started
+
+    return {'seconds': round(seconds, 3), 'rows': count_rows(engine, schema, model['table']),
+            'failed_chunks': [[str(chunk_start), str(chunk_end)] for chunk_start, chunk_end in results[name]['failed_chunks']]}
+
+
+def compare_outputs(engine, model, schema):
+    """
+    Compares the rows written by the chunked backfill with those written by the backfill script.
+    EXCEPT ALL is used both ways, so duplicated rows count, and NULLs compare as equal.
+    """
+    column_list = ', '.join(f'"{col}"' for col in model['columns'])
+    chunked, monolithic = f"{schema}.{model['table']}", f"{schema}.{monolithic_table(model)}"
+
+    differences = {}
+    with engine.connect() as connection:
+        for label, first, second in (('rows_only_in_chunked', chunked, monolithic), ('rows_only_in_monolithic', monolithic, chunked)):
+            differences[label] = connection.execute(text(f"""
+            SELECT COUNT(*)
+            FROM (SELECT {column_list} FROM {first}
+                  EXCEPT ALL
+                  SELECT {column_list} FROM {second}) AS difference
+            """)).scalar()
+
+    differences['matches_monolithic'] = not differences['rows_only_in_chunked'] and not differences['rows_only_in_monolithic']
+    return differences
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the monolithic backfill scripts with the chunked, parallel backfill.")
+    parser.add_argument('--models', nargs='+', choices=sorted(MODELS), default=sorted(MODELS), help="Models benchmarked (default: all).")
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4], help="Numbers of workers of the chunked backfill (default: %(default)s).")
+    parser.add_argument('--chunk-days', type=int, default=CHUNK_DAYS, help="Days per chunk (default: %(default)s).")
+    parser.add_argument('--schema', default='benchmark', help="Schema of the benchmark tables (dropped before each run).")
+    parser.add_argument('--results-dir', default=RESULTS_DIR, help="Directory where the results are saved.")
+    arguments = parser.parse_args()
+
+    source_engine, conn_source = db_conn(conn_param=config_source)
+    if source_engine is None:
+        return
+    conn_source.close()
+
+    # The backfill scripts load every day up to yesterday
+    end = date.today() - timedelta(days=1)
+    results = {'run_at': datetime.now().isoformat(timespec='seconds'), 'settings': vars(arguments), 'end': str(end), 'models': {}}
+
+    for name in arguments.models:
+        model = MODELS[name]
+        model_results = results['models'][name] = {'start': str(model['history_start'])}
+
+        try:
+            model_results['monolithic'] = time_monolithic(source_engine, model, arguments.schema)
+            print(f"{name:<12}{'monolithic':<16}{model_results['monolithic']['seconds']:>10.1f} s{model_results['monolithic']['rows']:>14,} rows")
+        except Exception as err:
+            # Reported rather than raised, so the chunked runs are still measured
+            model_results['monolithic'] = {'error': str(err)}
+            print(f"{name:<12}{'monolithic':<16}failed\n", err)
+
+        for workers in arguments.workers:
+            run = model_results[f'chunked_{workers}_workers'] = time_chunked(source_engine, name, model, arguments.schema,
+                                                                            end, arguments.chunk_days, workers)
+            print(f"{name:<12}{f'{workers} workers':<16}{run['seconds']:>10.1f} s{run['rows']:>14,} rows")
+
+            if 'seconds' not in model_results['monolithic']:
+                continue
+
+            # Timings are only compared when both backfills wrote the same rows
+            run.update(compare_outputs(source_engine, model, arguments.schema))
+            if not run['matches_monolithic']:
+                print(f"{name:<12}{'differs':<16}{run['rows_only_in_chunked']:,} rows only in the chunked output, "
+                      f"{run['rows_only_in_monolithic']:,} only in the monolithic one")
+            elif run['seconds']:
+                run['speedup'] = round(model_results['monolithic']['seconds'] / run['seconds'], 2)
+                print(f"{name:<12}{'speedup':<16}{run['speedup']:>10.2f}x")
+
+        with source_engine.begin() as connection:
+            connection.execute(text(f"DROP TABLE IF EXISTS {arguments.schema}.{model['table']}"))
+            connection.execute(text(f"DROP TABLE IF EXISTS {arguments.schema}.{monolithic_table(model)}"))
+
+    os.makedirs(arguments.results_dir, exist_ok=True)
+    result_path = os.path.join(arguments.results_dir, f"daily_balances_backfill_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    with open(result_path, 'w') as result_file:
+        json.dump(results, result_file, indent=2)
+    print(f"Results saved to: {result_path}")
+
+
+if __name__ == "__main__":
+    main()
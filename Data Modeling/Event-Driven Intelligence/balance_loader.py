@@ -0,0 +1,304 @@
+import csv  # For writing the rows in the format read by COPY
+import os  # For reading the load mode from the environment
+import re  # For reading the bound of the history partition
+from datetime import date, timedelta  # For the bounds of the daily partitions
+from io import StringIO  # In-memory buffer holding each chunk for COPY
+import pandas as pd  # For reading the query results in chunks
+from sqlalchemy import text  # For running the SQL statements of the snapshot
+
+# Number of rows read from the server-side cursor, and written with COPY, at a time
+CHUNK_SIZE = 50000
+
+# How a daily snapshot is loaded (see load_snapshot):
+# - 'stream': the rows are read into Python in chunks and written back with COPY
+# - 'in_database': the snapshot is computed and written by a single INSERT ... SELECT, without leaving the database
+LOAD_MODES = ('stream', 'in_database')
+LOAD_MODE = os.getenv('BALANCE_LOAD_MODE', 'stream')
+
+# Marks NULL values in the COPY data, so that empty strings are kept as empty strings
+COPY_NULL = '\\N'
+
+
+def copy_insert(table, conn, keys, data_iter):
+    """
+    Writes rows with PostgreSQL's COPY, for use as the `method` of pandas' DataFrame.to_sql.
+
+    The default method of to_sql sends INSERT statements, whereas COPY streams all the rows of a chunk to the server
+    in a single command, which is several times faster on large tables.
+
+    Parameters
+    ----------
+    table : pandas.io.sql.SQLTable
+        The table being written to (provided by to_sql).
+    conn : sqlalchemy.engine.Connection
+        The connection used by to_sql.
+    keys : list of str
+        The column names.
+    data_iter : iterable
+        The rows, as tuples with None for missing values.
+
+    Returns
+    -------
+    int
+        The number of rows written.
+    """
+    buffer = StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    row_count = 0
+    for row in data_iter:
+        writer.writerow([COPY_NULL if value is None else value for value in row])
+        row_count += 1
+    buffer.seek(0)
+
+    columns = ', '.join(f'"{key}"' for key in keys)
+    table_name = f'{table.schema}.{table.name}' if table.schema else table.name
+
+    # The raw DB-API (psycopg2) connection is used, as COPY is not available through SQLAlchemy
+    with conn.connection.cursor() as cur:
+        cur.copy_expert(f"COPY {table_name} ({columns}) FROM STDIN WITH (FORMAT csv, NULL '{COPY_NULL}')", buffer)
+
+    return row_count
+
+
+def stream_snapshot(query, stream_conn, engine, table_name, schema, columns, date_column, snapshot_date, chunksize=CHUNK_SIZE):
+    """
+    Loads the result of a latest-balance query into a daily fact table, one chunk at a time.
+
+    The query is read through a server-side cursor (the `stream_results=True` connection returned by `cred.db_conn`),
+    so only `chunksize` rows are held in memory at a time, whatever the size of the result. Each chunk is stamped
+    with the snapshot date and written with COPY (see copy_insert) before the next one is read.
+
+    Parameters
+    ----------
+    query : str
+        The query returning the latest balances.
+    stream_conn : sqlalchemy.engine.Connection
+        The streaming connection the query is read from.
+    engine : sqlalchemy.engine.Engine
+        The engine the chunks are written through (on a connection of their own, as the streaming one stays busy
+        with the open cursor).
+    table_name : str
+        The fact table, e.g. 'fact_client_daily_balance'. It is created by to_sql if it does not exist.
+    schema : str
+        The schema of the fact table, e.g. 'analytics_mart'.
+    columns : list of str
+        The columns written to the fact table, in order.
+    date_column : str
+        The column stamped with the snapshot date, e.g. 'date'.
+    snapshot_date : str
+        The date of the snapshot, e.g. yesterday as 'YYYY-MM-DD'. It is written as a date, so that a table created
+        by to_sql gets a DATE column.
+    chunksize : int, optional
+        Number of rows per chunk. Defaults to CHUNK_SIZE.
+
+    Returns
+    -------
+    int
+        The number of rows written.
+    """
+    snapshot_date = date.fromisoformat(str(snapshot_date))
+    row_count = 0
+
+    for chunk in pd.read_sql_query(query, stream_conn, chunksize=chunksize):
+        # Select the columns and stamp the date on the chunk, without a second copy of it
+        chunk = chunk[columns].assign(**{date_column: snapshot_date})
+        chunk.to_sql(table_name, engine, schema=schema, index=False, if_exists="append", method=copy_insert)
+        row_count += len(chunk)
+
+    return row_count
+
+
+def insert_snapshot(connection, query, table_name, schema, columns, date_column):
+    """
+    Writes the result of a latest-balance query into a daily fact table with a single INSERT ... SELECT.
+
+    The snapshot date (CURRENT_DATE - 1) is stamped in SQL, so no row crosses the network.
+    If the fact table does not exist, it is created with the columns and types of the query.
+
+    Parameters
+    ----------
+    connection : sqlalchemy.engine.Connection
+        The connection (and transaction) the snapshot is written in.
+    query : str
+        The query returning the latest balances. Its own date column is replaced by the snapshot date.
+    table_name, schema, columns, date_column :
+        As in stream_snapshot.
+
+    Returns
+    -------
+    int
+        The number of rows written.
+    """
+    select_list = ', '.join(f'(CURRENT_DATE - 1) AS "{col}"' if col == date_column else f'latest."{col}"' for col in columns)
+    snapshot = f"""
+    SELECT {select_list}
+    FROM (
+    {query}
+    ) AS latest
+    """
+
+    table_exists = connection.execute(text("SELECT to_regclass(:table_name) IS NOT NULL"),
+                                      {'table_name': f'{schema}.{table_name}'}).scalar()
+    if not table_exists:
+        connection.execute(text(f"CREATE TABLE {schema}.{table_name} AS {snapshot} WITH NO DATA"))
+
+    column_list = ', '.join(f'"{col}"' for col in columns)
+    return connection.execute(text(f"INSERT INTO {schema}.{table_name} ({column_list}) {snapshot}")).rowcount
+
+
+def is_partitioned(connection, schema, table_name):
+    """ Returns True if the table is a partitioned table (see 0_partition_daily_balance_tables.sql). """
+    return connection.execute(text("""
+    SELECT EXISTS (
+        SELECT 1
+        FROM pg_partitioned_table part
+        JOIN pg_class cls ON cls.oid = part.partrelid
+        JOIN pg_namespace nsp ON nsp.oid = cls.relnamespace
+        WHERE nsp.nspname = :schema AND cls.relname = :table_name
+    )
+    """), {'schema': schema, 'table_name': table_name}).scalar()
+
+
+def daily_partitions_start(connection, schema, table_name):
+    """
+    Returns the first day loaded as a daily partition: the upper bound of the history partition created by
+    0_partition_daily_balance_tables.sql, or None if the table has no history partition (every day is a daily partition).
+    """
+    bound = connection.execute(text("""
+    SELECT pg_get_expr(child.relpartbound, child.oid)
+    FROM pg_inherits inh
+    JOIN pg_class child ON child.oid = inh.inhrelid
+    JOIN pg_namespace nsp ON nsp.oid = child.relnamespace
+    WHERE inh.inhparent = to_regclass(:parent) AND nsp.nspname = :schema AND child.relname = :history_table
+    """), {'parent': f'{schema}.{table_name}', 'schema': schema, 'history_table': f'{table_name}_history'}).scalar()
+
+    # e.g. FOR VALUES FROM (MINVALUE) TO ('2024-06-30')
+    match = re.search(r"TO \('(\d{4}-\d{2}-\d{2})'\)", bound or '')
+    return date.fromisoformat(match.group(1)) if match else None
+
+
+def partition_name(table_name, day):
+    """ Returns the name of the partition holding a day, e.g. fact_client_daily_balance_p20240131. """
+    return f"{table_name}_p{day:%Y%m%d}"
+
+
+def create_staging_partition(connection, schema, table_name, date_column, day):
+    """
+    Creates the empty table a day is loaded into before it is swapped in as the day's partition (see swap_partition).
+
+    The staging table has the columns and indexes of the fact table, a NOT NULL date column and a CHECK constraint
+    limiting it to the day, so that attaching it as a partition needs neither to scan it nor to build indexes.
+
+    Parameters
+    ----------
+    connection : sqlalchemy.engine.Connection
+        The connection (and transaction) the staging table is created in.
+    schema, table_name, date_column :
+        As in stream_snapshot.
+    day : datetime.date
+        The day loaded.
+
+    Returns
+    -------
+    str
+        The name of the staging table.
+    """
+    staging_table = f"{partition_name(table_name, day)}_staging"
+
+    # A staging table left behind by a failed run is discarded
+    connection.execute(text(f"DROP TABLE IF EXISTS {schema}.{staging_table}"))
+    connection.execute(text(f"""
+    CREATE TABLE {schema}.{staging_table} (
+        LIKE {schema}.{table_name} INCLUDING DEFAULTS INCLUDING INDEXES,
+        CONSTRAINT {staging_table}_day CHECK ({date_column} >= DATE '{day}' AND {date_column} < DATE '{day + timedelta(days=1)}')
+    )
+    """))
+    connection.execute(text(f"ALTER TABLE {schema}.{staging_table} ALTER COLUMN {date_column} SET NOT NULL"))
+
+    return staging_table
+
+
+def swap_partition(connection, schema, table_name, staging_table, day):
+    """
+    Makes a loaded staging table the partition of its day, replacing the partition loaded by a previous run.
+
+    The swap only changes the catalog (detach, drop, rename, attach), so it is instant whatever the size of the day,
+    and neither deletes rows nor leaves dead rows behind. Run it in one transaction, so that readers see either
+    the previous partition or the new one.
+    """
+    partition = partition_name(table_name, day)
+
+    if connection.execute(text("SELECT to_regclass(:partition) IS NOT NULL"), {'partition': f'{schema}.{partition}'}).scalar():
+        connection.execute(text(f"ALTER TABLE {schema}.{table_name} DETACH PARTITION {schema}.{partition}"))
+        connection.execute(text(f"DROP TABLE {schema}.{partition}"))
+
+    connection.execute(text(f"ALTER TABLE {schema}.{staging_table} RENAME TO {partition}"))
+    connection.execute(text(f"""
+    ALTER TABLE {schema}.{table_name} ATTACH PARTITION {schema}.{partition}
+    FOR VALUES FROM ('{day}') TO ('{day + timedelta(days=1)}')
+    """))
+
+
+def load_snapshot(query, stream_conn, engine, table_name, schema, columns, date_column, snapshot_date, mode=LOAD_MODE):
+    """
+    Replaces yesterday's snapshot in a daily fact table.
+
+    Partitioned fact tables (see 0_partition_daily_balance_tables.sql) are loaded into a staging table, which is then
+    swapped in as the day's partition (see swap_partition): a rerun replaces the day instantly, and the other days are
+    never read or rewritten. Other tables have the rows already loaded for the day deleted before they are loaded again.
+
+    Parameters
+    ----------
+    query, stream_conn, engine, table_name, schema, columns, date_column, snapshot_date :
+        As in stream_snapshot.
+    mode : str, optional
+        One of LOAD_MODES. Defaults to LOAD_MODE, set by the BALANCE_LOAD_MODE environment variable.
+        - 'in_database': the rows are written by a single INSERT ... SELECT (see insert_snapshot), in the same
+          transaction as the delete or the partition swap, so the day is replaced atomically and nothing is
+          transferred to Python.
+        - 'stream': the rows are streamed through Python (see stream_snapshot). The delete is committed first;
+          the partition swap happens once every chunk is loaded.
+
+    Returns
+    -------
+    int
+        The number of rows written.
+    """
+    if mode not in LOAD_MODES:
+        raise ValueError(f"Unknown load mode {mode!r}, expected one of {LOAD_MODES}")
+
+    with engine.begin() as connection:
+        # The in-database mode stamps the day in SQL, so the partition bounds must use the same day
+        day = (connection.execute(text("SELECT CURRENT_DATE - 1")).scalar() if mode == 'in_database'
+               else date.fromisoformat(str(snapshot_date)))
+
+        partitioned = is_partitioned(connection, schema, table_name)
+
+        if partitioned:
+            staging_table = create_staging_partition(connection, schema, table_name, date_column, day)
+            if mode == 'in_database':
+                row_count = insert_snapshot(connection, query, staging_table, schema, columns, date_column)
+                swap_partition(connection, schema, table_name, staging_table, day)
+                return row_count
+
+        else:
+            # Rows already loaded for the day are deleted first, so that a rerun does not duplicate them.
+            # The date column is compared to a range rather than wrapped in DATE(), so that an index on it can be used.
+            if connection.execute(text("SELECT to_regclass(:table_name) IS NOT NULL"),
+                                  {'table_name': f'{schema}.{table_name}'}).scalar():
+                connection.execute(text(f"""
+                DELETE FROM {schema}.{table_name}
+                WHERE {date_column} >= DATE '{day}' AND {date_column} < DATE '{day + timedelta(days=1)}'
+                """))
+
+            if mode == 'in_database':
+                return insert_snapshot(connection, query, table_name, schema, columns, date_column)
+
+    if not partitioned:
+        return stream_snapshot(query, stream_conn, engine, table_name, schema, columns, date_column, snapshot_date)
+
+    row_count = stream_snapshot(query, stream_conn, engine, staging_table, schema, columns, date_column, snapshot_date)
+    with engine.begin() as connection:
+        swap_partition(connection, schema, table_name, staging_table, day)
+
+    return row_count
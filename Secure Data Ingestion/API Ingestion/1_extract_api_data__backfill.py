@@ -1,18 +1,14 @@
-import requests
-import hashlib
 import time
+import json
+import argparse
 import logging
 from logging.handlers import RotatingFileHandler
-import smtplib
-from email.message import EmailMessage
 from datetime import datetime, timedelta
-from Crypto.Cipher import AES
-from Crypto.Util.Padding import unpad
-import base64
-import psycopg2
-from psycopg2.extras import execute_values
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import os
 from dotenv import load_dotenv
+from ingestion_connections import DB_POOL_MAX_CONNECTIONS
+from api_engine import ApiIngestionEngine, endpoint_config
 
 # Load environment variables
 load_dotenv()
@@ -36,104 +32,137 @@ DB_CONFIG = {
 
 SCHEMA = os.getenv('DB_SCHEMA')
 
-def generate_hash(api_key, secret_key, timestamp):
-    """Generate authentication hash using API credentials and timestamp"""
-    message = f"{api_key}{secret_key}{timestamp}"
-    return hashlib.sha256(message.encode()).hexdigest()
+# Number of records requested per page. Each page is decrypted and written before the next one is fetched.
+PAGE_SIZE = int(os.getenv('API_PAGE_SIZE', 1000))
 
-def decrypt_field(encrypted_value):
-    """Decrypt AES-encrypted field values from the API response"""
-    try:
-        encrypted_data = base64.b64decode(encrypted_value)
-        cipher = AES.new(ENCRYPTION_KEY, AES.MODE_CBC, IV)
-        decrypted_data = unpad(cipher.decrypt(encrypted_data), AES.block_size)
-        return decrypted_data.decode('utf-8')
-    except Exception as e:
-        logging.error(f"Decryption failed for value: {encrypted_value}. Error: {str(e)}")
-        return encrypted_value
+# Backfill settings, each of which can be overridden on the command line (see main)
+BACKFILL_PERIODS = [1, 2, 4]
+BACKFILL_WORKERS = int(os.getenv('BACKFILL_WORKERS', 4))
+BACKFILL_RETRIES = int(os.getenv('BACKFILL_RETRIES', 3))
+BACKFILL_CHECKPOINT_FILE = os.getenv('BACKFILL_CHECKPOINT_FILE', 'backfill_checkpoint.json')
 
-def make_api_request(endpoint, params=None):
-    """Make authenticated API request and decrypt response data"""
-    timestamp = str(int(time.time()))
-    hash_key = generate_hash(API_KEY, SECRET_KEY, timestamp)
+ENGINE = ApiIngestionEngine(API_KEY, SECRET_KEY, ENCRYPTION_KEY, IV, DB_CONFIG, SCHEMA, page_size=PAGE_SIZE)
 
-    headers = {
-        "api-key": API_KEY,
-        "hash-key": hash_key,
-        "request-ts": timestamp
-    }
+def period_endpoint(period_id):
+    """Describe the metrics endpoint of one period (see api_engine.py)
 
-    try:
-        response = requests.get(endpoint, headers=headers, params=params)
-        response.raise_for_status()
-
-        encrypted_data = response.json()
-        decrypted_data = encrypted_data.copy()
-
-        if 'data' in decrypted_data and isinstance(decrypted_data['data'], list):
-            for item in decrypted_data['data']:
-                for key, value in item.items():
-                    if isinstance(value, str):
-                        item[key] = decrypt_field(value)
-            return decrypted_data
-        return None
-
-    except requests.RequestException as e:
-        logging.error(f"API request failed: {str(e)}")
-        return None
-
-def create_table_if_not_exists(cur, schema_name, table_name, data):
-    """Create PostgreSQL table with appropriate schema if it doesn't exist"""
-    columns = data[0].keys()
-    column_defs = [f"{col} TEXT" for col in columns]
-    column_defs.append("UNIQUE (project_id, metric_period)")
-    
-    create_table_query = f"""
-    CREATE TABLE IF NOT EXISTS {schema_name}.{table_name} (
-        {', '.join(column_defs)}
-    )
+    Pages are upserted and committed one at a time, so a failed attempt keeps the pages already written.
+    row_hash is kept up to date, as the incremental updates rely on it to skip unchanged rows.
+    The endpoint is strict: a period with no data comes back as an empty page, so a failed request
+    must not be checkpointed as an empty period.
+    """
+    return endpoint_config(name=f"project_metrics period {period_id}", url=f"{DATA_ENDPOINT}&period_id={period_id}",
+                           table='project_metrics', constraints=["UNIQUE (project_id, metric_period)"],
+                           conflict_columns=['project_id', 'metric_period'], refresh_mode='upsert',
+                           track_changes=True, strict=True)
+
+def load_checkpoint(checkpoint_file):
+    """Return the set of periods already loaded by previous runs of the backfill"""
+    if not os.path.exists(checkpoint_file):
+        return set()
+
+    with open(checkpoint_file) as f:
+        return set(json.load(f)['completed_periods'])
+
+def save_checkpoint(checkpoint_file, completed_periods):
+    """Record the periods loaded so far, writing to a temporary file first so a crash never leaves a truncated checkpoint"""
+    temporary_file = f"{checkpoint_file}.tmp"
+    with open(temporary_file, 'w') as f:
+        json.dump({'completed_periods': sorted(completed_periods), 'updated_at': datetime.now().isoformat(timespec='seconds')}, f, indent=2)
+    os.replace(temporary_file, checkpoint_file)
+
+def backfill_period(period_id, retries=BACKFILL_RETRIES, retry_delay=5):
+    """Fetch and upsert the metrics of one period, retrying with exponential backoff if it fails
+
+    Pages are upserted, so a retry simply writes again the pages a failed attempt had already committed.
+    Returns the result of the load (see ApiIngestionEngine.load_endpoint), or None if every attempt failed.
     """
-    cur.execute(create_table_query)
+    endpoint = period_endpoint(period_id)
 
-def insert_data_to_db(schema_name, table_name, data):
-    """Insert or update decrypted data into PostgreSQL with conflict handling"""
-    data = data.get('data', [])
-    if not data:
-        return "No data to insert."
+    for attempt in range(1, retries + 2):
+        result = ENGINE.load_endpoint(endpoint)
 
+        if result is not None:
+            if result == "No data to insert.":
+                print(f"No metrics available for period {period_id}")
+            else:
+                print(f"Period {period_id} loaded")
+            return result
+
+        if attempt <= retries:
+            logging.error(f"Backfill of period {period_id} failed (attempt {attempt} of {retries + 1}), retrying")
+            time.sleep(retry_delay * 2 ** (attempt - 1))
+
+    logging.error(f"Backfill of period {period_id} failed after {retries + 1} attempts")
+    return None
+
+def parse_arguments(argv=None):
+    """Read the periods to backfill and the backfill settings from the command line"""
+    parser = argparse.ArgumentParser(description="Backfill historical project metrics, several periods at a time.")
+    periods = parser.add_mutually_exclusive_group()
+    periods.add_argument('--periods', type=int, nargs='+', default=BACKFILL_PERIODS,
+                         help="Periods to load, e.g. --periods 1 2 4 (default: %(default)s).")
+    periods.add_argument('--period-range', type=int, nargs=2, metavar=('FIRST', 'LAST'),
+                         help="Load every period from FIRST to LAST inclusive, e.g. --period-range 1 24.")
+    parser.add_argument('--workers', type=int, default=BACKFILL_WORKERS,
+                        help="Number of periods loaded at the same time (default: %(default)s).")
+    parser.add_argument('--retries', type=int, default=BACKFILL_RETRIES,
+                        help="Retries per period before it is given up for this run (default: %(default)s).")
+    parser.add_argument('--checkpoint-file', default=BACKFILL_CHECKPOINT_FILE,
+                        help="File recording the periods already loaded (default: %(default)s).")
+    parser.add_argument('--restart', action='store_true',
+                        help="Ignore the checkpoint and load every period again.")
+    arguments = parser.parse_args(argv)
+
+    if arguments.period_range:
+        first, last = arguments.period_range
+        arguments.periods = list(range(first, last + 1))
+
+    return arguments
+
+def main(argv=None):
+    """Process historical project metrics data for initial database population
+
+    Periods are loaded concurrently, up to --workers at a time, so a reload over many periods takes about as long as
+    its slowest period rather than the sum of all of them. Each completed period is recorded in the checkpoint file,
+    so an interrupted or partly failed backfill can be re-run and only loads the periods still missing.
+    """
     try:
-        with psycopg2.connect(**DB_CONFIG) as conn:
-            with conn.cursor() as cur:
-                create_table_if_not_exists(cur, schema_name, table_name, data)
-                    
-                columns = data[0].keys()
-                query = f"""
-                INSERT INTO {schema_name}.{table_name} ({','.join(columns)})
-                VALUES %s 
-                ON CONFLICT (project_id, metric_period) DO UPDATE 
-                SET {', '.join(f"{col} = EXCLUDED.{col}" for col in columns if col not in ['project_id', 'metric_period'])}
-                """  
-
-                values = [[row[col] for col in columns] for row in data]
-                execute_values(cur, query, values)
-            conn.commit()
-            return "Data insertion successful."
+        arguments = parse_arguments(argv)
 
-    except Exception as e:
-        logging.error(f"Database insertion failed: {str(e)}")
+        completed_periods = set() if arguments.restart else load_checkpoint(arguments.checkpoint_file)
+        pending_periods = [period_id for period_id in dict.fromkeys(arguments.periods) if period_id not in completed_periods]
 
-def main():
-    """Process historical project metrics data for initial database population"""
-    try:
-        print("Fetching historical project metrics...")
-        for period_id in [1, 2, 4]:
-            HISTORICAL_DATA_ENDPOINT = f"{DATA_ENDPOINT}&period_id={period_id}"
-            historical_data = make_api_request(HISTORICAL_DATA_ENDPOINT)
-            
-            if historical_data:
-                insert_data_to_db(SCHEMA, 'project_metrics', historical_data)
-            else:
-                print("No metrics available for the specified period")
+        if not pending_periods:
+            print("Every requested period is already loaded (see the checkpoint file, or use --restart)")
+            return
+
+        # Each period holds a pooled database connection while it loads, and the pool does not wait for a free connection
+        workers = max(1, min(arguments.workers, DB_POOL_MAX_CONNECTIONS, len(pending_periods)))
+        failed_periods = []
+
+        print(f"Fetching historical project metrics for {len(pending_periods)} periods, {workers} at a time...")
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(backfill_period, period_id, arguments.retries): period_id for period_id in pending_periods}
+
+            for future in as_completed(futures):
+                period_id = futures[future]
+
+                if future.result() is None:
+                    failed_periods.append(period_id)
+                    continue
+
+                # Only this thread writes the checkpoint, as each period completes
+                completed_periods.add(period_id)
+                save_checkpoint(arguments.checkpoint_file, completed_periods)
+
+        if failed_periods:
+            error_msg = f"Backfill incomplete, periods failed: {sorted(failed_periods)}. Re-run the script to retry them."
+            logging.error(error_msg)
+            print(error_msg)
+            return error_msg
+
+        print("Backfill complete")
 
     except Exception as e:
         error_msg = f"Script execution failed: {str(e)}"
@@ -0,0 +1,223 @@
+import os
+import time
+import queue
+import atexit
+import logging
+import smtplib
+import threading
+from collections import deque
+from datetime import datetime
+from email.message import EmailMessage
+
+# Non-blocking alert emails for the API Ingestion scripts.
+# Failures are handed to a background thread instead of being emailed inline, so the pipeline never waits on SMTP.
+# The thread keeps one SMTP connection open between emails, sends the first alert of a kind straight away,
+# folds repeats of it into a periodic digest, and caps the number of emails sent per hour.
+
+# Dispatcher settings. Each can be overridden from the .env file.
+ALERT_DIGEST_INTERVAL = float(os.getenv('ALERT_DIGEST_INTERVAL', 300))
+ALERT_MAX_EMAILS_PER_HOUR = int(os.getenv('ALERT_MAX_EMAILS_PER_HOUR', 20))
+ALERT_QUEUE_SIZE = int(os.getenv('ALERT_QUEUE_SIZE', 10000))
+SMTP_IDLE_TIMEOUT = float(os.getenv('SMTP_IDLE_TIMEOUT', 60))
+
+# Number of example messages kept per kind of alert in a digest
+DIGEST_EXAMPLES = 3
+
+_STOP = object()
+
+class AlertDispatcher:
+    """
+    Sends alert emails from a background thread, with de-duplication, digests and rate limiting.
+
+    - send() only puts the alert on a queue, so the caller never blocks on SMTP (a full queue drops the alert and counts it).
+    - The first alert with a given subject is emailed immediately. Further alerts with the same subject within
+      digest_interval seconds are aggregated, and a single digest listing every aggregated subject, its count and
+      a few example messages is sent at the end of the interval.
+    - At most max_emails_per_hour emails are sent. Beyond that, alerts wait in the next digest instead.
+    - One SMTP connection (with STARTTLS and login) is opened on the first email and reused for the next ones.
+      It is closed after SMTP_IDLE_TIMEOUT seconds without email, and reopened when the server drops it.
+
+    Parameters:
+    - email_config (dict): smtp_server, smtp_port, sender_email, sender_password and recipient_email,
+      as EMAIL_CONFIG in the scripts. An optional use_tls (default True) switches STARTTLS off, e.g. for a local SMTP stub.
+      Login is skipped when there is no sender_password.
+    - digest_interval (float): Seconds over which repeated alerts are aggregated. Defaults to ALERT_DIGEST_INTERVAL.
+    - max_emails_per_hour (int): Cap on the emails sent per rolling hour. Defaults to ALERT_MAX_EMAILS_PER_HOUR.
+
+    Usage:
+        alerts = AlertDispatcher(EMAIL_CONFIG)
+        alerts.send("Database Insertion Failed", error_msg)
+
+    Notes:
+    - Pending alerts and digests are flushed when the process exits (atexit) or when close() is called.
+    - Send failures are logged, never raised to the caller.
+
+    """
+    def __init__(self, email_config, digest_interval=ALERT_DIGEST_INTERVAL, max_emails_per_hour=ALERT_MAX_EMAILS_PER_HOUR):
+        self.email_config = email_config
+        self.digest_interval = digest_interval
+        self.max_emails_per_hour = max_emails_per_hour
+        self.dropped_alerts = 0
+
+        self._queue = queue.Queue(maxsize=ALERT_QUEUE_SIZE)
+        self._pending = {}
+        self._last_sent = {}
+        self._sent_times = deque()
+        self._smtp = None
+        self._smtp_last_used = 0.0
+        self._thread = None
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def send(self, subject, body):
+        """ Queues an alert. Returns immediately. """
+        if self._closed:
+            return
+
+        self._start()
+        try:
+            self._queue.put_nowait((subject, body, datetime.now()))
+        except queue.Full:
+            self.dropped_alerts += 1
+
+    def close(self, timeout=30):
+        """ Sends the alerts still pending (including the digest) and closes the SMTP connection. """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+
+        if self._thread is not None:
+            self._queue.put(_STOP)
+            self._thread.join(timeout)
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='alert-dispatcher', daemon=True)
+                self._thread.start()
+                atexit.register(self.close)
+
+    def _run(self):
+        next_digest = time.monotonic() + self.digest_interval
+
+        while True:
+            try:
+                item = self._queue.get(timeout=max(0.0, min(next_digest - time.monotonic(), SMTP_IDLE_TIMEOUT)))
+            except queue.Empty:
+                item = None
+
+            if item is _STOP:
+                break
+            if item is not None:
+                self._handle(*item)
+
+            if time.monotonic() >= next_digest:
+                self._send_digest()
+                next_digest = time.monotonic() + self.digest_interval
+
+            if self._smtp is not None and time.monotonic() - self._smtp_last_used > SMTP_IDLE_TIMEOUT:
+                self._disconnect()
+
+        # Drain what was queued before close(), then flush the digest
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not _STOP:
+                self._handle(*item)
+
+        self._send_digest(force=True)
+        self._disconnect()
+
+    def _handle(self, subject, body, received_at):
+        """ Emails an alert straight away, unless an alert with the same subject was sent recently or the hourly cap is reached. """
+        last_sent = self._last_sent.get(subject)
+        recently_sent = last_sent is not None and time.monotonic() - last_sent < self.digest_interval
+
+        if not recently_sent and subject not in self._pending and self._can_send():
+            if self._send_email(subject, body):
+                self._last_sent[subject] = time.monotonic()
+                return
+
+        pending = self._pending.setdefault(subject, {'count': 0, 'first_seen': received_at, 'examples': []})
+        pending['count'] += 1
+        pending['last_seen'] = received_at
+        if len(pending['examples']) < DIGEST_EXAMPLES:
+            pending['examples'].append(body)
+
+    def _send_digest(self, force=False):
+        """ Sends one email summarising every aggregated alert. """
+        if not self._pending or (not force and not self._can_send()):
+            return
+
+        total = sum(pending['count'] for pending in self._pending.values())
+        sections = []
+        for subject, pending in self._pending.items():
+            sections.append(f"{subject}: {pending['count']} occurrence(s) between "
+                            f"{pending['first_seen']:%Y-%m-%d %H:%M:%S} and {pending['last_seen']:%Y-%m-%d %H:%M:%S}\n"
+                            + "\n".join(f"  - {example}" for example in pending['examples']))
+
+        if self.dropped_alerts:
+            sections.append(f"{self.dropped_alerts} alert(s) were dropped because the alert queue was full.")
+
+        subject = f"Ingestion alert digest: {total} alert(s), {len(self._pending)} kind(s)"
+        if self._send_email(subject, "\n\n".join(sections)):
+            now = time.monotonic()
+            for pending_subject in self._pending:
+                self._last_sent[pending_subject] = now
+            self._pending.clear()
+            self.dropped_alerts = 0
+
+    def _can_send(self):
+        """ Applies the hourly cap over a rolling window. """
+        now = time.monotonic()
+        while self._sent_times and now - self._sent_times[0] > 3600:
+            self._sent_times.popleft()
+        return len(self._sent_times) < self.max_emails_per_hour
+
+    def _send_email(self, subject, body):
+        """ Sends one email over the shared connection, reconnecting once if the server dropped it. Returns True if sent. """
+        msg = EmailMessage()
+        msg.set_content(body)
+        msg['Subject'] = subject
+        msg['From'] = self.email_config['sender_email']
+        msg['To'] = self.email_config['recipient_email']
+
+        for attempt in range(2):
+            try:
+                if self._smtp is None:
+                    self._connect()
+                self._smtp.send_message(msg)
+
+                self._smtp_last_used = time.monotonic()
+                self._sent_times.append(self._smtp_last_used)
+                logging.error("Error email sent successfully")
+                return True
+
+            except smtplib.SMTPServerDisconnected:
+                self._smtp = None
+                if attempt:
+                    logging.error("Failed to send error email: the SMTP server closed the connection")
+            except Exception as e:
+                self._disconnect()
+                logging.error(f"Failed to send error email: {str(e)}")
+                return False
+
+        return False
+
+    def _connect(self):
+        self._smtp = smtplib.SMTP(self.email_config['smtp_server'], self.email_config['smtp_port'], timeout=30)
+        if self.email_config.get('use_tls', True):
+            self._smtp.starttls()
+        if self.email_config.get('sender_password'):
+            self._smtp.login(self.email_config['sender_email'], self.email_config['sender_password'])
+
+    def _disconnect(self):
+        if self._smtp is not None:
+            try:
+                self._smtp.quit()
+            except Exception:
+                pass
+            self._smtp = None
@@ -0,0 +1,265 @@
+import os
+import time
+import hashlib
+import logging
+import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from ingestion_connections import pooled_connection, DB_POOL_MAX_CONNECTIONS
+from field_decryption import decrypt_rows
+from http_client import http_get
+from bulk_upsert import copy_upsert, create_key_table, delete_missing_rows, ROW_HASH_COLUMN
+from schema_inference import ensure_table_schema, prepare_rows
+
+# Declarative API ingestion engine shared by the API Ingestion scripts.
+# The scripts used to repeat the authentication, request, decryption and load logic, with the differences between
+# tables hard-coded as branches on the table name. Here each endpoint is described by a dictionary (see ENDPOINT_DEFAULTS)
+# and one engine fetches, decrypts and loads any of them. Several endpoints can be loaded at the same time in one process:
+# they share the database connection pool, the HTTP connections of each worker thread and the decryption processes.
+
+# Number of records requested per page. Each page is decrypted and written before the next one is fetched.
+PAGE_SIZE = int(os.getenv('API_PAGE_SIZE', 1000))
+
+# Number of endpoints loaded at the same time by run()
+API_ENGINE_WORKERS = int(os.getenv('API_ENGINE_WORKERS', 4))
+
+# How the rows of an endpoint are written to its table:
+# - 'upsert': rows are inserted or update the row with the same key, and committed after every page.
+# - 'diff': like upsert, but in one transaction, and the rows whose key is missing from the complete response are deleted.
+# - 'full_refresh': the table is truncated and reloaded in one transaction, so it is never seen half loaded.
+REFRESH_MODES = ('upsert', 'diff', 'full_refresh')
+
+# Settings of an endpoint, and their defaults. Only 'name', 'url' and 'table' are required.
+ENDPOINT_DEFAULTS = {
+    "name": None,                 # Name used in the messages, e.g. 'team_composition'
+    "url": None,                  # URL of the endpoint
+    "table": None,                # Table the rows are written to
+    "params": None,               # Query parameters sent with every request
+    "constraints": (),            # Table constraints used when the table is created, e.g. "PRIMARY KEY (team_member_id)"
+    "conflict_columns": None,     # Unique key of the table. Required by 'upsert' with a key and by 'diff'.
+    "refresh_mode": 'upsert',     # One of REFRESH_MODES
+    "track_changes": False,       # Store a content hash (row_hash) and skip the rows that did not change
+    "paginated": True,            # Request the endpoint page by page; otherwise in a single request
+    "page_size": None,            # Records per page. Defaults to the engine's page size.
+    "strict": False,              # Raise if the first page cannot be fetched, instead of treating it as no data
+}
+
+def endpoint_config(**settings):
+    """
+    Returns the complete configuration of an endpoint: the given settings over ENDPOINT_DEFAULTS.
+
+    Raises:
+    - ValueError: If a setting is unknown, a required setting is missing or the refresh mode cannot work
+      with the other settings.
+
+    """
+    unknown = set(settings) - set(ENDPOINT_DEFAULTS)
+    if unknown:
+        raise ValueError(f"Unknown endpoint settings: {sorted(unknown)}")
+
+    endpoint = dict(ENDPOINT_DEFAULTS, **settings)
+
+    missing = [setting for setting in ('name', 'url', 'table') if not endpoint[setting]]
+    if missing:
+        raise ValueError(f"Endpoint {endpoint['name']} is missing {missing}")
+    if endpoint['refresh_mode'] not in REFRESH_MODES:
+        raise ValueError(f"Endpoint {endpoint['name']}: refresh_mode must be one of {REFRESH_MODES}")
+    if endpoint['refresh_mode'] == 'diff' and not endpoint['conflict_columns']:
+        raise ValueError(f"Endpoint {endpoint['name']}: the 'diff' refresh mode needs conflict_columns")
+
+    return endpoint
+
+class ApiIngestionEngine:
+    """
+    Fetches, decrypts and loads API endpoints into PostgreSQL, as described by endpoint configurations.
+
+    Required:
+    - The Secure Data Ingestion folder on the PYTHONPATH (for ingestion_connections).
+
+    Parameters:
+    - api_key (str), secret_key (str): The API credentials, used to sign each request.
+    - encryption_key (bytes), iv (bytes): The AES key and IV of the encrypted fields.
+    - db_config (dict): The connection settings, as DB_CONFIG in the scripts.
+    - schema_name (str): The schema of the tables.
+    - alerts (AlertDispatcher, optional): Failures are emailed through it, in addition to being logged.
+    - page_size (int): Records per page, unless set on the endpoint. Defaults to PAGE_SIZE.
+
+    Usage:
+        engine = ApiIngestionEngine(API_KEY, SECRET_KEY, ENCRYPTION_KEY, IV, DB_CONFIG, SCHEMA, alerts=ALERTS)
+        results = engine.run([endpoint_config(name='metrics', url=METRICS_ENDPOINT, table='project_metrics',
+                                              conflict_columns=['project_id', 'metric_period'])])
+
+    Notes:
+    - Loading an endpoint returns "Data insertion successful.", "No data to insert.", or None when it failed
+      (the failure is logged and alerted, never raised).
+
+    """
+    def __init__(self, api_key, secret_key, encryption_key, iv, db_config, schema_name, alerts=None, page_size=PAGE_SIZE):
+        self.api_key = api_key
+        self.secret_key = secret_key
+        self.encryption_key = encryption_key
+        self.iv = iv
+        self.db_config = db_config
+        self.schema_name = schema_name
+        self.alerts = alerts
+        self.page_size = page_size
+
+    def _report(self, subject, error_msg):
+        logging.error(error_msg)
+        if self.alerts is not None:
+            self.alerts.send(subject, error_msg)
+
+    def generate_hash(self, timestamp):
+        """ Generates the authentication hash of a request from the API credentials and the timestamp. """
+        message = f"{self.api_key}{self.secret_key}{timestamp}"
+        return hashlib.sha256(message.encode()).hexdigest()
+
+    def sign_request(self):
+        """ Returns the authentication headers of a request sent now. """
+        timestamp = str(int(time.time()))
+
+        return {
+            "api-key": self.api_key,
+            "hash-key": self.generate_hash(timestamp),
+            "request-ts": timestamp
+        }
+
+    def make_api_request(self, url, params=None):
+        """ Makes an authenticated API request and returns the response with its records decrypted, or None if it failed. """
+        try:
+            # Signed per attempt, so that retries carry a fresh timestamp
+            response = http_get(url, sign=self.sign_request, params=params)
+            response.raise_for_status()
+
+            decrypted_data = response.json().copy()
+
+            if 'data' in decrypted_data and isinstance(decrypted_data['data'], list):
+                decrypt_rows(decrypted_data['data'], self.encryption_key, self.iv)
+                return decrypted_data
+
+            return None
+
+        except requests.RequestException as e:
+            self._report("API Request Failed", f"API request failed: {str(e)}")
+            return None
+
+    def fetch_pages(self, endpoint):
+        """
+        Yields the decrypted records of an endpoint one page at a time.
+
+        Only one page is held in memory at a time. The last page is recognised by being shorter than the page size
+        (or empty), so a dataset that is an exact multiple of the page size costs one extra, empty request.
+        A page that cannot be fetched after the first one raises an error, so that a partial dataset is never mistaken
+        for a complete one; so does the first page of a strict endpoint.
+        """
+        if not endpoint['paginated']:
+            response = self.make_api_request(endpoint['url'], params=endpoint['params'])
+            if response is None and endpoint['strict']:
+                raise RuntimeError(f"{endpoint['url']} could not be fetched")
+            if response is not None and response['data']:
+                yield response['data']
+            return
+
+        page_size = endpoint['page_size'] or self.page_size
+        page_number = 1
+
+        while True:
+            page = self.make_api_request(endpoint['url'], params=dict(endpoint['params'] or {}, page=page_number, page_size=page_size))
+
+            if page is None:
+                if page_number == 1 and not endpoint['strict']:
+                    return
+                raise RuntimeError(f"Page {page_number} of {endpoint['url']} could not be fetched")
+
+            if page['data']:
+                yield page['data']
+
+            if len(page['data']) < page_size:
+                return
+
+            page_number += 1
+
+    def load_endpoint(self, endpoint):
+        """
+        Fetches an endpoint and writes its records to its table, page by page, as set by its refresh mode.
+
+        The table is created, or evolved, with column types inferred from the data (see ensure_table_schema).
+        With track_changes, each row carries a hash of its content and existing rows are only rewritten when it changed.
+
+        Returns:
+        - str: "Data insertion successful." or "No data to insert.", or None if the load failed.
+
+        """
+        table_name = endpoint['table']
+        refresh_mode = endpoint['refresh_mode']
+        conflict_columns = endpoint['conflict_columns']
+        hash_column = ROW_HASH_COLUMN if endpoint['track_changes'] else None
+        extra_columns = {ROW_HASH_COLUMN: 'TEXT'} if hash_column else None
+
+        rows_received = 0
+        rows_written = 0
+        rows_deleted = 0
+        key_table = None
+        column_types = None
+
+        try:
+            with pooled_connection(self.db_config) as conn:
+                with conn.cursor() as cur:
+                    for data in self.fetch_pages(endpoint):
+                        # Adds the new fields of the page as columns, and widens columns whose new values do not fit their type
+                        column_types = ensure_table_schema(cur, self.schema_name, table_name, data,
+                                                           constraints=endpoint['constraints'],
+                                                           extra_columns=extra_columns, column_types=column_types)
+                        data = prepare_rows(data, column_types)
+
+                        if rows_received == 0:
+                            if refresh_mode == 'full_refresh':
+                                cur.execute(f"TRUNCATE TABLE {self.schema_name}.{table_name}")
+                            elif refresh_mode == 'diff':
+                                key_table = create_key_table(cur, self.schema_name, table_name, conflict_columns)
+
+                        # COPY the page into a staging table, then apply it to the table in one statement
+                        rows_written += copy_upsert(cur, self.schema_name, table_name, data, conflict_columns=conflict_columns,
+                                                    hash_column=hash_column, key_table=key_table)
+                        rows_received += len(data)
+
+                        if refresh_mode == 'upsert':
+                            conn.commit()
+
+                    # Only reached once every page was received, so a failed fetch never deletes rows
+                    if key_table:
+                        rows_deleted = delete_missing_rows(cur, self.schema_name, table_name, key_table, conflict_columns)
+
+                conn.commit()
+
+            if not rows_received:
+                print(f"{endpoint['name']}: no data to insert.")
+                return "No data to insert."
+
+            print(f"{endpoint['name']}: {rows_received} rows received, {rows_written} rows written, {rows_deleted} rows deleted.")
+            return "Data insertion successful."
+
+        except Exception as e:
+            self._report("Database Insertion Failed", f"Database insertion failed for {endpoint['name']}: {str(e)}")
+            return None
+
+    def run(self, endpoints, workers=API_ENGINE_WORKERS):
+        """
+        Loads several endpoints at the same time.
+
+        Parameters:
+        - endpoints (list of dict): The endpoint configurations (see endpoint_config).
+        - workers (int): Number of endpoints loaded at the same time. Defaults to API_ENGINE_WORKERS.
+          Capped at DB_POOL_MAX_CONNECTIONS, as each load holds a pooled connection and the pool does not wait for a free one.
+
+        Returns:
+        - dict: The result of load_endpoint for each endpoint, by name.
+
+        """
+        if not endpoints:
+            return {}
+
+        workers = max(1, min(workers, DB_POOL_MAX_CONNECTIONS, len(endpoints)))
+
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='api-endpoint') as executor:
+            futures = {executor.submit(self.load_endpoint, endpoint): endpoint['name'] for endpoint in endpoints}
+            return {futures[future]: future.result() for future in as_completed(futures)}
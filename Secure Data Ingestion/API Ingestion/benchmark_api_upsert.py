@@ -0,0 +1,151 @@
+import os
+import json
+import time
+import random
+import argparse
+import statistics
+from datetime import datetime
+from psycopg2.extras import execute_values
+from dotenv import load_dotenv
+from ingestion_connections import pooled_connection
+from bulk_upsert import copy_upsert
+
+# Benchmark of the two ways of writing API pages to PostgreSQL:
+# - execute_values: the rows are sent as the parameters of an INSERT ... ON CONFLICT (the previous path),
+# - copy: the rows are streamed with COPY into a staging table, then upserted in one statement (copy_upsert).
+#
+# Both are timed on a synthetic, project_metrics-like dataset, first inserting into an empty table, then upserting
+# the same keys again with changed values (every row conflicts). Each scenario is repeated and the median is kept.
+# Every run is saved as a JSON file in the results directory.
+#
+# Usage (from the API Ingestion folder, with the Secure Data Ingestion folder on the PYTHONPATH and DB_* set to a local PostgreSQL):
+#   python benchmark_api_upsert.py --rows 200000 --page-size 1000
+
+load_dotenv()
+
+DB_CONFIG = {
+    "dbname": os.getenv('DB_NAME'),
+    "user": os.getenv('DB_USER'),
+    "password": os.getenv('DB_PASSWORD'),
+    "host": os.getenv('DB_HOST'),
+    "port": os.getenv('DB_PORT')
+}
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'benchmark_results')
+
+CONFLICT_COLUMNS = ['project_id', 'metric_period']
+
+def generate_rows(row_count, seed, revision=0):
+    """ Generates project_metrics-like rows, all TEXT as they come out of the API. `revision` changes the values, not the keys. """
+    generator = random.Random(seed + revision)
+    statuses = ['on_track', 'at_risk', 'delayed', 'completed']
+
+    return [{'project_id': str(index // 12),
+             'metric_period': f"2024-{index % 12 + 1:02d}",
+             'project_name': f"Project {index // 12}",
+             'status': generator.choice(statuses),
+             'budget': f"{generator.uniform(1e4, 1e6):.2f}",
+             'spend': f"{generator.uniform(1e3, 1e6):.2f}",
+             'completion_rate': f"{generator.random():.4f}",
+             'team_size': str(generator.randint(2, 40)),
+             'owner_email': f"owner{generator.randint(1, 500)}@example.com",
+             'notes': generator.choice(['', 'Scope change\tapproved', 'Line one\nline two', 'Path C:\\reports']),
+             'updated_at': datetime(2024, index % 12 + 1, 1, 12).isoformat()}
+            for index in range(row_count)]
+
+def reset_table(conn, schema_name, table_name, columns):
+    """ Drops and recreates the benchmark table with the same shape as project_metrics (TEXT columns, unique key). """
+    with conn.cursor() as cur:
+        cur.execute(f"CREATE SCHEMA IF NOT EXISTS {schema_name}")
+        cur.execute(f"DROP TABLE IF EXISTS {schema_name}.{table_name}")
+        cur.execute(f"""
+        CREATE TABLE {schema_name}.{table_name} (
+            {', '.join(f'{col} TEXT' for col in columns)},
+            UNIQUE ({', '.join(CONFLICT_COLUMNS)})
+        )
+        """)
+    conn.commit()
+
+def load_with_execute_values(conn, schema_name, table_name, pages):
+    """ The previous path: one INSERT ... VALUES ... ON CONFLICT per page through execute_values, committed per page. """
+    with conn.cursor() as cur:
+        for data in pages:
+            columns = data[0].keys()
+            query = f"""
+            INSERT INTO {schema_name}.{table_name} ({','.join(columns)})
+            VALUES %s
+            ON CONFLICT ({', '.join(CONFLICT_COLUMNS)}) DO UPDATE
+            SET {', '.join(f"{col} = EXCLUDED.{col}" for col in columns if col not in CONFLICT_COLUMNS)}
+            """
+            execute_values(cur, query, [[row[col] for col in columns] for row in data])
+            conn.commit()
+
+def load_with_copy(conn, schema_name, table_name, pages):
+    """ The COPY path: each page goes through a staging table and a single set-based upsert, committed per page. """
+    with conn.cursor() as cur:
+        for data in pages:
+            copy_upsert(cur, schema_name, table_name, data, conflict_columns=CONFLICT_COLUMNS)
+            conn.commit()
+
+def paginate(rows, page_size):
+    """ Splits rows into pages, as fetch_pages returns them. """
+    return [rows[start:start + page_size] for start in range(0, len(rows), page_size)]
+
+def time_load(conn, load, schema_name, table_name, rows, page_size, upsert):
+    """ Times one load of rows into a fresh table. With upsert, the table is first filled with an older revision of the same keys. """
+    reset_table(conn, schema_name, table_name, list(rows[0].keys()))
+
+    if upsert:
+        previous_revision = generate_rows(len(rows), seed=0, revision=-1)
+        load_with_copy(conn, schema_name, table_name, paginate(previous_revision, page_size))
+
+    started = time.perf_counter()
+    load(conn, schema_name, table_name, paginate(rows, page_size))
+    return time.perf_counter() - started
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare execute_values and COPY staging upserts on a local PostgreSQL.")
+    parser.add_argument('--schema', default='benchmark', help="Schema of the benchmark table.")
+    parser.add_argument('--table', default='project_metrics', help="Benchmark table (dropped before each load).")
+    parser.add_argument('--rows', type=int, default=100000, help="Number of rows loaded.")
+    parser.add_argument('--page-size', type=int, default=1000, help="Rows per page (and per commit).")
+    parser.add_argument('--repeats', type=int, default=3, help="Repetitions of each scenario; the median is reported.")
+    parser.add_argument('--seed', type=int, default=42, help="Seed of the data generator.")
+    parser.add_argument('--results-dir', default=RESULTS_DIR, help="Directory where the results are saved.")
+    arguments = parser.parse_args()
+
+    rows = generate_rows(arguments.rows, arguments.seed)
+    methods = {'execute_values': load_with_execute_values, 'copy': load_with_copy}
+    results = {'run_at': datetime.now().isoformat(timespec='seconds'), 'settings': vars(arguments), 'scenarios': {}}
+
+    with pooled_connection(DB_CONFIG) as conn:
+        for scenario, upsert in (('insert', False), ('upsert', True)):
+            results['scenarios'][scenario] = {}
+
+            for method, load in methods.items():
+                timings = [time_load(conn, load, arguments.schema, arguments.table, rows, arguments.page_size, upsert)
+                           for _ in range(arguments.repeats)]
+                median = statistics.median(timings)
+
+                results['scenarios'][scenario][method] = {'median_seconds': round(median, 3),
+                                                          'rows_per_second': round(arguments.rows / median),
+                                                          'timings': [round(timing, 3) for timing in timings]}
+                print(f"{scenario:<8}{method:<16}{median:>10.3f} s{arguments.rows / median:>14,.0f} rows/s")
+
+            speedup = (results['scenarios'][scenario]['execute_values']['median_seconds']
+                       / results['scenarios'][scenario]['copy']['median_seconds'])
+            results['scenarios'][scenario]['copy_speedup'] = round(speedup, 2)
+            print(f"{scenario:<8}{'copy speedup':<16}{speedup:>10.2f}x")
+
+        with conn.cursor() as cur:
+            cur.execute(f"DROP TABLE IF EXISTS {arguments.schema}.{arguments.table}")
+        conn.commit()
+
+    os.makedirs(arguments.results_dir, exist_ok=True)
+    result_path = os.path.join(arguments.results_dir, f"api_upsert_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    with open(result_path, 'w') as result_file:
+        json.dump(results, result_file, indent=2)
+    print(f"Results saved to: {result_path}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+import json
+from io import StringIO
+
+# Bulk loading for the API Ingestion scripts.
+# Instead of sending rows as parameters of an INSERT (execute_values), a page of rows is streamed with COPY into a
+# temporary staging table, then applied to the target table with a single set-based INSERT ... ON CONFLICT.
+# COPY is PostgreSQL's fastest load path, and the target table is only touched (and locked) by that one statement.
+
+# Column added to the staging table to remember the order of the rows, so that the last occurrence of a key wins
+ROW_ORDER_COLUMN = '_staging_row'
+
+# Column holding the content hash of each row, used to skip rows that did not change (see copy_upsert)
+ROW_HASH_COLUMN = 'row_hash'
+
+_COPY_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+
+def format_copy_value(value):
+    """
+    Formats a value for COPY's text format.
+
+    - None becomes \\N (NULL).
+    - Booleans become true / false.
+    - Dictionaries and lists are serialised as JSON, so they can land in TEXT or JSONB columns.
+    - Everything else is converted with str(). Backslashes, tabs and line breaks are escaped, as COPY uses them as delimiters.
+
+    """
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, (dict, list)):
+        value = json.dumps(value)
+
+    return str(value).translate(_COPY_ESCAPES)
+
+def create_staging_table(cur, schema_name, table_name, columns):
+    """
+    Creates the staging table of a load: a temporary table with the target's columns (and types) plus the row order.
+
+    A temporary table is used rather than an UNLOGGED one: like an unlogged table it writes no WAL, and it is also
+    private to the session and dropped at the end of the transaction, so concurrent loads (e.g. backfill workers)
+    never share or clash over a staging table, and nothing is left behind after a failure.
+
+    Returns:
+    - str: The name of the staging table.
+
+    """
+    staging_table = f"{table_name}_staging"
+
+    cur.execute(f"""
+    CREATE TEMPORARY TABLE {staging_table} ON COMMIT DROP AS
+    SELECT {', '.join(columns)}, 0::BIGINT AS {ROW_ORDER_COLUMN}
+    FROM {schema_name}.{table_name}
+    WITH NO DATA
+    """)
+
+    return staging_table
+
+def copy_rows(cur, staging_table, columns, rows):
+    """ Streams rows (a list of dictionaries) into the staging table with COPY, numbering them in order. """
+    buffer = StringIO()
+    for row_number, row in enumerate(rows):
+        buffer.write('\t'.join([format_copy_value(row[col]) for col in columns] + [str(row_number)]))
+        buffer.write('\n')
+    buffer.seek(0)
+
+    cur.copy_expert(f"COPY {staging_table} ({', '.join(columns)}, {ROW_ORDER_COLUMN}) FROM STDIN", buffer)
+
+def row_hash_expression(columns):
+    """
+    Returns the SQL expression computing the content hash of a row: the MD5 of its values.
+
+    The columns are sorted by name, so the hash does not depend on the order the API returns the fields in.
+    """
+    return f"md5(ROW({', '.join(sorted(columns))})::TEXT)"
+
+def create_key_table(cur, schema_name, table_name, key_columns):
+    """
+    Creates a temporary table recording the keys received during a load, for delete_missing_rows.
+    It is dropped at the end of the transaction, so the whole load must run in one transaction.
+
+    Returns:
+    - str: The name of the key table.
+
+    """
+    key_table = f"{table_name}_received_keys"
+    cur.execute(f"""
+    CREATE TEMPORARY TABLE {key_table} ON COMMIT DROP AS
+    SELECT {', '.join(key_columns)}
+    FROM {schema_name}.{table_name}
+    WITH NO DATA
+    """)
+    return key_table
+
+def delete_missing_rows(cur, schema_name, table_name, key_table, key_columns):
+    """
+    Deletes the rows of a table whose key was not received during the load (see create_key_table).
+    Only call it once every page has been loaded: keys missing from an incomplete load would be deleted too.
+
+    Returns:
+    - int: The number of rows deleted.
+
+    """
+    cur.execute(f"""
+    DELETE FROM {schema_name}.{table_name} AS target
+    WHERE NOT EXISTS (
+        SELECT 1 FROM {key_table} AS received
+        WHERE {' AND '.join(f'received.{col} = target.{col}' for col in key_columns)}
+    )
+    """)
+    return cur.rowcount
+
+def copy_upsert(cur, schema_name, table_name, rows, conflict_columns=None, hash_column=None, key_table=None):
+    """
+    Writes rows to a table through a COPY-loaded staging table, in one set-based statement.
+
+    Required:
+    - from io import StringIO
+    - The target table must exist (see create_table_if_not_exists), as the staging table copies its column types.
+
+    Parameters:
+    - cur (psycopg2.extensions.cursor): A cursor of the connection (and transaction) the rows are written in.
+    - schema_name (str): The schema of the target table.
+    - table_name (str): The target table.
+    - rows (list of dict): The rows to write, all with the same keys. The keys are the column names.
+    - conflict_columns (list of str, optional): The unique key of the table. Rows whose key already exists update
+      the existing row (INSERT ... ON CONFLICT DO UPDATE). Without it, the rows are plainly inserted.
+    - hash_column (str, optional): A column of the table storing the content hash of each row (e.g. ROW_HASH_COLUMN).
+      When given, an existing row is only updated if its hash differs from the incoming one, 
+      so unchanged rows cost neither a new row version nor WAL.
+    - key_table (str, optional): A table created with create_key_table, to which the keys of the rows are added.
+
+    Returns:
+    - int: The number of rows inserted or updated (unchanged rows skipped through hash_column are not counted).
+
+    Notes:
+    - ON CONFLICT cannot update the same row twice in one statement, so when a key occurs more than once in rows,
+      only its last occurrence is kept (DISTINCT ON): the same outcome as upserting the rows one after the other.
+    - The staging table is dropped when the transaction commits or rolls back.
+
+    """
+    if not rows:
+        return 0
+
+    columns = list(rows[0].keys())
+    staging_table = create_staging_table(cur, schema_name, table_name, columns)
+    copy_rows(cur, staging_table, columns, rows)
+
+    target_columns = columns + [hash_column] if hash_column else columns
+    source_columns = columns + [row_hash_expression(columns)] if hash_column else columns
+
+    if conflict_columns:
+        update_columns = [col for col in target_columns if col not in conflict_columns]
+        on_conflict = (f"DO UPDATE SET {', '.join(f'{col} = EXCLUDED.{col}' for col in update_columns)}"
+                       if update_columns else "DO NOTHING")
+
+        if hash_column and update_columns:
+            on_conflict += f" WHERE target.{hash_column} IS DISTINCT FROM EXCLUDED.{hash_column}"
+
+        query = f"""
+        INSERT INTO {schema_name}.{table_name} AS target ({', '.join(target_columns)})
+        SELECT DISTINCT ON ({', '.join(conflict_columns)}) {', '.join(source_columns)}
+        FROM {staging_table}
+        ORDER BY {', '.join(conflict_columns)}, {ROW_ORDER_COLUMN} DESC
+        ON CONFLICT ({', '.join(conflict_columns)}) {on_conflict}
+        """
+    else:
+        query = f"""
+        INSERT INTO {schema_name}.{table_name} ({', '.join(target_columns)})
+        SELECT {', '.join(source_columns)}
+        FROM {staging_table}
+        ORDER BY {ROW_ORDER_COLUMN}
+        """
+
+    cur.execute(query)
+    row_count = cur.rowcount
+
+    if key_table:
+        cur.execute(f"INSERT INTO {key_table} SELECT DISTINCT {', '.join(conflict_columns)} FROM {staging_table}")
+
+    # Dropped now rather than at commit, so several pages can be loaded in the same transaction
+    cur.execute(f"DROP TABLE {staging_table}")
+
+    return row_count
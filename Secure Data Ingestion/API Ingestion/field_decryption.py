@@ -0,0 +1,258 @@
+import os
+import queue
+import atexit
+import hashlib
+import logging
+import binascii
+import multiprocessing
+import threading
+from collections import Counter
+from logging.handlers import QueueHandler, QueueListener
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from Crypto.Cipher import AES
+from Crypto.Util.Padding import unpad
+
+# Batched decryption of the AES-CBC encrypted fields returned by the API.
+# decrypt_field in the API scripts used to build a new cipher and decode each value on its own. Here a whole response
+# is decrypted at once: one cipher (one key schedule) decrypts every value in a single call, and large responses are
+# split across processes. The decrypted output is identical to the per-field path, including the fallbacks on failure.
+
+# Number of encrypted values from which a response is split across processes, and the number of processes used.
+# Below the threshold, the cost of shipping the values to other processes outweighs the gain.
+PARALLEL_THRESHOLD = int(os.getenv('DECRYPTION_PARALLEL_THRESHOLD', 100000))
+DECRYPTION_WORKERS = int(os.getenv('DECRYPTION_WORKERS', os.cpu_count() or 1))
+
+# How decryption failures are logged:
+# - 'aggregated' (default): one line per column and batch, with the failure count, the errors and a few redacted examples.
+#   Lines go through a queue to a background thread, so the decryption loop never waits on the log file.
+# - 'per_value': one line per failed value, including the value itself, as decrypt_field used to log. For debugging only.
+DECRYPTION_FAILURE_LOGGING = os.getenv('DECRYPTION_FAILURE_LOGGING', 'aggregated')
+DECRYPTION_FAILURE_EXAMPLES = int(os.getenv('DECRYPTION_FAILURE_EXAMPLES', 3))
+
+_CBC_PADDING_ERROR = "Data must be padded to 16 byte boundary in CBC mode"
+
+failure_logger = logging.getLogger('field_decryption')
+_failure_log_listener = None
+_failure_log_lock = threading.Lock()
+
+_process_pool = None
+_process_pool_lock = threading.Lock()
+
+def _decrypt_chunk(values, key, iv):
+    """
+    Decrypts a list of base64 encoded AES-CBC values with a single cipher.
+
+    CBC decryption of a block is the ECB decryption of that block XORed with the previous ciphertext block
+    (the IV for the first block of each value). So every ciphertext is concatenated and decrypted in one ECB call,
+    and the XOR with the previous blocks is done in one go on the whole buffer, instead of creating a CBC cipher per value.
+
+    Parameters:
+    - values (list of str): The encrypted values.
+    - key (bytes): The AES key.
+    - iv (bytes): The initialisation vector every value was encrypted with.
+
+    Returns:
+    - tuple: The decrypted values (the original value where decryption failed, as decrypt_field does)
+      and the failures, as a list of (position, original value, error message) in the order of the values. The failures are logged by the caller,
+      so that messages from worker processes are not lost.
+
+    """
+    results = list(values)
+    failures = []
+
+    try:
+        # Also validates the key and IV, which the per-field path does for every value
+        AES.new(key, AES.MODE_CBC, iv)
+        cipher = AES.new(key, AES.MODE_ECB)
+        cipher_error = None
+    except Exception as e:
+        cipher_error = str(e)
+
+    positions = []
+    ciphertexts = []
+    for position, value in enumerate(values):
+        # Same checks, in the same order, as decrypt_field: base64 decoding, then the cipher, then the block size
+        try:
+            ciphertext = binascii.a2b_base64(value)
+        except Exception as e:
+            failures.append((position, value, str(e)))
+            continue
+
+        if cipher_error is not None:
+            failures.append((position, value, cipher_error))
+            continue
+
+        if len(ciphertext) % AES.block_size:
+            failures.append((position, value, _CBC_PADDING_ERROR))
+            continue
+
+        positions.append(position)
+        ciphertexts.append(ciphertext)
+
+    if not ciphertexts:
+        return results, failures
+
+    # Previous ciphertext block of every block: the IV for the first block of a value, the block before it otherwise
+    previous_blocks = b''.join(iv + ciphertext[:-AES.block_size] if ciphertext else b'' for ciphertext in ciphertexts)
+    ciphertext_buffer = b''.join(ciphertexts)
+
+    decrypted_blocks = int.from_bytes(cipher.decrypt(ciphertext_buffer), 'big') ^ int.from_bytes(previous_blocks, 'big')
+    plaintext_buffer = decrypted_blocks.to_bytes(len(ciphertext_buffer), 'big')
+
+    offset = 0
+    for position, ciphertext in zip(positions, ciphertexts):
+        plaintext = plaintext_buffer[offset:offset + len(ciphertext)]
+        offset += len(ciphertext)
+
+        try:
+            results[position] = unpad(plaintext, AES.block_size).decode('utf-8')
+        except Exception as e:
+            failures.append((position, values[position], str(e)))
+
+    return results, sorted(failures, key=lambda failure: failure[0])
+
+def _get_process_pool():
+    """
+    Returns the process pool used for large responses, creating it on first use.
+
+    The pool is usually first used from a worker thread of the API engine, while other threads hold locks (logging,
+    connection pool, ...). Forked workers would inherit those locks held and could hang, so they are started with 'spawn'.
+    """
+    global _process_pool
+
+    with _process_pool_lock:
+        if _process_pool is None:
+            _process_pool = ProcessPoolExecutor(max_workers=DECRYPTION_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+            atexit.register(_process_pool.shutdown)
+
+    return _process_pool
+
+def redact(value):
+    """ Describes a value without revealing it: its length and a short SHA-256 fingerprint, enough to tell values apart. """
+    value = str(value)
+    return f"<{len(value)} chars, sha256:{hashlib.sha256(value.encode('utf-8', 'replace')).hexdigest()[:12]}>"
+
+def _start_failure_logging():
+    """
+    Routes failure_logger through a queue, on first use.
+
+    A QueueListener thread writes the records to the handlers of the root logger (e.g. the scripts' RotatingFileHandler),
+    so logging a failure only costs putting a record on a queue.
+    """
+    global _failure_log_listener
+
+    with _failure_log_lock:
+        if _failure_log_listener is None:
+            log_queue = queue.SimpleQueue()
+            handlers = logging.getLogger().handlers or [logging.lastResort]
+
+            _failure_log_listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+            _failure_log_listener.start()
+            atexit.register(_failure_log_listener.stop)
+
+            failure_logger.addHandler(QueueHandler(log_queue))
+            failure_logger.propagate = False
+
+def log_failures(failures, total_values, labels=None):
+    """
+    Logs the failures of a batch, as set by DECRYPTION_FAILURE_LOGGING.
+
+    Parameters:
+    - failures (list): (position, original value, error message) of each value that could not be decrypted.
+    - total_values (int): Number of values in the batch.
+    - labels (list of str, optional): The column of each value, by position, to count the failures per column.
+
+    Notes:
+    - In aggregated mode the values are never written: examples are redacted (see redact).
+
+    """
+    if not failures:
+        return
+
+    if DECRYPTION_FAILURE_LOGGING == 'per_value':
+        for _, value, error in failures:
+            logging.error(f"Decryption failed for value: {value}. Error: {error}")
+        return
+
+    _start_failure_logging()
+    totals = Counter(labels) if labels is not None else {None: total_values}
+
+    by_column = {}
+    for position, value, error in failures:
+        column = labels[position] if labels is not None else None
+        summary = by_column.setdefault(column, {'count': 0, 'errors': Counter(), 'examples': []})
+        summary['count'] += 1
+        summary['errors'][error] += 1
+        if len(summary['examples']) < DECRYPTION_FAILURE_EXAMPLES:
+            summary['examples'].append(redact(value))
+
+    for column, summary in by_column.items():
+        errors = '; '.join(f"{error} ({count})" for error, count in summary['errors'].most_common())
+        failure_logger.error(f"Decryption failed for {summary['count']} of {totals[column]} values"
+                             f"{f' in column {column}' if column is not None else ''}. "
+                             f"Errors: {errors}. Examples: {', '.join(summary['examples'])}")
+
+def decrypt_values(values, key, iv, parallel_threshold=PARALLEL_THRESHOLD, workers=DECRYPTION_WORKERS, labels=None):
+    """
+    Decrypts a list of base64 encoded, AES-CBC encrypted values (e.g. a column, or every field of a response).
+
+    Required:
+    - from Crypto.Cipher import AES
+    - from Crypto.Util.Padding import unpad
+
+    Parameters:
+    - values (list of str): The encrypted values.
+    - key (bytes): The AES key (ENCRYPTION_KEY).
+    - iv (bytes): The initialisation vector (IV).
+    - parallel_threshold (int): Number of values from which the work is split across processes. Defaults to PARALLEL_THRESHOLD.
+    - workers (int): Number of processes used above the threshold. Defaults to DECRYPTION_WORKERS.
+    - labels (list of str, optional): The column of each value, used to report the failures per column.
+
+    Returns:
+    - list of str: The decrypted values, in the same order.
+
+    Notes:
+    - The output is the same as calling decrypt_field on every value: a value that cannot be decrypted
+      is returned unchanged. Failures are logged once per batch and column (see log_failures).
+
+    """
+    values = list(values)
+
+    if workers > 1 and len(values) >= parallel_threshold:
+        chunk_size = -(-len(values) // workers)
+        chunks = [values[start:start + chunk_size] for start in range(0, len(values), chunk_size)]
+
+        results, failures = [], []
+        for chunk_results, chunk_failures in _get_process_pool().map(partial(_decrypt_chunk, key=key, iv=iv), chunks):
+            failures.extend((len(results) + position, value, error) for position, value, error in chunk_failures)
+            results.extend(chunk_results)
+    else:
+        results, failures = _decrypt_chunk(values, key, iv)
+
+    log_failures(failures, len(values), labels)
+
+    return results
+
+def decrypt_rows(rows, key, iv, **options):
+    """
+    Decrypts every string value of a list of API records in place, in a single batch.
+
+    Parameters:
+    - rows (list of dict): The records of an API response (response['data']).
+    - key (bytes): The AES key (ENCRYPTION_KEY).
+    - iv (bytes): The initialisation vector (IV).
+    - **options: Passed on to decrypt_values (parallel_threshold, workers).
+
+    Returns:
+    - list of dict: The same records, with their string values decrypted. Non-string values are left as they are.
+
+    """
+    locations = [(row, column) for row in rows for column, value in row.items() if isinstance(value, str)]
+    decrypted_values = decrypt_values([row[column] for row, column in locations], key, iv,
+                                      labels=[column for _, column in locations], **options)
+
+    for (row, column), decrypted_value in zip(locations, decrypted_values):
+        row[column] = decrypted_value
+
+    return rows
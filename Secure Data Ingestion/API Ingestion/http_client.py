@@ -0,0 +1,150 @@
+import os
+import time
+import random
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry, make_headers
+
+# Shared HTTP client for the API Ingestion scripts.
+# Requests go through a long-lived requests.Session, so connections are kept alive and reused instead of paying
+# a TCP and TLS handshake on every call. Transient failures are retried with jittered exponential backoff,
+# and responses are requested compressed.
+# Signed requests (whose headers carry a timestamp) are retried here rather than by urllib3, so each attempt is signed afresh.
+
+# Retry and timeout settings. Each can be overridden from the .env file.
+HTTP_TIMEOUT = float(os.getenv('HTTP_TIMEOUT', 60))
+HTTP_RETRIES = int(os.getenv('HTTP_RETRIES', 5))
+HTTP_BACKOFF_FACTOR = float(os.getenv('HTTP_BACKOFF_FACTOR', 1))
+HTTP_BACKOFF_JITTER = float(os.getenv('HTTP_BACKOFF_JITTER', 1))
+HTTP_BACKOFF_MAX = float(os.getenv('HTTP_BACKOFF_MAX', 30))
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', 10))
+
+# Responses worth retrying: rate limiting and server-side failures
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+_sessions = threading.local()
+
+def create_session(retries=HTTP_RETRIES, backoff_factor=HTTP_BACKOFF_FACTOR, backoff_jitter=HTTP_BACKOFF_JITTER,
+                   pool_size=HTTP_POOL_SIZE):
+    """
+    Creates a requests session with connection pooling, retries and compression.
+
+    Required:
+    - import requests
+    - from requests.adapters import HTTPAdapter
+    - from urllib3.util import Retry, make_headers
+
+    Parameters:
+    - retries (int): Number of retries of a failed request. Defaults to HTTP_RETRIES.
+    - backoff_factor (float): Base of the exponential backoff, in seconds: the n-th retry waits backoff_factor * 2 ** (n - 1)
+      seconds, capped at HTTP_BACKOFF_MAX. Defaults to HTTP_BACKOFF_FACTOR.
+    - backoff_jitter (float): Up to this many seconds are added at random to each wait, so that clients
+      failing at the same time do not retry in lockstep. Defaults to HTTP_BACKOFF_JITTER.
+    - pool_size (int): Number of connections kept alive per host. Defaults to HTTP_POOL_SIZE.
+
+    Returns:
+    session (requests.Session): The configured session.
+
+    Notes:
+    - Connection errors, read timeouts and 429/5xx responses are retried. When the API sends a Retry-After header
+      (usually with a 429 or 503), it is honoured instead of the backoff.
+    - Once the retries are exhausted, the last response is returned as it is, so response.raise_for_status()
+      reports the failure exactly as it did without retries.
+    - Accept-Encoding asks for gzip and deflate, and for brotli (br) and zstd when the brotli / zstandard packages
+      are installed, as only then can urllib3 decode them. Responses are decompressed transparently.
+
+    """
+    retry = Retry(total=retries,
+                  connect=retries,
+                  read=retries,
+                  status=retries,
+                  status_forcelist=RETRY_STATUS_CODES,
+                  allowed_methods=frozenset(['GET', 'HEAD', 'OPTIONS']),
+                  backoff_factor=backoff_factor,
+                  backoff_jitter=backoff_jitter,
+                  backoff_max=HTTP_BACKOFF_MAX,
+                  respect_retry_after_header=True,
+                  raise_on_status=False)
+
+    adapter = HTTPAdapter(max_retries=retry, pool_connections=pool_size, pool_maxsize=pool_size)
+
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers.update(make_headers(keep_alive=True, accept_encoding=True))
+
+    return session
+
+def get_session(retries=True):
+    """
+    Returns the session of the calling thread, creating it on first use.
+
+    requests.Session is not guaranteed to be thread-safe, so each thread (e.g. each backfill worker) keeps its own
+    session, and with it its own kept-alive connections.
+    With retries=False, the thread's session without transport-level retries is returned (see http_get's sign).
+
+    """
+    name = 'session' if retries else 'session_without_retries'
+    session = getattr(_sessions, name, None)
+
+    if session is None:
+        session = create_session() if retries else create_session(retries=0)
+        setattr(_sessions, name, session)
+
+    return session
+
+def backoff_delay(retry_number, response=None, backoff_factor=HTTP_BACKOFF_FACTOR, backoff_jitter=HTTP_BACKOFF_JITTER):
+    """
+    Returns the seconds to wait before the n-th retry (starting at 1): the Retry-After header of the response if it has one,
+    otherwise the same jittered exponential backoff as the session's retries.
+
+    """
+    retry_after = response.headers.get('Retry-After') if response is not None else None
+    if retry_after:
+        try:
+            return Retry().parse_retry_after(retry_after)
+        except Exception:
+            pass
+
+    return min(HTTP_BACKOFF_MAX, backoff_factor * 2 ** (retry_number - 1)) + random.uniform(0, backoff_jitter)
+
+def http_get(url, timeout=HTTP_TIMEOUT, sign=None, retries=HTTP_RETRIES, **kwargs):
+    """
+    Sends a GET request through the calling thread's shared session.
+
+    Parameters:
+    - url (str): The URL to request.
+    - timeout (float): Seconds to wait for the server to connect or send data, per attempt. Defaults to HTTP_TIMEOUT.
+    - sign (callable, optional): Returns the headers of an attempt, e.g. an authentication hash of the current timestamp.
+      It is called again for every retry, so a retry never resends a signature that has gone stale during the backoff.
+    - retries (int): Number of retries of a signed request. Defaults to HTTP_RETRIES.
+    - **kwargs: Passed on to requests.Session.get (headers, params, ...).
+
+    Returns:
+    response (requests.Response): The response of the last attempt.
+
+    Notes:
+    - Unsigned requests are retried by urllib3 (see create_session), which resends the same headers.
+      Signed requests go through a session without retries and are retried here, on the same failures and with the same backoff.
+
+    """
+    if sign is None:
+        return get_session().get(url, timeout=timeout, **kwargs)
+
+    session = get_session(retries=False)
+    headers = kwargs.pop('headers', None) or {}
+
+    for retry_number in range(1, retries + 2):
+        try:
+            response = session.get(url, timeout=timeout, headers=dict(headers, **sign()), **kwargs)
+        except (requests.ConnectionError, requests.Timeout):
+            if retry_number > retries:
+                raise
+            time.sleep(backoff_delay(retry_number))
+            continue
+
+        if response.status_code not in RETRY_STATUS_CODES or retry_number > retries:
+            return response
+
+        time.sleep(backoff_delay(retry_number, response))
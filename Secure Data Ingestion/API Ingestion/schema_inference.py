@@ -0,0 +1,227 @@
+import os
+import re
+from datetime import date, datetime
+
+# Column type inference for the tables loaded from the API.
+# The API returns every field as a string, and the tables used to declare every column as TEXT. Here the decrypted
+# rows are sampled to pick compact PostgreSQL types (BIGINT, NUMERIC, BOOLEAN, DATE, TIMESTAMP, TIMESTAMPTZ), and the
+# table is evolved as the payload changes: new fields become new columns, and a column receiving a value its type
+# cannot hold is widened (e.g. BIGINT to NUMERIC, or to TEXT) instead of failing the load.
+
+# Number of rows sampled to infer the type of a new column
+SAMPLE_SIZE = int(os.getenv('SCHEMA_INFERENCE_SAMPLE_SIZE', 1000))
+
+_INTEGER = re.compile(r'[+-]?(0|[1-9]\d*)')
+_DECIMAL = re.compile(r'[+-]?((0|[1-9]\d*)(\.\d*)?|\.\d+)([eE][+-]?\d+)?')
+_DATE = re.compile(r'\d{4}-\d{2}-\d{2}')
+_TIMESTAMP = re.compile(r'\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}(:\d{2}(\.\d{1,6})?)?(Z|[+-]\d{2}(:?\d{2})?)?')
+
+_BIGINT_RANGE = range(-2 ** 63, 2 ** 63)
+
+# Types as reported by information_schema.columns. Other types (e.g. set by hand) are left alone.
+_CATALOG_TYPES = {'bigint': 'BIGINT', 'numeric': 'NUMERIC', 'boolean': 'BOOLEAN', 'date': 'DATE', 'text': 'TEXT',
+                  'timestamp without time zone': 'TIMESTAMP', 'timestamp with time zone': 'TIMESTAMPTZ'}
+
+# Pairs of types whose values fit in a wider type other than TEXT
+_WIDER_TYPES = {frozenset(['BIGINT', 'NUMERIC']): 'NUMERIC',
+                frozenset(['DATE', 'TIMESTAMP']): 'TIMESTAMP',
+                frozenset(['DATE', 'TIMESTAMPTZ']): 'TIMESTAMPTZ',
+                frozenset(['TIMESTAMP', 'TIMESTAMPTZ']): 'TIMESTAMPTZ'}
+
+def value_type(value):
+    """
+    Returns the narrowest PostgreSQL type able to hold a value, or None for a missing value (None or '').
+
+    - Integers with leading zeros (e.g. codes such as '00123') are kept as TEXT, as a numeric type would drop the zeros.
+    - Only ISO 8601 dates and timestamps are recognised; timestamps with a UTC offset are TIMESTAMPTZ.
+    - Dictionaries and lists are TEXT (they are loaded as JSON text).
+
+    """
+    if value is None or value == '':
+        return None
+    if isinstance(value, bool):
+        return 'BOOLEAN'
+    if isinstance(value, int):
+        return 'BIGINT' if value in _BIGINT_RANGE else 'NUMERIC'
+    if isinstance(value, float):
+        return 'NUMERIC'
+    if not isinstance(value, str):
+        return 'TEXT'
+
+    if value.lower() in ('true', 'false'):
+        return 'BOOLEAN'
+    if _INTEGER.fullmatch(value):
+        return 'BIGINT' if int(value) in _BIGINT_RANGE else 'NUMERIC'
+    if _DECIMAL.fullmatch(value):
+        return 'NUMERIC'
+
+    try:
+        if _DATE.fullmatch(value):
+            date.fromisoformat(value)
+            return 'DATE'
+        if _TIMESTAMP.fullmatch(value):
+            timestamp = datetime.fromisoformat(value.replace('Z', '+00:00'))
+            return 'TIMESTAMPTZ' if timestamp.tzinfo else 'TIMESTAMP'
+    except ValueError:
+        pass
+
+    return 'TEXT'
+
+def combine_types(first, second):
+    """ Returns the narrowest type holding the values of both types (None stands for no value). """
+    if first is None or first == second:
+        return second
+    if second is None:
+        return first
+
+    return _WIDER_TYPES.get(frozenset([first, second]), 'TEXT')
+
+def infer_column_types(rows, columns, sample_size=SAMPLE_SIZE):
+    """
+    Infers the type of each column from a sample of rows. Columns with no value in the sample are TEXT.
+
+    Parameters:
+    - rows (list of dict): The decrypted rows of a page.
+    - columns (iterable of str): The columns to infer.
+    - sample_size (int): Number of rows, spread evenly over the page, looked at. Defaults to SAMPLE_SIZE.
+
+    Returns:
+    - dict: The type of each column.
+
+    """
+    step = max(1, len(rows) // sample_size)
+    sample = rows[::step]
+
+    column_types = {}
+    for col in columns:
+        column_type = None
+        for row in sample:
+            column_type = combine_types(column_type, value_type(row.get(col)))
+            if column_type == 'TEXT':
+                break
+        column_types[col] = column_type or 'TEXT'
+
+    return column_types
+
+def _page_column_types(rows, columns):
+    """
+    Returns the types of new columns: inferred from a sample of the page, then widened until every row of the page fits,
+    so that a value the sample missed cannot fail the load.
+    """
+    column_types = infer_column_types(rows, columns)
+    _, widened_columns = _required_changes(rows, column_types)
+    column_types.update(widened_columns)
+
+    return column_types
+
+def read_column_types(cur, schema_name, table_name):
+    """ Returns the columns of a table and their types (None for types this module does not manage), or None if the table does not exist. """
+    cur.execute("""
+    SELECT column_name, data_type
+    FROM information_schema.columns
+    WHERE table_schema = %s AND table_name = %s
+    ORDER BY ordinal_position
+    """, (schema_name, table_name))
+    columns = cur.fetchall()
+
+    if not columns:
+        return None
+
+    return {column_name: _CATALOG_TYPES.get(data_type) for column_name, data_type in columns}
+
+def _required_changes(rows, column_types):
+    """ Returns the columns missing from the table and the columns whose type must be widened to hold the rows. """
+    columns = list(rows[0].keys())
+    new_columns = [col for col in columns if col not in column_types]
+
+    widened_columns = {}
+    for col in columns:
+        current_type = column_types.get(col)
+        if current_type in (None, 'TEXT'):
+            continue
+
+        column_type = current_type
+        for row in rows:
+            column_type = combine_types(column_type, value_type(row[col]))
+            if column_type == 'TEXT':
+                break
+
+        if column_type != current_type:
+            widened_columns[col] = column_type
+
+    return new_columns, widened_columns
+
+def ensure_table_schema(cur, schema_name, table_name, rows, constraints=(), extra_columns=None, column_types=None):
+    """
+    Creates a table with inferred column types, or evolves it so that it can hold the rows of a page.
+
+    Required:
+    - The rows of a page share the same keys (the column names).
+
+    Parameters:
+    - cur (psycopg2.extensions.cursor): A cursor of the connection (and transaction) the rows are written in.
+    - schema_name (str): The schema of the table.
+    - table_name (str): The table.
+    - rows (list of dict): The decrypted rows of the page about to be loaded.
+    - constraints (iterable of str): Table constraints used when the table is created, e.g. "UNIQUE (project_id, metric_period)".
+    - extra_columns (dict, optional): Columns not in the payload, and their types, e.g. {'row_hash': 'TEXT'}.
+      They are added to tables that do not have them yet.
+    - column_types (dict, optional): The column types returned for the previous page. When the page fits them,
+      no query is sent to the database.
+
+    Returns:
+    - dict: The type of each column of the table, to pass back for the next page and to prepare_rows.
+
+    Notes:
+    - The schema changes take an advisory lock held until the end of the transaction, so concurrent loads of the same
+      table (e.g. backfill workers) apply them one at a time. The catalog is read again once the lock is held.
+    - New columns are typed from a sample of the current page, then widened to fit every row of it.
+      Existing columns are only ever widened, never narrowed, and tables created as all TEXT keep their TEXT columns.
+
+    """
+    extra_columns = extra_columns or {}
+
+    if column_types is not None:
+        new_columns, widened_columns = _required_changes(rows, column_types)
+        if not new_columns and not widened_columns and all(col in column_types for col in extra_columns):
+            return column_types
+
+    cur.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (f"{schema_name}.{table_name}",))
+    column_types = read_column_types(cur, schema_name, table_name)
+
+    if column_types is None:
+        column_types = dict(_page_column_types(rows, rows[0].keys()), **extra_columns)
+        column_defs = [f"{col} {column_type}" for col, column_type in column_types.items()] + list(constraints)
+
+        cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS {schema_name}.{table_name} (
+            {', '.join(column_defs)}
+        )
+        """)
+        return column_types
+
+    new_columns, widened_columns = _required_changes(rows, column_types)
+    added_types = dict(_page_column_types(rows, new_columns), **{col: column_type for col, column_type in extra_columns.items() if col not in column_types})
+
+    for col, column_type in added_types.items():
+        cur.execute(f"ALTER TABLE {schema_name}.{table_name} ADD COLUMN {col} {column_type}")
+    for col, column_type in widened_columns.items():
+        cur.execute(f"ALTER TABLE {schema_name}.{table_name} ALTER COLUMN {col} TYPE {column_type} USING {col}::{column_type}")
+
+    column_types.update(added_types)
+    column_types.update(widened_columns)
+    return column_types
+
+def prepare_rows(rows, column_types):
+    """
+    Replaces the empty strings of typed columns by None (NULL), as '' is not a valid number, date or boolean.
+    TEXT columns keep their empty strings. Returns the rows, modified in place.
+    """
+    typed_columns = [col for col in rows[0].keys() if column_types.get(col) not in (None, 'TEXT')]
+
+    for row in rows:
+        for col in typed_columns:
+            if row[col] == '':
+                row[col] = None
+
+    return rows
@@ -1,11 +1,52 @@
 import os
-import boto3
+import gzip
+import json
+import time
+import random
+import hashlib
+import tempfile
+import threading
 import pandas as pd
 import psycopg2
+from psycopg2.extras import execute_values
 from docx import Document
 from io import BytesIO
+from collections import deque, namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
+from functools import partial
 from pypdf import PdfReader
 from dotenv import load_dotenv
+from ingestion_connections import get_connection_pool, get_s3_resource
+
+# Lightweight, picklable stand-in for a boto3 ObjectSummary.
+# Worker processes only need the key and metadata of a file, not the live boto3 resource behind it.
+S3Document = namedtuple('S3Document', ['key', 'e_tag', 'last_modified', 'size'])
+
+# A document whose text was found in the extraction cache. It travels through the pipeline in its place in the listing order,
+# without being downloaded or parsed.
+CachedDocument = namedtuple('CachedDocument', ['document', 'pagewise_content'])
+
+# Load the environment variables from the .env file, so the settings below can be overridden there
+load_dotenv()
+
+# Memory limits for document extraction. Each can be overridden from the .env file.
+# - Files larger than SPOOL_THRESHOLD_BYTES are spooled to a temporary file on disk instead of being held in memory.
+# - Files larger than MAX_DOCUMENT_BYTES are skipped altogether.
+# - At most MAX_DOCUMENT_PAGES pages (or DOCX paragraphs) are extracted per document.
+SPOOL_THRESHOLD_BYTES = int(os.getenv('S3_SPOOL_THRESHOLD_BYTES', 8 * 1024 * 1024))
+MAX_DOCUMENT_BYTES = int(os.getenv('S3_MAX_DOCUMENT_BYTES', 100 * 1024 * 1024))
+MAX_DOCUMENT_PAGES = int(os.getenv('S3_MAX_DOCUMENT_PAGES', 1000))
+DOWNLOAD_CHUNK_BYTES = 1024 * 1024
+
+# Local cache of extracted text. Caching is switched off unless a cache directory is set in the .env file.
+EXTRACTION_CACHE_DIR = os.getenv('S3_EXTRACTION_CACHE_DIR')
+EXTRACTION_CACHE_MAX_BYTES = int(os.getenv('S3_EXTRACTION_CACHE_MAX_BYTES', 2 * 1024 * 1024 * 1024))
+# Share of the size limit the cache is brought back to once it exceeds it, so that eviction runs once per batch of entries
+EXTRACTION_CACHE_LOW_WATER = 0.9
+
+# Metrics snapshot written at the end of a run. Instrumentation is switched off unless a file is set in the .env file.
+# A path ending in .prom is written in the Prometheus text format (for the node_exporter textfile collector), anything else as JSON.
+METRICS_FILE = os.getenv('S3_METRICS_FILE')
 
 def connect_to_database():
     """ 
@@ -18,6 +59,7 @@ def connect_to_database():
     - import psycopg2
     - import os
     - from dotenv import load_dotenv
+    - from ingestion_connections import get_connection_pool
     - .env file in project directory
 
     Parameters:
@@ -33,6 +75,8 @@ def connect_to_database():
     connection (psycopg2.extensions.connection): A connection object that represents the database connection. 
     If the connection is successful, this object can be used to perform SQL operations on the database. 
     If the connection fails, the function will print an error message and return None.
+    The connection is borrowed from the shared pool of ingestion_connections, so calling the function again 
+    (e.g. for another table or another run within the same process) reuses open connections instead of opening new ones.
 
     Raises:
     Exception: An exception is raised if there is an error when trying to connect to the database. 
@@ -51,12 +95,12 @@ def connect_to_database():
         pg_datasource_pw = os.getenv("POSTGRES_PASSWORD")
         pg_datasource_port = os.getenv("POSTGRES_PORT")
 
-        # Establish a connection to the database
-        connection = psycopg2.connect(database = pg_datasource_dbname,
-                                       user = pg_datasource_username,
-                                       host = pg_datasource_host,
-                                       password = pg_datasource_pw,
-                                       port = 5432)
+        # Borrow a connection to the database from the shared pool
+        connection = get_connection_pool(dict(database = pg_datasource_dbname,
+                                              user = pg_datasource_username,
+                                              host = pg_datasource_host,
+                                              password = pg_datasource_pw,
+                                              port = 5432)).getconn()
         print("Connection to Database Successful")
         
         return connection
@@ -74,7 +118,7 @@ def connect_to_s3_bucket(bucket_name):
 
     Required:
     - import os
-    - import boto3
+    - from ingestion_connections import get_s3_resource
 
     Parameters:
     The first three(3) parameters are harvested from a .env file attached to the project.
@@ -83,12 +127,14 @@ def connect_to_s3_bucket(bucket_name):
     - aws_access_key_id (str) ["ACCESS_KEY"]: The AWS access key ID for your account.
     - aws_secret_access_key (str) ["SECRET_KEY"]: The AWS secret access key for your account.
     - region_name (str) ["REGION"]: The name of the AWS region where the S3 bucket is located.
+    - endpoint_url (str) ["S3_ENDPOINT_URL"]: Optional. The URL of an S3-compatible stand-in to use instead of AWS, e.g. for local testing.
     - bucket_name (str): The name of the S3 bucket you want to connect to.
 
     Returns:
     s3 (boto3.resources.factory.s3.ServiceResource): A resource representing Amazon S3. 
     If the connection is successful, this object can be used to interact with the contents of the s3 bucket. 
     If the connection fails, the function will print an error message and return None.
+    The resource is cached by ingestion_connections, so calling the function again reuses its HTTP connection pool.
 
     Raises:
     Exception: An exception is raised if there is an error when trying to connect to the s3 bucket. 
@@ -101,13 +147,15 @@ def connect_to_s3_bucket(bucket_name):
         aws_access_key_id = os.getenv('ACCESS_KEY')
         aws_secret_access_key = os.getenv('SECRET_KEY')
         region_name = os.getenv('REGION')
-
-        # Create a boto3 session to the s3 bucket of concern
-        s3 = boto3.resource('s3',
-                            aws_access_key_id=aws_access_key_id,
-                            aws_secret_access_key=aws_secret_access_key,
-                            region_name=region_name
-                            )
+        # Optional: points the connection at an S3 stand-in (e.g. a local moto server or MinIO) instead of AWS
+        endpoint_url = os.getenv('S3_ENDPOINT_URL')
+
+        # Get the shared boto3 resource for the s3 bucket of concern
+        s3 = get_s3_resource(aws_access_key_id=aws_access_key_id,
+                             aws_secret_access_key=aws_secret_access_key,
+                             region_name=region_name,
+                             endpoint_url=endpoint_url
+                             )
         
         # Test the connection by trying to access the bucket
         s3.meta.client.head_bucket(Bucket=bucket_name)
@@ -190,7 +238,44 @@ def ensure_table_exists(connection, schema_name, table_name):
 
 
 # %%
-def extract_text_from_s3_files(file, cv_file):
+def iter_document_text(file_key, source, max_pages=MAX_DOCUMENT_PAGES):
+    """
+    Yields the text of a PDF or DOCX document one page (PDF) or paragraph (DOCX) at a time.
+
+    Because the text is produced by a generator, only one page is held in memory at a time on top of the parser's own state, 
+    and callers can join the pieces once instead of growing a string page by page.
+
+    Required:
+    - import docx: For extracting text from DOCX files using python-docx.
+    - import pypdf.PdfReader: For reading and extracting text from PDF files.
+
+    Parameters:
+    - file_key (str): The key of the file in the S3 bucket. The file extension decides whether it is read as a PDF or DOCX.
+    - source (str or file-like object): A path to the file on disk or a binary stream holding the file.
+    - max_pages (int): The maximum number of pages (or DOCX paragraphs) to yield. None means no limit.
+
+    Yields:
+    - str: The text of each page or paragraph, in document order. Unsupported file types yield nothing.
+
+    """
+    if file_key.endswith('.pdf'):
+        # PdfReader parses pages lazily from the stream, so a file spooled to disk is never fully loaded into memory
+        pdf_reader = PdfReader(source)
+        for page_number, page in enumerate(pdf_reader.pages):
+            if max_pages is not None and page_number >= max_pages:
+                break
+            yield page.extract_text()
+
+    elif file_key.endswith('.docx'):
+        # The python-docx library lacks a built-in method to get the number of pages in a Word document, 
+        # so the page cap is applied to paragraphs instead.
+        doc_reader = Document(source)
+        for paragraph_number, paragraph in enumerate(doc_reader.paragraphs):
+            if max_pages is not None and paragraph_number >= max_pages:
+                break
+            yield paragraph.text
+
+def extract_text_from_s3_files(file, cv_file, max_pages=MAX_DOCUMENT_PAGES, stats=None):
     """
     Extracts text content from PDF or DOCX files stored in an S3 bucket.
 
@@ -198,14 +283,16 @@ def extract_text_from_s3_files(file, cv_file):
     it uses the appropriate libraries to extract the text content.
 
     Required:
-    - import docx: For extracting text from DOCX files using python-docx.
+    - Function: iter_document_text - Generator yielding the text of each page of the document.
     - import io.BytesIO: For handling in-memory file operations.
-    - import pypdf.PdfReader: For reading and extracting text from PDF files.
 
     Parameters:
-    - file (boto3.s3.Object): The S3 file object that represents the file stored in the bucket. 
+    - file (boto3.s3.Object or S3Document): The S3 file object that represents the file stored in the bucket. 
       The function checks the file extension to determine whether it's a PDF or DOCX.
-    - cv_file (bytes): The content of the file retrieved from S3, passed as a byte stream for processing.
+    - cv_file (bytes or str): The content of the file retrieved from S3, either as bytes 
+      or as the path of the temporary file it was spooled to (see download_s3_file).
+    - max_pages (int): The maximum number of pages (or DOCX paragraphs) to extract. None means no limit. Defaults to MAX_DOCUMENT_PAGES.
+    - stats (dict, optional): If given, the number of pages (or DOCX paragraphs) extracted is stored in it under 'pages'.
 
     Returns:
     - pagewise_content (str): A string containing the extracted text content from the file. If an error occurs during extraction, 
@@ -218,49 +305,824 @@ def extract_text_from_s3_files(file, cv_file):
     - For PDF files: The function uses PyPDF to read and extract text from each page.
     - For DOCX files: The function uses python-docx to read and extract text from each paragraph.
     - The function currently does not calculate the number of pages for DOCX files, as python-docx does not provide this capability.
-    - If the file type is unsupported or an error occurs, a message indicating the issue is returned.
+    - The pages are joined once at the end, rather than appended to a growing string, which avoids re-copying the text for every page.
+    - If the file type is unsupported, an empty string is returned. If an error occurs, a message indicating the issue is returned.
 
     """
-    # Create a temporary string to store the text from all pages of a file
-    pagewise_content = ''
+    source = BytesIO(cv_file) if isinstance(cv_file, bytes) else cv_file
+    pages = iter_document_text(file.key, source, max_pages=max_pages)
+
+    if stats is not None:
+        stats['pages'] = 0
+        pages = _count_pages(pages, stats)
 
     try:
-            
-        if file.key.endswith('.pdf'):
-            # Read the PDF file using PyPDF
-            pdf_reader = PdfReader(BytesIO(cv_file))
+        pagewise_content = ''.join(pages)
 
-            # Get the number of pages of the file
-            no_of_pages = len(pdf_reader.pages)
+    except Exception as e:
+        pagewise_content = f"No Text In CV With Filename: {file.key}"
 
-            # Extract text from each page and append it to the list
-            for page in range(no_of_pages):
-                cv_pages = pdf_reader.pages[page]
-                pagewise_content += cv_pages.extract_text()
+    return pagewise_content
 
-        elif file.key.endswith('.docx'):
-            # Read the .docx file using python-docx
-            doc_reader = Document(BytesIO(cv_file))
+def _count_pages(pages, stats):
+    """ Passes pages through unchanged, counting them into stats['pages']. """
+    for page in pages:
+        stats['pages'] += 1
+        yield page
 
-            # Get the number of pages of the file
-            # The python-docx library lacks a built-in method to get the number of pages in a Word document. 
-            # This is because page count can vary based on page size, font size, and formatting settings, 
-            # which are not stored in the .docx file.
-            # Hence, page count for .docx will be none. This is a reason why .pdf files should be the only allowed file type
-            no_of_pages = None
+# %%
+class ExtractionCache:
+    """
+    Local, on-disk, content-addressed cache of extracted document text.
 
-            # Extract text from each paragraph and print it
-            for paragraph in doc_reader.paragraphs:
-                pagewise_content += paragraph.text
+    Entries are keyed by the file's ETag (its content hash), not by its key, so a document re-uploaded under another name, 
+    or re-processed after the table is rebuilt, is served from the cache without being downloaded or parsed again.
 
+    Required:
+    - import gzip
+    - import hashlib
 
-    except Exception as e:
-        pagewise_content = f"No Text In CV With Filename: {file.key}"
+    Parameters:
+    - cache_dir (str): The directory holding the cache entries. It is created if it does not exist.
+    - max_bytes (int): The maximum size of the cache on disk. Defaults to EXTRACTION_CACHE_MAX_BYTES.
 
-    return pagewise_content
+    Notes:
+    - Each entry is a gzip-compressed text file named after the SHA-256 of the ETag and page limit, 
+      spread over 256 sub-directories to keep directory listings short.
+    - Entries are written to a temporary file and renamed into place, so concurrent runs sharing a cache never read a partial entry.
+    - Eviction is least-recently-used by size: reading an entry refreshes its modification time, 
+      and once the cache grows beyond max_bytes the entries with the oldest modification times are removed
+      until it is back under EXTRACTION_CACHE_LOW_WATER of max_bytes. The cache directory is therefore only walked again 
+      once another tenth of max_bytes has been written, rather than on every insert once the cache is full.
+    - Failed extractions are not cached, so they are retried on the next run.
+
+    """
+    def __init__(self, cache_dir, max_bytes=EXTRACTION_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+        # Size of the cache on disk, computed once and then kept up to date as entries are added and evicted
+        self.current_bytes = sum(os.path.getsize(path) for path, _ in self._entries())
+
+    def _path(self, e_tag, max_pages):
+        # The page limit is part of the key, as the same file yields a different text under a different limit
+        digest = hashlib.sha256(f"{e_tag}:{max_pages}".encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, digest[:2], f"{digest}.txt.gz")
+
+    def _entries(self):
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if name.endswith('.txt.gz'):
+                    path = os.path.join(root, name)
+                    yield path, os.path.getmtime(path)
+
+    def get(self, e_tag, max_pages=MAX_DOCUMENT_PAGES):
+        """ Returns the cached text of a file, or None if it is not in the cache. """
+        path = self._path(e_tag, max_pages)
+
+        try:
+            with gzip.open(path, 'rt', encoding='utf-8') as cache_file:
+                pagewise_content = cache_file.read()
+            # Mark the entry as recently used
+            os.utime(path)
+        except (OSError, EOFError):
+            return None
+
+        return pagewise_content
+
+    def put(self, e_tag, pagewise_content, max_pages=MAX_DOCUMENT_PAGES):
+        """ Stores the text of a file, then evicts the least recently used entries if the cache is over its size limit. """
+        path = self._path(e_tag, max_pages)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), prefix='.tmp_', delete=False) as temporary_file:
+            try:
+                with gzip.open(temporary_file, 'wt', encoding='utf-8') as cache_file:
+                    cache_file.write(pagewise_content)
+            except BaseException:
+                # Do not leave a partial entry behind (e.g. when the disk is full)
+                temporary_file.close()
+                os.remove(temporary_file.name)
+                raise
+
+        previous_bytes = os.path.getsize(path) if os.path.exists(path) else 0
+        os.replace(temporary_file.name, path)
+        self.current_bytes += os.path.getsize(path) - previous_bytes
+
+        if self.current_bytes > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        """ Removes the least recently used entries until the cache is back under the low-water share of its size limit. """
+        target_bytes = self.max_bytes * EXTRACTION_CACHE_LOW_WATER
+        for path, _ in sorted(self._entries(), key=lambda entry: entry[1]):
+            if self.current_bytes <= target_bytes:
+                break
+            try:
+                entry_bytes = os.path.getsize(path)
+                os.remove(path)
+                self.current_bytes -= entry_bytes
+            except FileNotFoundError:
+                # Already evicted by another run sharing the cache
+                continue
+
+def _extraction_failed(document, pagewise_content):
+    """ Tells whether extract_text_from_s3_files returned its failure message instead of the document's text. """
+    return pagewise_content == f"No Text In CV With Filename: {document.key}"
+
+# %%
+class PipelineMetrics:
+    """
+    Per-stage timings and counters for the S3 ingestion pipeline.
+
+    Stages (list, hash_check, download, parse, insert and total) record how often they ran, the time spent in them 
+    and a sample of their latencies. Counters record quantities such as bytes downloaded, pages parsed and documents skipped.
+    The results are exposed as a snapshot, which can be written as JSON or in the Prometheus text format.
+
+    Parameters:
+    - max_samples (int): The number of latencies kept per stage for the percentiles. Beyond that, 
+      reservoir sampling keeps a uniform sample, so memory use does not grow with the number of documents. Defaults to 10000.
+
+    Usage:
+        metrics = PipelineMetrics()
+        with metrics.stage('download'):
+            ...
+        metrics.increment('bytes_downloaded', 1024)
+        metrics.write('/var/lib/node_exporter/s3_ingestion.prom')
+
+    Notes:
+    - The object is thread-safe, so download threads can record into it directly. 
+      Parse processes report their timings back with their results instead (see _parse_document).
+    - Pass NULL_METRICS (the default everywhere) to switch instrumentation off: its methods do nothing.
+
+    """
+    def __init__(self, max_samples=10000):
+        self.max_samples = max_samples
+        self.stages = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+        self._random = random.Random(0)
+
+    def stage(self, name):
+        """ Returns a context manager timing one run of a stage. """
+        return _StageTimer(self, name)
+
+    def observe(self, name, seconds):
+        """ Records one run of a stage that took `seconds`. """
+        with self._lock:
+            stage = self.stages.setdefault(name, {'calls': 0, 'seconds': 0.0, 'max_seconds': 0.0, 'samples': []})
+            stage['calls'] += 1
+            stage['seconds'] += seconds
+            stage['max_seconds'] = max(stage['max_seconds'], seconds)
+
+            if len(stage['samples']) < self.max_samples:
+                stage['samples'].append(seconds)
+            else:
+                slot = self._random.randrange(stage['calls'])
+                if slot < self.max_samples:
+                    stage['samples'][slot] = seconds
+
+    def increment(self, name, amount=1):
+        """ Adds `amount` to a counter. """
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def snapshot(self):
+        """
+        Returns the current state of the metrics as a dictionary:
+        {'stages': {name: {calls, seconds, mean_ms, p50_ms, p90_ms, p99_ms, max_ms}}, 'counters': {name: value}}.
+        """
+        with self._lock:
+            stages = {}
+            for name, stage in self.stages.items():
+                samples = sorted(stage['samples'])
+                def percentile(share):
+                    return round(samples[min(len(samples) - 1, int(share * len(samples)))] * 1000, 3)
+
+                stages[name] = {'calls': stage['calls'],
+                                'seconds': round(stage['seconds'], 6),
+                                'mean_ms': round(stage['seconds'] / stage['calls'] * 1000, 3),
+                                'p50_ms': percentile(0.50),
+                                'p90_ms': percentile(0.90),
+                                'p99_ms': percentile(0.99),
+                                'max_ms': round(stage['max_seconds'] * 1000, 3)}
+
+            return {'stages': stages, 'counters': dict(self.counters)}
+
+    def to_prometheus(self, prefix='s3_ingestion'):
+        """ Renders the snapshot in the Prometheus text exposition format. """
+        snapshot = self.snapshot()
+        lines = [f"# HELP {prefix}_stage_seconds_total Time spent in each stage of the pipeline.",
+                 f"# TYPE {prefix}_stage_seconds_total counter"]
+        lines += [f'{prefix}_stage_seconds_total{{stage="{name}"}} {stage["seconds"]}' for name, stage in snapshot['stages'].items()]
+
+        lines += [f"# HELP {prefix}_stage_calls_total Number of runs of each stage of the pipeline.",
+                  f"# TYPE {prefix}_stage_calls_total counter"]
+        lines += [f'{prefix}_stage_calls_total{{stage="{name}"}} {stage["calls"]}' for name, stage in snapshot['stages'].items()]
+
+        lines += [f"# HELP {prefix}_stage_latency_seconds Latency quantiles of each stage of the pipeline.",
+                  f"# TYPE {prefix}_stage_latency_seconds gauge"]
+        for name, stage in snapshot['stages'].items():
+            for quantile, key in (('0.5', 'p50_ms'), ('0.9', 'p90_ms'), ('0.99', 'p99_ms')):
+                lines.append(f'{prefix}_stage_latency_seconds{{stage="{name}",quantile="{quantile}"}} {stage[key] / 1000}')
+
+        for name, value in snapshot['counters'].items():
+            lines += [f"# TYPE {prefix}_{name}_total counter", f"{prefix}_{name}_total {value}"]
+
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """
+        Writes the snapshot to a file: in the Prometheus text format if the path ends in .prom, as JSON otherwise.
+        The file is written to a temporary name and renamed into place, so a collector never reads a partial file.
+        """
+        content = self.to_prometheus() if path.endswith('.prom') else json.dumps(self.snapshot(), indent=2)
+
+        temporary_path = f"{path}.tmp"
+        with open(temporary_path, 'w') as metrics_file:
+            metrics_file.write(content)
+        os.replace(temporary_path, path)
+        print(f"Metrics written to: {path}")
+
+class _StageTimer:
+    """ Context manager timing one run of a stage of a PipelineMetrics. """
+    __slots__ = ('metrics', 'name', 'started')
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.observe(self.name, time.perf_counter() - self.started)
+        return False
+
+class _DisabledMetrics:
+    """ Stand-in for PipelineMetrics when instrumentation is off. Every method does nothing, at the cost of a method call. """
+    class _NoOpStage:
+        def __enter__(self):
+            return self
+
+        def __exit__(self, exc_type, exc_value, traceback):
+            return False
+
+    _no_op_stage = _NoOpStage()
+
+    def stage(self, name):
+        return self._no_op_stage
+
+    def observe(self, name, seconds):
+        pass
+
+    def increment(self, name, amount=1):
+        pass
+
+NULL_METRICS = _DisabledMetrics()
 
 # %%
-def process_documents(s3_connection_function, bucket_name, database_connection_function, schema_name, table_name):
+def ensure_watermark_table_exists(connection, schema_name, table_name):
+    """
+    Creates the table holding the S3 listing watermark of a target table, if it does not exist yet.
+
+    The watermark table is named after the target table ({table_name}_listing_watermark) and lives in the same schema.
+    It stores one row per bucket with the last key and the most recent last_modified date seen by a completed run.
+
+    Parameters:
+    - connection (psycopg2.extensions.connection): The database connection object.
+    - schema_name (str): The name of the schema where the target table resides.
+    - table_name (str): The name of the target table.
+
+    Returns:
+    None.
+
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(f"""CREATE TABLE IF NOT EXISTS {schema_name}.{table_name}_listing_watermark (
+                                bucket_name varchar(255) PRIMARY KEY,
+                                last_key TEXT COLLATE "C",
+                                last_modified TIMESTAMPTZ,
+                                updated_at TIMESTAMP DEFAULT now())""")
+    connection.commit()
+
+def load_listing_watermark(connection, schema_name, table_name, bucket_name):
+    """
+    Reads the listing watermark left by the previous completed run over a bucket.
+
+    Parameters:
+    - connection (psycopg2.extensions.connection): The database connection object.
+    - schema_name (str): The name of the schema where the target table resides.
+    - table_name (str): The name of the target table.
+    - bucket_name (str): The name of the S3 bucket.
+
+    Returns:
+    - watermark (dict or None): A dictionary with the 'last_key' and 'last_modified' of the previous run, 
+      or None if the bucket has never been processed (in which case the bucket is listed in full).
+
+    """
+    ensure_watermark_table_exists(connection, schema_name, table_name)
+
+    with connection.cursor() as cursor:
+        cursor.execute(f"""SELECT last_key, last_modified FROM {schema_name}.{table_name}_listing_watermark WHERE bucket_name = %s;""", (bucket_name,))
+        row = cursor.fetchone()
+
+    if row is None:
+        return None
+
+    return {'last_key': row[0], 'last_modified': row[1]}
+
+def save_listing_watermark(connection, schema_name, table_name, bucket_name, watermark):
+    """
+    Records the listing watermark of a completed run. 
+    
+    The watermark only ever moves forward: GREATEST keeps the stored values if they are ahead of the new ones.
+    Keys are compared with the "C" collation, i.e. byte by byte, which is the order S3 lists them in
+    (the database collation may sort them differently, e.g. ignoring case or punctuation).
+    It should only be saved once every listed file has been written, so a failed run is simply listed again by the next one.
+
+    Parameters:
+    - connection (psycopg2.extensions.connection): The database connection object.
+    - schema_name (str): The name of the schema where the target table resides.
+    - table_name (str): The name of the target table.
+    - bucket_name (str): The name of the S3 bucket.
+    - watermark (dict): A dictionary with the 'last_key' and 'last_modified' seen by the run, as filled in by list_bucket_documents.
+
+    Returns:
+    None.
+
+    """
+    if watermark.get('last_key') is None:
+        return
+
+    ensure_watermark_table_exists(connection, schema_name, table_name)
+
+    with connection.cursor() as cursor:
+        cursor.execute(f"""INSERT INTO {schema_name}.{table_name}_listing_watermark AS w (bucket_name, last_key, last_modified, updated_at)
+                           VALUES (%s, %s, %s, now())
+                           ON CONFLICT (bucket_name) DO UPDATE
+                           SET last_key = GREATEST(w.last_key COLLATE "C", EXCLUDED.last_key COLLATE "C"),
+                               last_modified = GREATEST(w.last_modified, EXCLUDED.last_modified),
+                               updated_at = now();""",
+                       (bucket_name, watermark['last_key'], watermark['last_modified']))
+    connection.commit()
+
+# %%
+def list_bucket_documents(bucket, listing_mode='full', watermark=None, next_watermark=None, metrics=NULL_METRICS):
+    """
+    Lists the files in an S3 bucket, optionally only those added or changed since a previous run.
+
+    Parameters:
+    - bucket (boto3.resources.factory.s3.Bucket): The S3 bucket to list.
+    - listing_mode (str): How much of the bucket to list. One of:
+      - 'full': list every file in the bucket (the original behaviour).
+      - 'start_after': ask S3 for the keys that sort after the watermark's last_key only. 
+        S3 does this server side, so the listing cost tracks the number of new files. 
+        This suits buckets where new files get ever-increasing keys (e.g. keys prefixed with the upload date or a timestamp).
+      - 'last_modified': list the bucket but only keep files modified at or after the watermark's last_modified date. 
+        S3 cannot filter on dates, so every page of the listing is still read, 
+        but the hash checks, downloads and parsing only run for the changed files. This suits any key layout.
+    - watermark (dict, optional): The watermark of the previous run, as returned by load_listing_watermark. 
+      Without one, the bucket is listed in full whatever the mode.
+    - next_watermark (dict, optional): A dictionary updated in place with the greatest 'last_key' and 'last_modified' listed, 
+      to be saved with save_listing_watermark once the run completes.
+    - metrics (PipelineMetrics, optional): Records the time spent waiting on S3 for the listing (the 'list' stage) and the files listed.
+
+    Yields:
+    - S3Document: The key, hash (ETag without quotes), last modified date and size of each file, in listing order.
+
+    """
+    if listing_mode not in ('full', 'start_after', 'last_modified'):
+        raise ValueError(f"Unknown listing mode: {listing_mode}")
+
+    watermark = watermark or {}
+
+    if listing_mode == 'start_after' and watermark.get('last_key'):
+        files = bucket.objects.filter(StartAfter=watermark['last_key'])
+    else:
+        files = bucket.objects.all()
+
+    # Files modified in the same second as the watermark are listed again; the hash check drops those already stored
+    modified_since = watermark.get('last_modified') if listing_mode == 'last_modified' else None
+
+    files = iter(files)
+    listing_seconds = 0.0
+
+    while True:
+        # Only the time spent waiting on S3 counts towards the list stage, not the time the caller spends on each file
+        started = time.perf_counter()
+        file = next(files, None)
+        listing_seconds += time.perf_counter() - started
+
+        if file is None:
+            break
+
+        metrics.increment('documents_listed')
+
+        if next_watermark is not None:
+            if next_watermark.get('last_key') is None or file.key > next_watermark['last_key']:
+                next_watermark['last_key'] = file.key
+            if next_watermark.get('last_modified') is None or file.last_modified > next_watermark['last_modified']:
+                next_watermark['last_modified'] = file.last_modified
+
+        if modified_since is not None and file.last_modified < modified_since:
+            continue
+
+        yield S3Document(file.key, file.e_tag.replace('"', ""), file.last_modified, file.size)
+
+    metrics.observe('list', listing_seconds)
+
+def fetch_existing_hashes(connection, schema_name, table_name, candidate_hashes=None):
+    """
+    Loads the file hashes already stored in the target table in a single query.
+
+    This replaces one SELECT EXISTS round trip per S3 object with one set-based lookup per run, 
+    so a run over a bucket where nothing has changed costs one query instead of one query per file.
+
+    Required:
+    - import psycopg2
+
+    Parameters:
+    - connection (psycopg2.extensions.connection): The database connection object.
+    - schema_name (str): The name of the schema where the table resides.
+    - table_name (str): The name of the table holding the extracted documents.
+    - candidate_hashes (list, optional): Only look these hashes up, instead of loading every hash in the table. 
+      Used by the incremental listing modes, where the handful of listed files is much smaller than the table.
+
+    Returns:
+    - known_hashes (set): The distinct file_hash values present in the table (among the candidates, if given).
+
+    Notes:
+    - A named (server-side) cursor is used so the hashes are streamed in chunks instead of being materialised twice in memory.
+    - An ETag is 32-34 characters long, so even a few million known documents fit comfortably in a Python set.
+
+    """
+    known_hashes = set()
+
+    if candidate_hashes is not None and not candidate_hashes:
+        return known_hashes
+
+    with connection.cursor(name=f"{table_name}_existing_hashes") as cursor:
+        cursor.itersize = 10000
+        if candidate_hashes is None:
+            cursor.execute("""SELECT DISTINCT file_hash FROM {}.{};""".format(schema_name, table_name))
+        else:
+            cursor.execute("""SELECT DISTINCT file_hash FROM {}.{} WHERE file_hash = ANY(%s);""".format(schema_name, table_name), (list(candidate_hashes),))
+        for (file_hash,) in cursor:
+            known_hashes.add(file_hash)
+
+    return known_hashes
+
+def list_new_documents(documents, known_hashes, metrics=NULL_METRICS):
+    """
+    Filters listed files down to those whose content is not yet stored in the database.
+
+    Parameters:
+    - documents (iterable of S3Document): The listed files, as yielded by list_bucket_documents.
+    - known_hashes (set): File hashes already stored in the database, as returned by fetch_existing_hashes.
+      The set is updated in place as new files are yielded, so a file that appears twice in the bucket 
+      under different keys is only yielded once, exactly as the per-file lookups used to behave.
+    - metrics (PipelineMetrics, optional): Counts the files skipped because their content is already stored.
+
+    Yields:
+    - S3Document: Every new file, in listing order.
+
+    """
+    for document in documents:
+        if document.e_tag not in known_hashes:
+            known_hashes.add(document.e_tag)
+            yield document
+        else:
+            metrics.increment('documents_skipped_existing')
+
+# %%
+def download_s3_file(s3_connection_function, bucket_name, document,
+                     spool_threshold=SPOOL_THRESHOLD_BYTES, max_document_bytes=MAX_DOCUMENT_BYTES, metrics=NULL_METRICS):
+    """
+    Downloads a single file from an S3 bucket, keeping memory use bounded.
+
+    The file is streamed in chunks. Small files are kept in memory, while files larger than spool_threshold 
+    are spooled to a temporary file on disk, so a large scanned PDF never has to sit in a worker's memory as one block of bytes.
+    The download goes through the low-level boto3 client rather than the resource API, 
+    because boto3 clients are thread-safe while resources are not. This lets a thread pool share one S3 connection.
+
+    Required:
+    - import tempfile
+
+    Parameters:
+    - s3_connection_function (boto3.resources.factory.s3.ServiceResource): A connected S3 resource.
+    - bucket_name (str): The name of the S3 bucket containing the file.
+    - document (S3Document): The file to download.
+    - spool_threshold (int): Size in bytes above which the file is spooled to disk. Defaults to SPOOL_THRESHOLD_BYTES.
+    - max_document_bytes (int): Size in bytes above which the download is abandoned. None means no limit. Defaults to MAX_DOCUMENT_BYTES.
+    - metrics (PipelineMetrics, optional): Records the download time (the 'download' stage), the bytes downloaded and the files skipped.
+
+    Returns:
+    - tuple: The document and its content, ready to be handed to extract_text_from_s3_files. 
+      The content is bytes for small files, the path of a temporary file for spooled files, 
+      or None if the file is larger than max_document_bytes.
+
+    Notes:
+    - The caller owns the temporary file and should remove it once the text is extracted (see release_downloaded_file).
+
+    """
+    if max_document_bytes is not None and document.size is not None and document.size > max_document_bytes:
+        print(f"Skipping file: {document.key} ({document.size} bytes exceeds the limit of {max_document_bytes} bytes)")
+        metrics.increment('documents_skipped_too_large')
+        return document, None
+
+    with metrics.stage('download'):
+        document, cv_file, downloaded_bytes = _stream_s3_file(s3_connection_function, bucket_name, document, spool_threshold, max_document_bytes)
+    metrics.increment('bytes_downloaded', downloaded_bytes)
+
+    if cv_file is None:
+        print(f"Skipping file: {document.key} (more than {max_document_bytes} bytes)")
+        metrics.increment('documents_skipped_too_large')
+    else:
+        metrics.increment('documents_downloaded')
+
+    return document, cv_file
+
+def _stream_s3_file(s3_connection_function, bucket_name, document, spool_threshold, max_document_bytes):
+    """ Streams a file from S3 into memory or a spool file. Returns the document, its content (None if too large) and the bytes read. """
+    response = s3_connection_function.meta.client.get_object(Bucket=bucket_name, Key=document.key)
+
+    buffer = BytesIO()
+    spool_file = None
+    downloaded_bytes = 0
+    too_large = False
+    completed = False
+
+    try:
+        for chunk in response['Body'].iter_chunks(chunk_size=DOWNLOAD_CHUNK_BYTES):
+            downloaded_bytes += len(chunk)
+
+            # The size from the listing can be stale if the file was replaced in the meantime
+            if max_document_bytes is not None and downloaded_bytes > max_document_bytes:
+                too_large = True
+                response['Body'].close()
+                break
+
+            if spool_file is None and downloaded_bytes > spool_threshold:
+                spool_file = tempfile.NamedTemporaryFile(prefix='s3_ingestion_', delete=False)
+                spool_file.write(buffer.getvalue())
+                buffer = None
+
+            (spool_file or buffer).write(chunk)
+
+        completed = not too_large
+
+    finally:
+        if spool_file is not None:
+            spool_file.close()
+            # Do not leave partial or unusable downloads behind on disk
+            if not completed:
+                release_downloaded_file(spool_file.name)
+
+    if too_large:
+        return document, None, downloaded_bytes
+
+    if spool_file is not None:
+        return document, spool_file.name, downloaded_bytes
+
+    return document, buffer.getvalue(), downloaded_bytes
+
+def release_downloaded_file(cv_file):
+    """ Removes the temporary file a download was spooled to, if any. In-memory downloads need no clean up. """
+    if isinstance(cv_file, str) and os.path.exists(cv_file):
+        os.remove(cv_file)
+
+def _parse_document(downloaded_document, max_pages=MAX_DOCUMENT_PAGES):
+    """
+    Process pool entry point: unpacks a (document, content) pair, extracts its text and removes any spooled file.
+
+    Returns the document, its text (None if it was skipped) and the parse statistics ({'pages': ..., 'seconds': ...}).
+    The statistics travel back with the result because a worker process cannot record into the parent's PipelineMetrics.
+
+    """
+    document, cv_file = downloaded_document
+    stats = {'pages': 0, 'seconds': 0.0}
+    if cv_file is None:
+        return document, None, stats
+
+    started = time.perf_counter()
+    try:
+        pagewise_content = extract_text_from_s3_files(document, cv_file, max_pages=max_pages, stats=stats)
+    finally:
+        release_downloaded_file(cv_file)
+    stats['seconds'] = time.perf_counter() - started
+
+    return document, pagewise_content, stats
+
+def _record_parse(metrics, stats):
+    """ Records the statistics returned by _parse_document. """
+    metrics.observe('parse', stats['seconds'])
+    metrics.increment('pages_parsed', stats['pages'])
+
+def _bounded_map(executor, function, iterable, window, skip=None):
+    """
+    Lazily maps a function over an iterable on an executor, keeping at most `window` tasks in flight.
+
+    Results are yielded in the same order as the input, which keeps the parallel path's output identical to the serial path.
+    Because the iterable is only consumed as slots free up, chaining two calls (e.g. downloads feeding parsing) 
+    forms a pipeline whose memory use is bounded by the window sizes rather than by the size of the bucket.
+    Items for which skip(item) is true are not submitted: they are yielded as they are, in their place in the order.
+
+    """
+    pending = deque()
+    for item in iterable:
+        if skip is not None and skip(item):
+            skipped = Future()
+            skipped.set_result(item)
+            pending.append(skipped)
+        else:
+            pending.append(executor.submit(function, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+
+    while pending:
+        yield pending.popleft().result()
+
+# %%
+class ExtractedContentWriter:
+    """
+    Buffered writer for the extracted_content table.
+
+    Rows are accumulated in memory and flushed with a single multi-row INSERT (psycopg2's execute_values) 
+    and a single commit per batch, instead of one INSERT and one commit (and fsync) per document.
+
+    Required:
+    - import psycopg2
+    - from psycopg2.extras import execute_values
+
+    Parameters:
+    - connection (psycopg2.extensions.connection): The database connection object used to write the rows.
+    - schema_name (str): The name of the schema where the table resides.
+    - table_name (str): The name of the table the rows are written to.
+    - batch_size (int): Number of rows buffered before they are flushed. Defaults to 100.
+    - metrics (PipelineMetrics, optional): Records the time of each flush (the 'insert' stage) and the documents written.
+
+    Usage:
+        with ExtractedContentWriter(connection, 'documents', 'extracted_content', batch_size=500) as writer:
+            writer.add(document, pagewise_content)
+
+    Notes:
+    - Each batch is written in its own transaction. If a flush fails, the transaction is rolled back and the error is raised, 
+      so a batch is either fully stored or not stored at all.
+    - The INSERT skips rows whose file_hash is already in the table. Together with the all-or-nothing batches, 
+      this makes it safe to simply re-run the script after a partial failure: stored documents are skipped 
+      and the failed batch is picked up again, without ever writing duplicates.
+    - Leaving the `with` block flushes the remaining rows. If the block exits because of an error, 
+      the rows already buffered are still flushed, so work completed before the failure is kept.
+
+    """
+    def __init__(self, connection, schema_name, table_name, batch_size=100, metrics=NULL_METRICS):
+        self.connection = connection
+        self.schema_name = schema_name
+        self.table_name = table_name
+        self.batch_size = batch_size
+        self.metrics = metrics
+        self.rows = []
+        self.rows_written = 0
+
+        self.insert_query = """INSERT INTO {0}.{1} (file_hash, document_name, creation_date, document_text)
+                                SELECT v.file_hash, v.document_name, v.creation_date, v.document_text
+                                FROM (VALUES %s) AS v (file_hash, document_name, creation_date, document_text)
+                                WHERE NOT EXISTS (SELECT 1 FROM {0}.{1} AS t WHERE t.file_hash = v.file_hash);""".format(schema_name, table_name)
+
+    def add(self, document, pagewise_content):
+        """ Buffers one document and flushes the buffer once it holds batch_size rows. """
+        self.rows.append((document.e_tag, document.key, document.last_modified, pagewise_content))
+
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """ Writes the buffered rows in one statement and commits them in one transaction. """
+        if not self.rows:
+            return
+
+        try:
+            with self.metrics.stage('insert'):
+                with self.connection.cursor() as cursor:
+                    execute_values(cursor, self.insert_query, self.rows, page_size=len(self.rows))
+                self.connection.commit()
+        except Exception:
+            # Discard the failed batch: none of it was stored, so the next run picks these files up again
+            self.connection.rollback()
+            self.rows = []
+            raise
+
+        self.rows_written += len(self.rows)
+        self.metrics.increment('documents_written', len(self.rows))
+        print(f"{len(self.rows)} file contents successfully added to the table: {self.table_name} in the schema: {self.schema_name}")
+        self.rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+        return False
+
+# %%
+def _lookup_cached_documents(new_documents, extraction_cache, max_pages, metrics=NULL_METRICS):
+    """
+    Yields the documents in listing order: as a CachedDocument when their text is in the extraction cache,
+    otherwise as they are, to be downloaded and parsed.
+
+    """
+    for document in new_documents:
+        pagewise_content = extraction_cache.get(document.e_tag, max_pages) if extraction_cache else None
+
+        if pagewise_content is None:
+            yield document
+        else:
+            metrics.increment('documents_from_cache')
+            yield CachedDocument(document, pagewise_content)
+
+def _cache_extracted_document(extraction_cache, document, pagewise_content, max_pages):
+    """ Stores freshly extracted text in the extraction cache, unless there is no cache or the extraction failed. """
+    if extraction_cache and not _extraction_failed(document, pagewise_content):
+        extraction_cache.put(document.e_tag, pagewise_content, max_pages)
+
+def _process_documents_serially(s3_connection_function, bucket_name, connection, schema_name, table_name, new_documents,
+                                insert_batch_size, max_document_bytes, max_pages, extraction_cache, metrics):
+    """
+    Serial mode of process_documents: downloads, parses and writes the new documents one after the other.
+
+    """
+    with ExtractedContentWriter(connection, schema_name, table_name, batch_size=insert_batch_size, metrics=metrics) as writer:
+        for document in _lookup_cached_documents(new_documents, extraction_cache, max_pages, metrics=metrics):
+            if isinstance(document, CachedDocument):
+                writer.add(*document)
+                continue
+
+            # Extract text from document
+            # Get the PDF file from the S3 bucket
+            _, cv_file = download_s3_file(s3_connection_function, bucket_name, document,
+                                          max_document_bytes=max_document_bytes, metrics=metrics)
+            _, pagewise_content, parse_stats = _parse_document((document, cv_file), max_pages=max_pages)
+            _record_parse(metrics, parse_stats)
+
+            # Files skipped for being too large have no content and are not recorded
+            if pagewise_content is None:
+                continue
+
+            # Buffer the row; the writer inserts and commits it with the rest of its batch
+            writer.add(document, pagewise_content)
+            _cache_extracted_document(extraction_cache, document, pagewise_content, max_pages)
+
+def _process_documents_in_parallel(s3_connection_function, bucket_name, connection, schema_name, table_name, new_documents,
+                                   download_workers, parse_workers, insert_batch_size, max_document_bytes, max_pages, extraction_cache, metrics):
+    """
+    Parallel mode of process_documents.
+
+    - The files to process (new_documents) are selected by the caller, against the set of known hashes (see list_new_documents).
+    - A thread pool downloads files from S3, as downloads spend most of their time waiting on network I/O.
+    - A process pool runs extract_text_from_s3_files, as PDF parsing is CPU bound and would otherwise be limited to one core.
+    - The calling thread is the single writer: it hands the parsed documents to an ExtractedContentWriter, 
+      which inserts and commits them in batches. Documents found in the extraction cache skip the download and parse pools,
+      but keep their place in the pipeline.
+
+    Files are written in listing order and files sharing an ETag within the same run are only written once, 
+    so the table ends up with exactly the rows the serial path would produce.
+
+    """
+    is_cached = lambda item: isinstance(item, CachedDocument)
+
+    with ThreadPoolExecutor(max_workers=download_workers) as download_pool, \
+         ProcessPoolExecutor(max_workers=parse_workers) as parse_pool, \
+         ExtractedContentWriter(connection, schema_name, table_name, batch_size=insert_batch_size, metrics=metrics) as writer:
+
+        downloads = _bounded_map(download_pool,
+                                 lambda document: download_s3_file(s3_connection_function, bucket_name, document,
+                                                                   max_document_bytes=max_document_bytes, metrics=metrics),
+                                 _lookup_cached_documents(new_documents, extraction_cache, max_pages, metrics=metrics),
+                                 window=download_workers * 2, skip=is_cached)
+        parsed_documents = _bounded_map(parse_pool, partial(_parse_document, max_pages=max_pages), downloads,
+                                        window=parse_workers * 2, skip=is_cached)
+
+        for parsed_document in parsed_documents:
+            if is_cached(parsed_document):
+                writer.add(*parsed_document)
+                continue
+
+            document, pagewise_content, parse_stats = parsed_document
+            _record_parse(metrics, parse_stats)
+
+            # Files skipped for being too large have no content and are not recorded
+            if pagewise_content is not None:
+                writer.add(document, pagewise_content)
+                _cache_extracted_document(extraction_cache, document, pagewise_content, max_pages)
+
+# %%
+def process_documents(s3_connection_function, bucket_name, database_connection_function, schema_name, table_name,
+                      download_workers=None, parse_workers=None, insert_batch_size=100,
+                      max_document_bytes=MAX_DOCUMENT_BYTES, max_pages=MAX_DOCUMENT_PAGES, listing_mode='full', extraction_cache=None,
+                      metrics=None):
     """
     Adds unique text content extracted from files in an S3 bucket to a PostgreSQL database.
 
@@ -272,6 +1134,10 @@ def process_documents(s3_connection_function, bucket_name, database_connection_f
     - Function: s3_connection_function - Function to establish a connection to the S3 bucket.
     - Function: database_connection_function - Function to establish a connection to the PostgreSQL database.
     - Function: extract_text_from_s3_files - Function to extract text content from PDF or DOCX files.
+    - Function: list_bucket_documents, fetch_existing_hashes, list_new_documents - Functions to select the files not yet in the database.
+    - Function: load_listing_watermark, save_listing_watermark - Functions to persist how far the bucket has been processed.
+    - Class: ExtractedContentWriter - Buffered writer used to insert the extracted text in batches.
+    - Class: ExtractionCache (optional) - Local cache of extracted text, keyed by ETag.
 
     Parameters:
     - s3_connection_function (function): A function that returns a connected S3 resource.
@@ -279,63 +1145,109 @@ def process_documents(s3_connection_function, bucket_name, database_connection_f
     - database_connection_function (psycopg2.extensions.connection): A function that returns a connection to the PostgreSQL database.
     - schema_name (str): The name of the schema where the table resides.
     - table_name (str): The name of the table to check for existing records and insert new ones.
+    - download_workers (int, optional): Number of threads downloading files from S3. Setting this (or parse_workers) switches on the parallel mode.
+    - parse_workers (int, optional): Number of processes extracting text from the downloaded files. Setting this (or download_workers) switches on the parallel mode.
+    - insert_batch_size (int): Number of documents inserted per commit. Defaults to 100.
+    In parallel mode, any worker count left unset defaults to the number of CPUs on the machine.
+    - max_document_bytes (int): Files larger than this are skipped and left out of the table. None means no limit. Defaults to MAX_DOCUMENT_BYTES.
+    - max_pages (int): Maximum number of pages (or DOCX paragraphs) extracted per document. None means no limit. Defaults to MAX_DOCUMENT_PAGES.
+    - listing_mode (str): 'full' (default) lists the whole bucket. 'start_after' and 'last_modified' only consider 
+      the files added or changed since the previous completed run (see list_bucket_documents).
+    - extraction_cache (ExtractionCache, optional): A local cache of extracted text consulted before downloading and parsing a file.
+    - metrics (PipelineMetrics, optional): Collects the time spent in each stage (list, hash_check, download, parse, insert, total) 
+      and counters such as bytes downloaded and documents skipped. Instrumentation is off when not given.
 
     Returns:
     - None: The function does not return a value, but it prints messages indicating the status of the operations performed.
 
     Process:
-    1. The function connects to the specified S3 bucket and iterates through each file.
-    2. For each file, it calculates a unique hash (ETag) and checks if this hash already exists in the database.
-    3. If the hash is not found in the database, the function extracts text from the file and inserts the content along with metadata into the specified database table.
-    4. The function also queries and displays the last 5 records from the table, ordered by creation date.
+    1. The function lists the S3 bucket, in full or from the watermark left by the previous run, depending on listing_mode.
+    2. It loads the hashes of the documents already in the table in one query (fetch_existing_hashes) 
+       and keeps only the files whose unique hash (ETag) is not among them, so only new files are downloaded.
+    3. If the hash is not found in the database, the function takes the text from the extraction cache (if any) or extracts text from the file and inserts the content along with metadata into the specified database table.
+    4. Once every file has been written, the listing watermark is advanced for the next run.
+    5. The function also queries and displays the last 5 records from the table, ordered by creation date.
 
     Notes:
     - The function assumes that the database table has columns named 'file_hash', 'document_name', 'creation_date', and 'document_text'.
     - If a file's content already exists in the database (based on the hash), it is skipped.
-    - The function commits the changes to the database after each insertion. 
+    - Files are streamed from S3 and large files are spooled to disk (see download_s3_file), so memory use does not grow with file size.
+      Skipped oversized files are not recorded, so they are reconsidered on the next full run (e.g. after raising the limit).
+    - The watermark is recorded in every mode, so a bucket loaded once in full can be followed by incremental runs.
+    - The function commits the changes to the database after each batch of insert_batch_size documents. 
+      A failed batch is rolled back as a whole, so the script can be re-run safely after a partial failure.
+    - Both modes produce the same rows. The parallel mode only changes how the work is scheduled (see _process_documents_in_parallel).
+    - In parallel mode the stages overlap, so their times add up to more than the total: compare each stage's time with the total 
+      to find the bottleneck, rather than summing them.
 
     """
+    metrics = metrics or NULL_METRICS
+    with metrics.stage('total'):
+        _process_bucket(s3_connection_function, bucket_name, database_connection_function, schema_name, table_name,
+                        download_workers, parse_workers, insert_batch_size, max_document_bytes, max_pages, listing_mode,
+                        extraction_cache, metrics)
+
+    # View the table to confirm output
+    query = f"SELECT * FROM {schema_name}.{table_name} ORDER BY creation_date DESC LIMIT 5"
+    return pd.read_sql_query(query, database_connection_function)
+
+def _process_bucket(s3_connection_function, bucket_name, database_connection_function, schema_name, table_name,
+                    download_workers, parse_workers, insert_batch_size, max_document_bytes, max_pages, listing_mode,
+                    extraction_cache, metrics):
+    """ Body of process_documents: lists the bucket, selects the new files, processes them and advances the watermark. """
     bucket = s3_connection_function.Bucket(bucket_name)
     connection = database_connection_function
 
     ensure_table_exists(connection, schema_name, table_name)
 
-    for file in bucket.objects.all():
-        cv_file_hash = file.e_tag.replace('"', "")
-
-        with connection.cursor() as cursor:
-            cursor.execute("""SELECT EXISTS(SELECT 1 FROM {}.{} WHERE {} = '{}');""".format(schema_name, table_name, "file_hash", cv_file_hash))
-
-            record_exists = cursor.fetchone()[0]
-            # print(record_exists)
-
-            if not record_exists:
-                # Extract text from document
-                # Get the PDF file from the S3 bucket
-                cv_file = s3_connection_function.Object(bucket_name, file.key).get()['Body'].read()
-                cv_title = file.key
-                updated_at = file.last_modified
-                pagewise_content = extract_text_from_s3_files(file, cv_file)
-
-                 # Insert data into the database
-                insert_query = """INSERT INTO {}.{} (file_hash, document_name, creation_date, document_text) 
-                                    VALUES (%s, %s, %s, %s) RETURNING *;""".format(schema_name, table_name)
-                cursor.execute(insert_query, (cv_file_hash, cv_title, updated_at, pagewise_content))
-                
-                
-                # Make the changes to the database persistent
-                connection.commit()
-                print(f"File content successfully added to the table: {table_name} in the schema: {schema_name}")
-            
-            elif record_exists:
-                continue
+    watermark = load_listing_watermark(connection, schema_name, table_name, bucket_name) if listing_mode != 'full' else None
+    next_watermark = {}
+    documents = list_bucket_documents(bucket, listing_mode=listing_mode, watermark=watermark, next_watermark=next_watermark,
+                                      metrics=metrics)
+
+    if watermark:
+        # An incremental listing is small, so look up only its hashes instead of loading every hash in the table
+        documents = list(documents)
+        with metrics.stage('hash_check'):
+            known_hashes = fetch_existing_hashes(connection, schema_name, table_name,
+                                                 candidate_hashes=[document.e_tag for document in documents])
+    else:
+        with metrics.stage('hash_check'):
+            known_hashes = fetch_existing_hashes(connection, schema_name, table_name)
+
+    new_documents = list_new_documents(documents, known_hashes, metrics=metrics)
+
+    if download_workers or parse_workers:
+        _process_documents_in_parallel(s3_connection_function, bucket_name, connection, schema_name, table_name, new_documents,
+                                       download_workers=download_workers or os.cpu_count(),
+                                       parse_workers=parse_workers or os.cpu_count(),
+                                       insert_batch_size=insert_batch_size,
+                                       max_document_bytes=max_document_bytes,
+                                       max_pages=max_pages,
+                                       extraction_cache=extraction_cache,
+                                       metrics=metrics)
+    else:
+        _process_documents_serially(s3_connection_function, bucket_name, connection, schema_name, table_name, new_documents,
+                                    insert_batch_size=insert_batch_size,
+                                    max_document_bytes=max_document_bytes,
+                                    max_pages=max_pages,
+                                    extraction_cache=extraction_cache,
+                                    metrics=metrics)
 
-    # View the table to confirm output
-    query = f"SELECT * FROM {schema_name}.{table_name} ORDER BY creation_date DESC LIMIT 5"
-    return pd.read_sql_query(query, connection)
+    # Every listed file is now stored (or deliberately skipped), so the next run can start from here
+    save_listing_watermark(connection, schema_name, table_name, bucket_name, next_watermark)
 
 if __name__ == "__main__":
     s3 = connect_to_s3_bucket('bucket-name')
     db = connect_to_database()
     if s3 and db:
-        process_documents(s3, 'bucket-name', db, 'documents', 'extracted_content')
\ No newline at end of file
+        metrics = PipelineMetrics() if METRICS_FILE else None
+        process_documents(s3, 'bucket-name', db, 'documents', 'extracted_content',
+                          download_workers=int(os.getenv('S3_DOWNLOAD_WORKERS', 0)),
+                          parse_workers=int(os.getenv('S3_PARSE_WORKERS', 0)),
+                          insert_batch_size=int(os.getenv('S3_INSERT_BATCH_SIZE', 100)),
+                          listing_mode=os.getenv('S3_LISTING_MODE', 'full'),
+                          extraction_cache=ExtractionCache(EXTRACTION_CACHE_DIR) if EXTRACTION_CACHE_DIR else None,
+                          metrics=metrics)
+        if metrics:
+            metrics.write(METRICS_FILE)
\ No newline at end of file
@@ -0,0 +1,326 @@
+import os
+import asyncio
+import importlib
+import tempfile
+from io import BytesIO
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+import asyncpg
+from aiobotocore.session import get_session
+from aiobotocore.config import AioConfig
+from dotenv import load_dotenv
+
+# The asynchronous pipeline shares its document model, text extraction and extraction cache with the synchronous script.
+# The module name starts with a digit, so it cannot be imported with a plain import statement.
+s3_ingestion = importlib.import_module('1_extract_s3_data')
+
+# Marks the end of the work on a queue
+_END_OF_QUEUE = object()
+
+async def connect_to_database_async():
+    """
+    Establishes an asynchronous connection to a PostgreSQL database.
+
+    This is the asyncpg counterpart of connect_to_database in 1_extract_s3_data.py, and reads the same variables from the .env file.
+
+    Required:
+    - import asyncpg
+    - import os
+    - from dotenv import load_dotenv
+    - .env file in project directory
+
+    Parameters:
+    All parameters are harvested from a .env file attached to the project.
+    - host (str) ["POSTGRES_ADDRESS"]: The host of the database.
+    - dbname (str) ["DATABASE"]: The name of the database.
+    - user (str) ["POSTGRES_USERNAME"]: The username used to authenticate with the database.
+    - password (str) ["POSTGRES_PASSWORD"]: The password used to authenticate with the database.
+    - port (str) ["POSTGRES_PORT"]: The port of the database. Defaults to 5432.
+
+    Returns:
+    connection (asyncpg.Connection): A connection object that represents the database connection.
+    If the connection fails, the function will print an error message and return None.
+
+    """
+    try:
+        load_dotenv()
+
+        connection = await asyncpg.connect(database=os.getenv("DATABASE"),
+                                           user=os.getenv("POSTGRES_USERNAME"),
+                                           host=os.getenv("POSTGRES_ADDRESS"),
+                                           password=os.getenv("POSTGRES_PASSWORD"),
+                                           port=int(os.getenv("POSTGRES_PORT", 5432)))
+        print("Connection to Database Successful")
+
+        return connection
+
+    except Exception as e:
+        print("An error occurred:", e)
+        return None
+
+def create_s3_client_async(max_pool_connections):
+    """
+    Creates an asynchronous S3 client context.
+
+    The client reads the same variables from the .env file as connect_to_s3_bucket in 1_extract_s3_data.py.
+    Setting S3_ENDPOINT_URL points the client at an S3 stand-in instead of AWS,
+    e.g. a local moto server (`moto_server -p 5000` and S3_ENDPOINT_URL=http://localhost:5000) or MinIO.
+
+    Required:
+    - from aiobotocore.session import get_session
+
+    Parameters:
+    - max_pool_connections (int): The size of the client's HTTP connection pool. It should match the number of concurrent downloads.
+
+    Returns:
+    An async context manager yielding an aiobotocore S3 client. Use it as `async with create_s3_client_async(64) as s3_client:`.
+
+    """
+    session = get_session()
+
+    return session.create_client('s3',
+                                 aws_access_key_id=os.getenv('ACCESS_KEY'),
+                                 aws_secret_access_key=os.getenv('SECRET_KEY'),
+                                 region_name=os.getenv('REGION'),
+                                 endpoint_url=os.getenv('S3_ENDPOINT_URL'),
+                                 config=AioConfig(max_pool_connections=max_pool_connections))
+
+async def ensure_table_exists_async(connection, schema_name, table_name):
+    """ Creates the schema and the extracted content table if they do not exist, with the same columns as ensure_table_exists. """
+    await connection.execute(f"CREATE SCHEMA IF NOT EXISTS {schema_name};")
+    await connection.execute(f"""CREATE TABLE IF NOT EXISTS {schema_name}.{table_name} (file_hash varchar(64), document_name varchar(64), creation_date TIMESTAMP, document_text TEXT)""")
+
+# %%
+async def _list_stage(s3_client, bucket_name, known_hashes, fetch_queue):
+    """
+    List stage: pages through the bucket and queues every file whose hash is not yet in the database.
+
+    The listing only runs ahead of the downloads by the size of the fetch queue, after which it waits for room (backpressure).
+
+    """
+    paginator = s3_client.get_paginator('list_objects_v2')
+
+    async for page in paginator.paginate(Bucket=bucket_name):
+        for file in page.get('Contents', []):
+            document = s3_ingestion.S3Document(file['Key'], file['ETag'].replace('"', ""), file['LastModified'], file['Size'])
+
+            # Same rule as list_new_documents: known hashes, and hashes already queued in this run, are skipped
+            if document.e_tag not in known_hashes:
+                known_hashes.add(document.e_tag)
+                await fetch_queue.put(document)
+
+async def _fetch_stage(s3_client, bucket_name, fetch_queue, extract_queue, write_queue, extraction_cache, max_document_bytes, max_pages):
+    """
+    Fetch stage: downloads queued files, keeping small files in memory and spooling large files to a temporary file.
+
+    Files found in the extraction cache skip the download and go straight to the write stage.
+    Files larger than max_document_bytes are skipped, as in download_s3_file.
+
+    """
+    loop = asyncio.get_running_loop()
+
+    while True:
+        document = await fetch_queue.get()
+        if document is _END_OF_QUEUE:
+            return
+
+        if extraction_cache is not None:
+            pagewise_content = await loop.run_in_executor(None, extraction_cache.get, document.e_tag, max_pages)
+            if pagewise_content is not None:
+                await write_queue.put((document, pagewise_content, False))
+                continue
+
+        if max_document_bytes is not None and document.size > max_document_bytes:
+            print(f"Skipping file: {document.key} ({document.size} bytes exceeds the limit of {max_document_bytes} bytes)")
+            continue
+
+        response = await s3_client.get_object(Bucket=bucket_name, Key=document.key)
+
+        buffer = BytesIO()
+        spool_file = None
+        try:
+            async with response['Body'] as stream:
+                while True:
+                    chunk = await stream.read(s3_ingestion.DOWNLOAD_CHUNK_BYTES)
+                    if not chunk:
+                        break
+
+                    if spool_file is None and buffer.tell() + len(chunk) > s3_ingestion.SPOOL_THRESHOLD_BYTES:
+                        spool_file = tempfile.NamedTemporaryFile(prefix='s3_ingestion_', delete=False)
+                        spool_file.write(buffer.getvalue())
+                        buffer = None
+
+                    (spool_file or buffer).write(chunk)
+
+        except BaseException:
+            # Do not leave partial downloads behind on disk, including when the pipeline is cancelled
+            if spool_file is not None:
+                spool_file.close()
+                s3_ingestion.release_downloaded_file(spool_file.name)
+            raise
+
+        if spool_file is not None:
+            spool_file.close()
+            await extract_queue.put((document, spool_file.name))
+        else:
+            await extract_queue.put((document, buffer.getvalue()))
+
+async def _extract_stage(parse_pool, extract_queue, write_queue, max_pages):
+    """
+    Extract stage: hands downloaded files to the process pool for text extraction, so parsing never blocks the event loop.
+
+    """
+    loop = asyncio.get_running_loop()
+    parse_document = partial(s3_ingestion._parse_document, max_pages=max_pages)
+
+    while True:
+        downloaded_document = await extract_queue.get()
+        if downloaded_document is _END_OF_QUEUE:
+            return
+
+        document, pagewise_content, _ = await loop.run_in_executor(parse_pool, parse_document, downloaded_document)
+        await write_queue.put((document, pagewise_content, True))
+
+async def _write_stage(connection, schema_name, table_name, write_queue, extraction_cache, insert_batch_size, max_pages):
+    """
+    Write stage: the single writer. Inserts extracted documents in batches of insert_batch_size, one transaction per batch.
+
+    As with ExtractedContentWriter, rows whose file_hash is already in the table are skipped
+    and a failed batch is rolled back as a whole, so the pipeline can simply be re-run after a failure.
+
+    """
+    loop = asyncio.get_running_loop()
+    insert_query = """INSERT INTO {0}.{1} (file_hash, document_name, creation_date, document_text)
+                      SELECT v.file_hash, v.document_name, v.creation_date, v.document_text
+                      FROM unnest($1::text[], $2::text[], $3::timestamptz[], $4::text[]) AS v (file_hash, document_name, creation_date, document_text)
+                      WHERE NOT EXISTS (SELECT 1 FROM {0}.{1} AS t WHERE t.file_hash = v.file_hash);""".format(schema_name, table_name)
+    rows = []
+
+    async def flush():
+        if not rows:
+            return
+
+        async with connection.transaction():
+            await connection.execute(insert_query, *[list(column) for column in zip(*rows)])
+
+        print(f"{len(rows)} file contents successfully added to the table: {table_name} in the schema: {schema_name}")
+        rows.clear()
+
+    while True:
+        item = await write_queue.get()
+        if item is _END_OF_QUEUE:
+            await flush()
+            return
+
+        document, pagewise_content, freshly_extracted = item
+
+        # Files skipped for being too large have no content and are not recorded
+        if pagewise_content is None:
+            continue
+
+        rows.append((document.e_tag, document.key, document.last_modified, pagewise_content))
+
+        if freshly_extracted and extraction_cache is not None and not s3_ingestion._extraction_failed(document, pagewise_content):
+            await loop.run_in_executor(None, extraction_cache.put, document.e_tag, pagewise_content, max_pages)
+
+        if len(rows) >= insert_batch_size:
+            await flush()
+
+async def _close_queue_after(tasks, queue, consumers):
+    """ Waits for every producer of a queue to finish, then tells each of its consumers that no more work is coming. """
+    await asyncio.gather(*tasks)
+    for _ in range(consumers):
+        await queue.put(_END_OF_QUEUE)
+
+# %%
+async def process_documents_async(bucket_name, schema_name, table_name, fetch_concurrency=64, parse_workers=None, queue_size=256,
+                                  insert_batch_size=100, max_document_bytes=s3_ingestion.MAX_DOCUMENT_BYTES,
+                                  max_pages=s3_ingestion.MAX_DOCUMENT_PAGES, extraction_cache=None):
+    """
+    Adds unique text content extracted from files in an S3 bucket to a PostgreSQL database, using asyncio.
+
+    This is the asynchronous counterpart of process_documents in 1_extract_s3_data.py. It suits buckets holding many small files:
+    thousands of downloads can be in flight on a single core, instead of one per thread.
+
+    Required:
+    - Function: connect_to_database_async - Function to establish an asyncpg connection to the PostgreSQL database.
+    - Function: create_s3_client_async - Function to create an aiobotocore S3 client.
+    - Module: 1_extract_s3_data - Provides the text extraction, the size and page limits and the extraction cache.
+
+    Parameters:
+    - bucket_name (str): The name of the S3 bucket containing the files.
+    - schema_name (str): The name of the schema where the table resides.
+    - table_name (str): The name of the table to check for existing records and insert new ones.
+    - fetch_concurrency (int): Number of downloads in flight at once. Defaults to 64.
+    - parse_workers (int, optional): Number of processes extracting text. Defaults to the number of CPUs on the machine.
+    - queue_size (int): Capacity of each queue between two stages. Defaults to 256.
+    - insert_batch_size (int): Number of documents inserted per transaction. Defaults to 100.
+    - max_document_bytes (int): Files larger than this are skipped. None means no limit. Defaults to MAX_DOCUMENT_BYTES.
+    - max_pages (int): Maximum number of pages (or DOCX paragraphs) extracted per document. Defaults to MAX_DOCUMENT_PAGES.
+    - extraction_cache (ExtractionCache, optional): A local cache of extracted text consulted before downloading a file.
+
+    Returns:
+    - None: The function does not return a value, but it prints messages indicating the status of the operations performed.
+
+    Process:
+    The work flows through four stages connected by bounded queues:
+    1. list: pages through the bucket and drops files whose hash is already in the database (loaded once up front).
+    2. fetch: fetch_concurrency tasks download the files.
+    3. extract: one task per parse worker sends the downloaded files to a process pool for text extraction.
+    4. write: a single task inserts the documents in batches.
+    When a queue is full, the stage feeding it waits. Memory use is therefore bounded by the queue sizes, whatever the size of the bucket.
+
+    Notes:
+    - If any stage fails, the other stages are cancelled and the error is raised.
+      Batches already written stay in the table and are skipped by the next run.
+    - The incremental listing modes of the synchronous script are not available here; the bucket is always listed in full.
+    - For local testing, point S3_ENDPOINT_URL at a moto server (or MinIO) and the POSTGRES_* variables at a local PostgreSQL.
+
+    """
+    connection = await connect_to_database_async()
+    if connection is None:
+        return
+
+    parse_workers = parse_workers or os.cpu_count()
+
+    try:
+        await ensure_table_exists_async(connection, schema_name, table_name)
+        known_hashes = {record['file_hash'] for record in await connection.fetch(f"SELECT DISTINCT file_hash FROM {schema_name}.{table_name};")}
+
+        fetch_queue = asyncio.Queue(maxsize=queue_size)
+        extract_queue = asyncio.Queue(maxsize=queue_size)
+        write_queue = asyncio.Queue(maxsize=queue_size)
+
+        async with create_s3_client_async(max_pool_connections=fetch_concurrency) as s3_client:
+            with ProcessPoolExecutor(max_workers=parse_workers) as parse_pool:
+                lister = asyncio.ensure_future(_list_stage(s3_client, bucket_name, known_hashes, fetch_queue))
+                fetchers = [asyncio.ensure_future(_fetch_stage(s3_client, bucket_name, fetch_queue, extract_queue, write_queue,
+                                                               extraction_cache, max_document_bytes, max_pages))
+                            for _ in range(fetch_concurrency)]
+                extractors = [asyncio.ensure_future(_extract_stage(parse_pool, extract_queue, write_queue, max_pages))
+                              for _ in range(parse_workers)]
+                writer = asyncio.ensure_future(_write_stage(connection, schema_name, table_name, write_queue,
+                                                            extraction_cache, insert_batch_size, max_pages))
+
+                # Each queue is closed once every stage feeding it is done. Fetchers feed both the extract and the write queues.
+                tasks = [lister, *fetchers, *extractors, writer,
+                         asyncio.ensure_future(_close_queue_after([lister], fetch_queue, fetch_concurrency)),
+                         asyncio.ensure_future(_close_queue_after(fetchers, extract_queue, parse_workers)),
+                         asyncio.ensure_future(_close_queue_after(fetchers + extractors, write_queue, 1))]
+
+                try:
+                    await asyncio.gather(*tasks)
+                finally:
+                    for task in tasks:
+                        task.cancel()
+
+    finally:
+        await connection.close()
+
+if __name__ == "__main__":
+    load_dotenv()
+    asyncio.run(process_documents_async('bucket-name', 'documents', 'extracted_content',
+                                        fetch_concurrency=int(os.getenv('S3_FETCH_CONCURRENCY', 64)),
+                                        parse_workers=int(os.getenv('S3_PARSE_WORKERS', 0)) or None,
+                                        insert_batch_size=int(os.getenv('S3_INSERT_BATCH_SIZE', 100)),
+                                        extraction_cache=s3_ingestion.ExtractionCache(s3_ingestion.EXTRACTION_CACHE_DIR) if s3_ingestion.EXTRACTION_CACHE_DIR else None))
@@ -0,0 +1,411 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import importlib
+import resource
+import statistics
+import multiprocessing
+from queue import Empty
+from io import BytesIO
+from datetime import datetime
+from docx import Document
+from dotenv import load_dotenv
+from ingestion_connections import get_s3_resource
+
+# Benchmark harness for the S3 document ingestion.
+#
+# It generates a synthetic corpus of PDF and DOCX files of controlled sizes, uploads it to an S3 stand-in
+# (a local moto server or MinIO, set with S3_ENDPOINT_URL), runs process_documents against a local PostgreSQL
+# and reports documents/sec, bytes/sec, per-stage latency percentiles and peak RSS.
+# Every run is saved as a JSON file in the results directory and compared with the previous run.
+#
+# Usage (from the S3 Ingestion folder, with the Secure Data Ingestion folder on the PYTHONPATH):
+#   python benchmark_s3_ingestion.py --documents 500 --download-workers 8 --parse-workers 4
+
+s3_ingestion = importlib.import_module('1_extract_s3_data')
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'benchmark_results')
+
+# How often the parent checks that the pipeline process is still alive while waiting for its results
+PIPELINE_POLL_SECONDS = 5
+
+# %%
+def _pdf_text(text):
+    """ Escapes text for a PDF string literal. """
+    return text.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+
+def make_pdf(pages):
+    """
+    Builds a minimal, valid PDF document with one page per entry of `pages`.
+
+    Each entry is a list of text lines drawn in Helvetica, so pypdf can extract the text back.
+    The file is written by hand, rather than with a PDF library, to keep the benchmark free of extra dependencies.
+
+    Parameters:
+    - pages (list of list of str): The text lines of each page.
+
+    Returns:
+    - bytes: The content of the PDF file.
+
+    """
+    page_count = len(pages)
+    # Object numbers: 1 catalog, 2 page tree, 3 font, then one page object and one content stream per page
+    page_ids = [4 + 2 * index for index in range(page_count)]
+
+    objects = {1: b"<< /Type /Catalog /Pages 2 0 R >>",
+               2: f"<< /Type /Pages /Kids [{' '.join(f'{page_id} 0 R' for page_id in page_ids)}] /Count {page_count} >>".encode(),
+               3: b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"}
+
+    for page_id, lines in zip(page_ids, pages):
+        stream = "BT /F1 10 Tf 12 TL 50 800 Td " + " ".join(f"({_pdf_text(line)}) '" for line in lines) + " ET"
+        stream = stream.encode('latin-1', errors='replace')
+        objects[page_id] = (f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+                            f"/Resources << /Font << /F1 3 0 R >> >> /Contents {page_id + 1} 0 R >>").encode()
+        objects[page_id + 1] = b"<< /Length " + str(len(stream)).encode() + b" >>\nstream\n" + stream + b"\nendstream"
+
+    pdf = bytearray(b"%PDF-1.4\n")
+    offsets = {}
+    for object_id in sorted(objects):
+        offsets[object_id] = len(pdf)
+        pdf += f"{object_id} 0 obj\n".encode() + objects[object_id] + b"\nendobj\n"
+
+    xref_offset = len(pdf)
+    pdf += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    for object_id in sorted(objects):
+        pdf += f"{offsets[object_id]:010d} 00000 n \n".encode()
+    pdf += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref_offset}\n%%EOF\n".encode()
+
+    return bytes(pdf)
+
+def make_docx(paragraphs):
+    """ Builds a DOCX document with one paragraph per entry of `paragraphs`, using python-docx. """
+    document = Document()
+    for paragraph in paragraphs:
+        document.add_paragraph(paragraph)
+
+    docx_file = BytesIO()
+    document.save(docx_file)
+    return docx_file.getvalue()
+
+def generate_corpus(documents, pdf_ratio, min_pages, max_pages, chars_per_page, seed):
+    """
+    Generates a reproducible synthetic corpus of CV-like PDF and DOCX files.
+
+    Parameters:
+    - documents (int): The number of files to generate.
+    - pdf_ratio (float): The share of PDF files, between 0 and 1. The rest are DOCX files.
+    - min_pages, max_pages (int): The range of pages per PDF file (and paragraphs per DOCX file).
+    - chars_per_page (int): The approximate number of characters of text per page or paragraph.
+    - seed (int): Seed of the random generator, so the same arguments always produce the same corpus.
+
+    Yields:
+    - tuple: The key and the content (bytes) of each file.
+
+    """
+    generator = random.Random(seed)
+    words = ['experience', 'python', 'sql', 'analytics', 'engineering', 'pipeline', 'warehouse', 'leadership',
+             'stakeholder', 'delivery', 'cloud', 'modeling', 'reporting', 'automation', 'quality', 'design']
+
+    def line_of_text(length):
+        text = []
+        while sum(len(word) + 1 for word in text) < length:
+            text.append(generator.choice(words))
+        return ' '.join(text)
+
+    for index in range(documents):
+        pages = generator.randint(min_pages, max_pages)
+
+        if generator.random() < pdf_ratio:
+            # Lines of ~90 characters fit the page width at the chosen font size
+            content = make_pdf([[line_of_text(90) for _ in range(max(1, chars_per_page // 90))] for _ in range(pages)])
+            yield f"benchmark/cv_{index:06d}.pdf", content
+        else:
+            content = make_docx([line_of_text(chars_per_page) for _ in range(pages)])
+            yield f"benchmark/cv_{index:06d}.docx", content
+
+def upload_corpus(s3, bucket_name, corpus):
+    """ Creates the benchmark bucket if needed and uploads the corpus to it. Returns the number of files and bytes uploaded. """
+    client = s3.meta.client
+
+    existing_buckets = [bucket['Name'] for bucket in client.list_buckets().get('Buckets', [])]
+    if bucket_name not in existing_buckets:
+        client.create_bucket(Bucket=bucket_name)
+
+    uploaded_files, uploaded_bytes = 0, 0
+    for key, content in corpus:
+        client.put_object(Bucket=bucket_name, Key=key, Body=content)
+        uploaded_files += 1
+        uploaded_bytes += len(content)
+
+    return uploaded_files, uploaded_bytes
+
+# %%
+def reset_target_table(connection, schema_name, table_name):
+    """ Drops the benchmark table and its listing watermark, so every run ingests the whole corpus. """
+    with connection.cursor() as cursor:
+        cursor.execute(f"CREATE SCHEMA IF NOT EXISTS {schema_name};")
+        cursor.execute(f"DROP TABLE IF EXISTS {schema_name}.{table_name};")
+        cursor.execute(f"DROP TABLE IF EXISTS {schema_name}.{table_name}_listing_watermark;")
+    connection.commit()
+
+def percentiles(samples):
+    """ Summarises latency samples (in seconds) as count, mean and p50/p90/p99/max in milliseconds. """
+    if not samples:
+        return {'count': 0}
+
+    ordered = sorted(samples)
+    def percentile(share):
+        return round(ordered[min(len(ordered) - 1, int(share * len(ordered)))] * 1000, 3)
+
+    return {'count': len(ordered),
+            'mean_ms': round(statistics.mean(ordered) * 1000, 3),
+            'p50_ms': percentile(0.50),
+            'p90_ms': percentile(0.90),
+            'p99_ms': percentile(0.99),
+            'max_ms': round(ordered[-1] * 1000, 3)}
+
+def _peak_rss_mb():
+    """ Peak resident set size of this process and of its (finished) child processes, in MB. """
+    # ru_maxrss is reported in kilobytes on Linux and in bytes on macOS
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return {'self': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale, 1),
+            'children': round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale, 1)}
+
+def _run_pipeline(settings, results):
+    """
+    Child process entry point: runs process_documents end to end over the benchmark bucket.
+
+    Running the pipeline in a fresh process keeps the corpus generation and the stage profile out of the peak RSS figures.
+    The run is instrumented with a PipelineMetrics, whose snapshot shows where the time went while the stages overlap.
+
+    """
+    s3 = s3_ingestion.connect_to_s3_bucket(settings['bucket'])
+    connection = s3_ingestion.connect_to_database()
+
+    metrics = s3_ingestion.PipelineMetrics()
+
+    started = time.perf_counter()
+    s3_ingestion.process_documents(s3, settings['bucket'], connection, settings['schema'], settings['table'],
+                                   download_workers=settings['download_workers'],
+                                   parse_workers=settings['parse_workers'],
+                                   insert_batch_size=settings['batch_size'],
+                                   metrics=metrics)
+    elapsed = time.perf_counter() - started
+
+    with connection.cursor() as cursor:
+        cursor.execute(f"SELECT COUNT(*) FROM {settings['schema']}.{settings['table']};")
+        documents_written = cursor.fetchone()[0]
+
+    results.put({'elapsed_seconds': elapsed, 'documents_written': documents_written, 'peak_rss_mb': _peak_rss_mb(),
+                 'pipeline_metrics': metrics.snapshot()})
+
+def _wait_for_run(pipeline, results, poll_seconds=PIPELINE_POLL_SECONDS):
+    """
+    Waits for the results of the pipeline process, or for it to die without sending them.
+
+    Returns the results, or None if the process exited first (e.g. it could not connect to the database,
+    or failed on an error, whose traceback it prints).
+
+    """
+    while True:
+        try:
+            return results.get(timeout=poll_seconds)
+        except Empty:
+            if not pipeline.is_alive():
+                # The results may have been sent just before the process exited
+                try:
+                    return results.get(timeout=1)
+                except Empty:
+                    return None
+
+def profile_stages(s3, bucket_name, connection, schema_name, table_name, batch_size, max_pages):
+    """
+    Measures the latency of each stage of the pipeline on its own, by calling the stage functions one after the other.
+
+    Stages: list (whole listing), hash check (one bulk lookup), download and parse (per file) and insert (per batch).
+    The inserts go to a scratch table that is dropped afterwards.
+
+    Returns:
+    - dict: The latency percentiles of each stage.
+
+    """
+    samples = {'list': [], 'hash_check': [], 'download': [], 'parse': [], 'insert': []}
+    bucket = s3.Bucket(bucket_name)
+
+    started = time.perf_counter()
+    documents = list(s3_ingestion.list_bucket_documents(bucket))
+    samples['list'].append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    s3_ingestion.fetch_existing_hashes(connection, schema_name, table_name)
+    samples['hash_check'].append(time.perf_counter() - started)
+
+    scratch_table = f"{table_name}_stage_profile"
+    s3_ingestion.ensure_table_exists(connection, schema_name, scratch_table)
+    writer = s3_ingestion.ExtractedContentWriter(connection, schema_name, scratch_table, batch_size=batch_size)
+
+    for document in documents:
+        started = time.perf_counter()
+        _, cv_file = s3_ingestion.download_s3_file(s3, bucket_name, document)
+        samples['download'].append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        _, pagewise_content, _ = s3_ingestion._parse_document((document, cv_file), max_pages=max_pages)
+        samples['parse'].append(time.perf_counter() - started)
+
+        if pagewise_content is None:
+            continue
+
+        # Rows are buffered by hand so that each flush, and only the flush, is timed
+        writer.rows.append((document.e_tag, document.key, document.last_modified, pagewise_content))
+        if len(writer.rows) >= batch_size:
+            started = time.perf_counter()
+            writer.flush()
+            samples['insert'].append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    writer.flush()
+    samples['insert'].append(time.perf_counter() - started)
+
+    with connection.cursor() as cursor:
+        cursor.execute(f"DROP TABLE IF EXISTS {schema_name}.{scratch_table};")
+    connection.commit()
+
+    return {stage: percentiles(stage_samples) for stage, stage_samples in samples.items()}
+
+# %%
+def save_results(results, results_dir=RESULTS_DIR):
+    """
+    Saves the results of a run as a timestamped JSON file and returns the results of the latest earlier run 
+    with the same settings and corpus, if any. Runs with other settings are not comparable, so they are skipped.
+    """
+    os.makedirs(results_dir, exist_ok=True)
+    previous_files = sorted(name for name in os.listdir(results_dir) if name.endswith('.json'))
+
+    previous = None
+    for previous_name in reversed(previous_files):
+        with open(os.path.join(results_dir, previous_name)) as previous_file:
+            candidate = json.load(previous_file)
+        if candidate.get('settings') == results['settings'] and candidate.get('corpus') == results['corpus']:
+            previous = candidate
+            break
+
+    result_path = os.path.join(results_dir, f"s3_ingestion_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    with open(result_path, 'w') as result_file:
+        json.dump(results, result_file, indent=2, default=str)
+    print(f"Results saved to: {result_path}")
+
+    return previous
+
+def print_comparison(current, previous):
+    """ Prints the headline figures of the run, next to those of the previous run with the same settings when there is one. """
+    headline = [('documents/sec', ('throughput', 'documents_per_second')),
+                ('MB/sec', ('throughput', 'megabytes_per_second')),
+                ('peak RSS, main (MB)', ('peak_rss_mb', 'self')),
+                ('peak RSS, workers (MB)', ('peak_rss_mb', 'children'))]
+
+    if previous:
+        print(f"\nCompared with the run of {previous.get('run_at')}, which had the same settings and corpus.")
+    else:
+        print("\nNo earlier result with the same settings and corpus to compare with.")
+
+    print(f"\n{'metric':<26}{'this run':>14}{'previous':>14}{'change':>10}")
+    for label, (section, key) in headline:
+        value = current[section][key]
+        previous_value = previous.get(section, {}).get(key) if previous else None
+
+        if previous_value:
+            change = f"{(value - previous_value) / previous_value * 100:+.1f}%"
+            print(f"{label:<26}{value:>14}{previous_value:>14}{change:>10}")
+        else:
+            print(f"{label:<26}{value:>14}{'-':>14}{'-':>10}")
+
+    print(f"\n{'stage':<14}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for stage, stage_percentiles in current['stage_latency'].items():
+        if stage_percentiles['count']:
+            print(f"{stage:<14}{stage_percentiles['p50_ms']:>10}{stage_percentiles['p90_ms']:>10}{stage_percentiles['p99_ms']:>10}{stage_percentiles['max_ms']:>10}")
+
+def main():
+    """ Generates and uploads the corpus, runs the pipeline, profiles its stages and saves the results. """
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="Benchmark the S3 document ingestion against a local S3 stand-in and PostgreSQL.")
+    parser.add_argument('--bucket', default='ingestion-benchmark', help="Benchmark bucket (created if missing).")
+    parser.add_argument('--schema', default='benchmark', help="Schema of the benchmark table.")
+    parser.add_argument('--table', default='extracted_content', help="Benchmark table (dropped before each run).")
+    parser.add_argument('--documents', type=int, default=200, help="Number of files in the corpus.")
+    parser.add_argument('--pdf-ratio', type=float, default=0.8, help="Share of PDF files in the corpus.")
+    parser.add_argument('--min-pages', type=int, default=1, help="Minimum pages per file.")
+    parser.add_argument('--max-pages', type=int, default=5, help="Maximum pages per file.")
+    parser.add_argument('--chars-per-page', type=int, default=2500, help="Approximate characters of text per page.")
+    parser.add_argument('--seed', type=int, default=42, help="Seed of the corpus generator.")
+    parser.add_argument('--skip-upload', action='store_true', help="Reuse the corpus already in the bucket.")
+    parser.add_argument('--download-workers', type=int, default=0, help="Download threads (0 with --parse-workers 0 runs the serial path).")
+    parser.add_argument('--parse-workers', type=int, default=0, help="Parse processes.")
+    parser.add_argument('--batch-size', type=int, default=100, help="Documents inserted per commit.")
+    parser.add_argument('--results-dir', default=RESULTS_DIR, help="Directory where the results are saved.")
+    arguments = parser.parse_args()
+
+    settings = {'bucket': arguments.bucket, 'schema': arguments.schema, 'table': arguments.table,
+                'download_workers': arguments.download_workers, 'parse_workers': arguments.parse_workers,
+                'batch_size': arguments.batch_size}
+
+    # The bucket may not exist yet, so the resource is not checked with connect_to_s3_bucket here
+    s3 = get_s3_resource(os.getenv('ACCESS_KEY'), os.getenv('SECRET_KEY'), os.getenv('REGION'), os.getenv('S3_ENDPOINT_URL'))
+    connection = s3_ingestion.connect_to_database()
+    if connection is None:
+        return
+
+    if not arguments.skip_upload:
+        print("Generating and uploading the corpus...")
+        corpus = generate_corpus(arguments.documents, arguments.pdf_ratio, arguments.min_pages, arguments.max_pages,
+                                 arguments.chars_per_page, arguments.seed)
+        upload_corpus(s3, arguments.bucket, corpus)
+
+    corpus_files, corpus_bytes = 0, 0
+    for document in s3_ingestion.list_bucket_documents(s3.Bucket(arguments.bucket)):
+        corpus_files += 1
+        corpus_bytes += document.size
+
+    reset_target_table(connection, arguments.schema, arguments.table)
+
+    print("Running the pipeline...")
+    # 'spawn' gives the pipeline a fresh process, so its peak RSS is not inflated by this one
+    context = multiprocessing.get_context('spawn')
+    results_queue = context.Queue()
+    pipeline = context.Process(target=_run_pipeline, args=(settings, results_queue))
+    pipeline.start()
+    run = _wait_for_run(pipeline, results_queue)
+    pipeline.join()
+
+    if run is None:
+        print(f"The pipeline process failed (exit code {pipeline.exitcode}), no results were recorded.")
+        return
+
+    print("Profiling the stages...")
+    reset_target_table(connection, arguments.schema, arguments.table)
+    s3_ingestion.ensure_table_exists(connection, arguments.schema, arguments.table)
+    stage_latency = profile_stages(s3, arguments.bucket, connection, arguments.schema, arguments.table,
+                                   arguments.batch_size, s3_ingestion.MAX_DOCUMENT_PAGES)
+
+    results = {'run_at': datetime.now().isoformat(timespec='seconds'),
+               'settings': settings,
+               'corpus': {'files': corpus_files, 'bytes': corpus_bytes, 'seed': arguments.seed,
+                          'pdf_ratio': arguments.pdf_ratio, 'pages': [arguments.min_pages, arguments.max_pages],
+                          'chars_per_page': arguments.chars_per_page},
+               'throughput': {'elapsed_seconds': round(run['elapsed_seconds'], 3),
+                              'documents_written': run['documents_written'],
+                              'documents_per_second': round(run['documents_written'] / run['elapsed_seconds'], 2),
+                              'megabytes_per_second': round(corpus_bytes / (1024 * 1024) / run['elapsed_seconds'], 3)},
+               'peak_rss_mb': run['peak_rss_mb'],
+               'stage_latency': stage_latency,
+               'pipeline_metrics': run['pipeline_metrics']}
+
+    previous = save_results(results, arguments.results_dir)
+    print_comparison(results, previous)
+
+if __name__ == "__main__":
+    main()
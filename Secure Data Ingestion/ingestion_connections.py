@@ -0,0 +1,131 @@
+import os
+import threading
+from contextlib import contextmanager
+from functools import lru_cache
+from psycopg2.pool import ThreadedConnectionPool
+from dotenv import load_dotenv
+
+# Shared connection layer for the Secure Data Ingestion scripts.
+# Connections are created once per process and reused, instead of paying the TCP, TLS and authentication set up on every call.
+# The scripts import this module by name, so the Secure Data Ingestion folder must be on the PYTHONPATH (run_ingestion_script sets it).
+
+# Load the environment variables from the .env file, so the settings below can be overridden there
+load_dotenv()
+
+# Size limits of the shared pools. Each can be overridden from the .env file.
+DB_POOL_MIN_CONNECTIONS = int(os.getenv('DB_POOL_MIN_CONNECTIONS', 1))
+DB_POOL_MAX_CONNECTIONS = int(os.getenv('DB_POOL_MAX_CONNECTIONS', 10))
+S3_MAX_POOL_CONNECTIONS = int(os.getenv('S3_MAX_POOL_CONNECTIONS', 50))
+
+_connection_pools = {}
+_connection_pools_lock = threading.Lock()
+
+def get_connection_pool(db_config):
+    """
+    Returns the PostgreSQL connection pool for a database, creating it on first use.
+
+    One pool is kept per distinct set of connection parameters, so every script (and every thread of a script)
+    connecting to the same database with the same credentials shares the same connections.
+
+    Required:
+    - from psycopg2.pool import ThreadedConnectionPool
+
+    Parameters:
+    - db_config (dict): The keyword arguments accepted by psycopg2.connect, e.g. dbname, user, password, host and port.
+
+    Returns:
+    pool (psycopg2.pool.ThreadedConnectionPool): A thread-safe pool holding between
+    DB_POOL_MIN_CONNECTIONS and DB_POOL_MAX_CONNECTIONS connections.
+
+    """
+    pool_key = tuple(sorted((key, str(value)) for key, value in db_config.items()))
+
+    with _connection_pools_lock:
+        pool = _connection_pools.get(pool_key)
+
+        if pool is None or pool.closed:
+            pool = ThreadedConnectionPool(DB_POOL_MIN_CONNECTIONS, DB_POOL_MAX_CONNECTIONS, **db_config)
+            _connection_pools[pool_key] = pool
+
+    return pool
+
+@contextmanager
+def pooled_connection(db_config):
+    """
+    Borrows a connection from the shared pool for the duration of a `with` block.
+
+    Usage:
+        with pooled_connection(DB_CONFIG) as conn:
+            with conn.cursor() as cur:
+                ...
+            conn.commit()
+
+    Parameters:
+    - db_config (dict): The keyword arguments accepted by psycopg2.connect.
+
+    Yields:
+    conn (psycopg2.extensions.connection): A connection from the pool.
+
+    Notes:
+    - Work left uncommitted at the end of the block is rolled back, so the next borrower always gets a clean connection.
+    - A connection that was closed or broken while borrowed is discarded by the pool instead of being handed out again.
+
+    """
+    pool = get_connection_pool(db_config)
+    conn = pool.getconn()
+
+    try:
+        yield conn
+    finally:
+        if not conn.closed:
+            conn.rollback()
+        pool.putconn(conn, close=bool(conn.closed))
+
+def close_connection_pools():
+    """ Closes every connection held by the shared pools, e.g. at the end of a run. """
+    with _connection_pools_lock:
+        for pool in _connection_pools.values():
+            if not pool.closed:
+                pool.closeall()
+        _connection_pools.clear()
+
+@lru_cache(maxsize=None)
+def get_s3_resource(aws_access_key_id=None, aws_secret_access_key=None, region_name=None, endpoint_url=None):
+    """
+    Returns a boto3 S3 resource, creating it on first use.
+
+    One resource is kept per distinct set of credentials, region and endpoint, so repeated calls reuse the same
+    HTTP connection pool. The pool is sized with S3_MAX_POOL_CONNECTIONS, so that many download threads
+    can share the resource's (thread-safe) client without waiting for a free connection.
+
+    Required:
+    - import boto3 (imported on first use, so the API scripts can use the database pool without installing boto3)
+    - from botocore.config import Config
+
+    Parameters:
+    - aws_access_key_id (str): The AWS access key ID for your account.
+    - aws_secret_access_key (str): The AWS secret access key for your account.
+    - region_name (str): The name of the AWS region where the S3 bucket is located.
+    - endpoint_url (str, optional): The URL of an S3-compatible stand-in to use instead of AWS.
+
+    Returns:
+    s3 (boto3.resources.factory.s3.ServiceResource): A resource representing Amazon S3.
+
+    Notes:
+    - boto3 resources are not thread-safe. Threads should go through the resource's client (s3.meta.client), which is.
+
+    """
+    import boto3
+    from botocore.config import Config
+
+    session = boto3.session.Session(aws_access_key_id=aws_access_key_id,
+                                    aws_secret_access_key=aws_secret_access_key,
+                                    region_name=region_name)
+
+    return session.resource('s3',
+                            endpoint_url=endpoint_url,
+                            config=Config(max_pool_connections=S3_MAX_POOL_CONNECTIONS))
+
+def get_s3_client(aws_access_key_id=None, aws_secret_access_key=None, region_name=None, endpoint_url=None):
+    """ Returns the (thread-safe) client of the cached S3 resource for the given credentials, region and endpoint. """
+    return get_s3_resource(aws_access_key_id, aws_secret_access_key, region_name, endpoint_url).meta.client